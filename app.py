@@ -1,171 +1,65 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, send_from_directory
+from flask import Flask, Blueprint, request, jsonify, render_template, redirect, url_for
 import sqlite3
 import os # <--- 1. 确保导入 os 模块
+import time
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from user import User
+import database
+from database import get_db
+import migrations
+from versions import conditional_get, user_scope
+from images import variant_urls, InvalidImageError
+import upload_store
+import dates
+import jobs
+import metrics
+import profiler
+import upload_gc  # 注册定期清理上传文件的任务
+from inventory import reset_stock, apply_refill
 from communicate import communicate_bp # <--- 1. 导入蓝图
+from search import search_bp
+from transfer import transfer_bp
 
-app = Flask(__name__)
-# 请务必在生产环境中更改此密钥
-app.secret_key = 'a_very_secret_and_secure_key_for_flask_session'
+# 页面和 API 视图，在 create_app() 中注册到应用
+main_bp = Blueprint('main_bp', __name__)
 
 # --- Flask-Login 初始化 ---
 login_manager = LoginManager()
-login_manager.init_app(app)
-# 如果用户未登录并尝试访问受保护的页面，将他们重定向到'login'视图
-login_manager.login_view = 'login'
-
-app.register_blueprint(communicate_bp) # <--- 2. 注册蓝图
+# 如果用户未登录并尝试访问受保护的页面，将他们重定向到登录视图
+login_manager.login_view = 'main_bp.login'
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.get(user_id)
 
-# --- 数据库初始化 (已重构以支持多用户) ---
-def init_db():
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    print("Opened database successfully")
-
-    # --- 创建 users 表 (如果不存在) ---
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT NOT NULL UNIQUE,
-            password_hash TEXT NOT NULL,
-            avatar TEXT
-        )
-    ''')
-
-    # --- 创建 people 表 (如果不存在) ---
-    # 这样修改后，它将不再删除现有数据
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS people (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            name TEXT NOT NULL,
-            FOREIGN KEY(user_id) REFERENCES users(id),
-            UNIQUE(user_id, name)
-        )
-    ''')
-
-    # --- 检查并更新 records 表，添加 user_id ---
-    records_cols = [col[1] for col in cursor.execute("PRAGMA table_info(records)").fetchall()]
-    if 'user_id' not in records_cols:
-        cursor.execute('ALTER TABLE records ADD COLUMN user_id INTEGER')
-
-    # --- 确保所有字段都存在 (用于旧数据库的迁移) ---
-    columns = [col[1] for col in cursor.execute("PRAGMA table_info(records)").fetchall()]
-    fields_to_add = {
-        'category': 'TEXT NOT NULL DEFAULT "general"', 'date': 'TEXT', 'time': 'TEXT', 'urgency': 'TEXT',
-        'status': 'TEXT NOT NULL DEFAULT "pending"', 'quantity': 'TEXT', 'unit': 'TEXT', 'brand': 'TEXT',
-        'person_id': 'INTEGER', 'type': 'TEXT', 'color': 'TEXT', 'frequency': 'TEXT', 'style': 'TEXT',
-        'needs_purchase': 'INTEGER DEFAULT 0', 'dosage': 'TEXT', 'total_quantity': 'INTEGER',
-        'start_date': 'TEXT', 'refill_quantity': 'INTEGER', 'reminder_threshold': 'INTEGER',
-        'source_record_id': 'INTEGER', 'shopping_source_id': 'INTEGER',
-        'completion_notes': 'TEXT',
-        'completion_photos': 'TEXT'
-    }
-    for field, definition in fields_to_add.items():
-        if field not in columns:
-            cursor.execute(f'ALTER TABLE records ADD COLUMN {field} {definition}')
-
-    # --- 创建 records 表 (如果不存在) ---
-    # 确保 records 表的定义是最新的
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS records (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            user_id INTEGER, content TEXT, category TEXT NOT NULL DEFAULT "general",
-            date TEXT, time TEXT, urgency TEXT, status TEXT NOT NULL DEFAULT "pending",
-            quantity TEXT, unit TEXT, brand TEXT, person_id INTEGER, type TEXT, color TEXT,
-            frequency TEXT, style TEXT, needs_purchase INTEGER DEFAULT 0, dosage TEXT,
-            total_quantity INTEGER, start_date TEXT, refill_quantity INTEGER,
-            reminder_threshold INTEGER, source_record_id INTEGER, shopping_source_id INTEGER,
-            completion_notes TEXT, completion_photos TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(id),
-            FOREIGN KEY(person_id) REFERENCES people(id)
-        )
-    ''')
-
-    # --- 新增：创建帖子、评论和点赞的表 ---
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS posts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            content TEXT NOT NULL,
-            timestamp DATETIME NOT NULL,
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    ''')
-    
-    # --- 新增：为 posts 表添加 photos 列 (如果不存在) ---
-    post_columns = [col[1] for col in cursor.execute("PRAGMA table_info(posts)").fetchall()]
-    if 'photos' not in post_columns:
-        cursor.execute('ALTER TABLE posts ADD COLUMN photos TEXT')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS comments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            post_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            content TEXT NOT NULL,
-            timestamp DATETIME NOT NULL,
-            FOREIGN KEY(post_id) REFERENCES posts(id),
-            FOREIGN KEY(user_id) REFERENCES users(id)
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS likes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            post_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            FOREIGN KEY(post_id) REFERENCES posts(id),
-            FOREIGN KEY(user_id) REFERENCES users(id),
-            UNIQUE(post_id, user_id)
-        )
-    ''')
-
-
-    print("Table schemas are up to date.")
-    conn.commit()
-    conn.close()
-
-init_db()
-
 # --- 用户认证 API 和页面 ---
-@app.route('/login', methods=['GET', 'POST'])
+@main_bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main_bp.index'))
     if request.method == 'POST':
         data = request.get_json()
         username = data.get('username')
         password = data.get('password')
-        conn = None # 初始化
-        try:
-            conn = sqlite3.connect('database.db', timeout=15)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-            user_row = cursor.fetchone()
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM users WHERE username = ? AND deleted_at IS NULL", (username,))
+        user_row = cursor.fetchone()
 
-            if user_row and check_password_hash(user_row['password_hash'], password):
-                user_obj = User(id=user_row['id'], username=user_row['username'], avatar=user_row['avatar'])
-                login_user(user_obj, remember=True)
-                return jsonify({"status": "success"})
-            
-            return jsonify({"error": "无效的用户名或密码"}), 401
-        finally:
-            if conn:
-                conn.close()
+        if user_row and check_password_hash(user_row['password_hash'], password):
+            user_obj = User(id=user_row['id'], username=user_row['username'], avatar=user_row['avatar'])
+            login_user(user_obj, remember=True)
+            return jsonify({"status": "success"})
+
+        return jsonify({"error": "无效的用户名或密码"}), 401
     return render_template('login.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+@main_bp.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main_bp.index'))
     if request.method == 'POST':
         data = request.get_json()
         username = data.get('username')
@@ -175,9 +69,8 @@ def register():
             return jsonify({"error": "用户名和密码不能为空"}), 400
 
         password_hash = generate_password_hash(password)
-        conn = None
+        conn = get_db()
         try:
-            conn = sqlite3.connect('database.db', timeout=15)
             cursor = conn.cursor()
             cursor.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash))
             conn.commit()
@@ -186,30 +79,33 @@ def register():
             conn.rollback()
             return jsonify({"error": "用户名已存在"}), 409
         except sqlite3.Error as e:
-            if conn: conn.rollback()
+            conn.rollback()
             return jsonify({"error": str(e)}), 500
-        finally:
-            if conn:
-                conn.close()
     return render_template('register.html')
 
-@app.route('/logout')
+@main_bp.route('/logout')
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for('login'))
+    return redirect(url_for('main_bp.login'))
 
-@app.route('/api/user/current')
+@main_bp.route('/api/user/current')
 @login_required
+@conditional_get(user_scope)
 def get_current_user_info():
+    # current_user 可能来自其他 worker 尚未过期的缓存，这里直接读取最新的用户信息
+    cursor = get_db().cursor()
+    cursor.execute("SELECT username, avatar FROM users WHERE id = ?", (current_user.id,))
+    user_row = cursor.fetchone()
     return jsonify({
-        "username": current_user.username,
-        "avatar": current_user.avatar,
+        "username": user_row['username'],
+        "avatar": user_row['avatar'],
+        "avatar_variants": variant_urls(user_row['avatar'], 'avatar'),
         "id": current_user.id
     })
 
 # --- 新增：处理头像上传的 API ---
-@app.route('/api/user/avatar', methods=['POST'])
+@main_bp.route('/api/user/avatar', methods=['POST'])
 @login_required
 def upload_avatar():
     if 'avatar' not in request.files:
@@ -220,183 +116,186 @@ def upload_avatar():
         return jsonify({"error": "没有选择文件"}), 400
 
     if file:
-        # 确保 uploads 目录存在
-        upload_folder = 'uploads'
-        if not os.path.exists(upload_folder):
-            os.makedirs(upload_folder)
-
-        # 为了安全，生成一个唯一的文件名
-        import uuid
-        filename = str(uuid.uuid4()) + os.path.splitext(file.filename)[1]
-        filepath = os.path.join(upload_folder, filename)
-        file.save(filepath)
-
-        # **关键修复**: 将路径转换为 URL 格式 (使用正斜杠)
-        url_path = filepath.replace('\\', '/')
+        # 重新编码并生成 128/64 两种尺寸，数据库中保存 128 版本的路径
+        try:
+            upload = upload_store.prepare_upload(file, 'avatar')
+        except InvalidImageError as e:
+            return jsonify({"error": str(e)}), 400
 
         # 更新数据库中的头像路径
-        conn = _get_db_conn()
+        conn = get_db()
         cursor = conn.cursor()
         try:
+            # 相同内容的头像只保存一份；旧头像的引用随之释放
+            url_path = upload_store.store_upload(cursor, upload)
+            cursor.execute("DELETE FROM upload_refs WHERE owner_kind = 'avatar' AND owner_id = ?", (current_user.id,))
+            upload_store.add_ref(cursor, url_path, current_user.id, 'avatar', current_user.id)
             # **关键修复**: 保存 URL 格式的路径
             cursor.execute("UPDATE users SET avatar = ? WHERE id = ?", (url_path, current_user.id))
             conn.commit()
+            User.invalidate(current_user.id)
         except sqlite3.Error as e:
             conn.rollback()
             return jsonify({"error": str(e)}), 500
-        finally:
-            conn.close()
         
         # 返回新的头像路径，以便前端更新
-        return jsonify({"status": "success", "avatar_url": f"/{url_path}"})
+        return jsonify({"status": "success", "avatar_url": f"/{url_path}", "avatar_variants": variant_urls(url_path, 'avatar')})
 
     return jsonify({"error": "文件上传失败"}), 500
 
 
 # --- 新增：注销账户 API ---
-@app.route('/api/user/delete', methods=['DELETE'])
+@main_bp.route('/api/user/delete', methods=['DELETE'])
 @login_required
 def delete_account():
     user_id = current_user.id
-    conn = _get_db_conn()
+    conn = get_db()
     cursor = conn.cursor()
     try:
-        # 1. 查找该用户上传的所有文件以便后续删除
-        photo_paths_to_delete = []
-        # 查找头像
-        cursor.execute("SELECT avatar FROM users WHERE id = ?", (user_id,))
-        avatar_row = cursor.fetchone()
-        if avatar_row and avatar_row['avatar']:
-            photo_paths_to_delete.append(avatar_row['avatar'])
-        
-        # 查找记录中的照片
-        cursor.execute("SELECT completion_photos FROM records WHERE user_id = ? AND completion_photos IS NOT NULL", (user_id,))
-        import json
-        for row in cursor.fetchall():
-            try:
-                paths = json.loads(row['completion_photos'])
-                if isinstance(paths, list):
-                    photo_paths_to_delete.extend(paths)
-            except json.JSONDecodeError:
-                continue
-
-        # 2. 从数据库中删除所有与用户相关的数据
-        # 由于外键约束，删除顺序很重要：先删子表，再删主表
-        cursor.execute("DELETE FROM records WHERE user_id = ?", (user_id,))
-        cursor.execute("DELETE FROM people WHERE user_id = ?", (user_id,))
-        cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
-        
+        # 1. 只写入注销标记并加入删除任务，请求中不做耗时的删除，尽快释放写锁
+        cursor.execute(
+            "UPDATE users SET deleted_at = ? WHERE id = ? AND deleted_at IS NULL",
+            (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), user_id)
+        )
+        jobs.enqueue(cursor, 'purge_account', {"user_id": user_id})
         conn.commit()
+        User.invalidate(user_id)
+        jobs.wake()
 
-        # 3. 从文件系统中删除用户上传的文件
-        for path in photo_paths_to_delete:
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except OSError as e:
-                    # 记录错误，但继续执行，以防文件被占用等问题
-                    print(f"Error deleting file {path}: {e}")
-        
-        # 4. 登出用户
+        # 2. 登出用户
         logout_user()
 
     except sqlite3.Error as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
         
     return jsonify({"status": "success", "message": "账户已成功注销"})
 
 
+ACCOUNT_PURGE_BATCH_SIZE = 200
+ACCOUNT_PURGE_POST_BATCH_SIZE = 20  # 每个帖子还要连带删除其他用户的评论和点赞
+
+def _delete_in_batches(conn, table, where, params):
+    """分批删除，每批单独提交，避免长时间持有写锁阻塞其他请求"""
+    while True:
+        cursor = conn.execute(
+            f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE {where} LIMIT {ACCOUNT_PURGE_BATCH_SIZE})",
+            params
+        )
+        conn.commit()
+        if cursor.rowcount < ACCOUNT_PURGE_BATCH_SIZE:
+            break
+
+@jobs.handler('purge_account')
+def purge_account(conn, payload):
+    """后台删除已注销用户的所有数据和不再被引用的文件，可以重复执行"""
+    user_id = payload['user_id']
+    # 1. 先记下该用户引用的文件，删除数据时触发器会释放这些引用
+    photo_paths_to_delete = upload_store.referenced_paths(conn.cursor(), user_id)
+
+    # 2. 该用户的点赞、评论，以及帖子 (连同其他用户在上面的评论和点赞)
+    _delete_in_batches(conn, 'likes', 'user_id = ?', (user_id,))
+    _delete_in_batches(conn, 'comments', 'user_id = ?', (user_id,))
+    while True:
+        post_ids = [row['id'] for row in conn.execute(
+            "SELECT id FROM posts WHERE user_id = ? LIMIT ?", (user_id, ACCOUNT_PURGE_POST_BATCH_SIZE)
+        ).fetchall()]
+        if not post_ids:
+            break
+        placeholders = ','.join('?' for _ in post_ids)
+        conn.execute(f"DELETE FROM comments WHERE post_id IN ({placeholders})", post_ids)
+        conn.execute(f"DELETE FROM likes WHERE post_id IN ({placeholders})", post_ids)
+        conn.execute(f"DELETE FROM posts WHERE id IN ({placeholders})", post_ids)
+        conn.commit()
+
+    # 3. 记录和人物，最后删除用户本身
+    _delete_in_batches(conn, 'records', 'user_id = ?', (user_id,))
+    _delete_in_batches(conn, 'people', 'user_id = ?', (user_id,))
+    conn.execute("DELETE FROM users WHERE id = ? AND deleted_at IS NOT NULL", (user_id,))
+    conn.commit()
+
+    # 4. 删除不再被任何人引用的文件 (同样的图片可能也被其他用户上传过)
+    for i in range(0, len(photo_paths_to_delete), ACCOUNT_PURGE_BATCH_SIZE):
+        upload_store.purge_unreferenced(conn, photo_paths_to_delete[i:i + ACCOUNT_PURGE_BATCH_SIZE])
+
+
 # **新增**: 获取已完成的记录
-@app.route('/api/records/completed', methods=['GET'])
+@main_bp.route('/api/records/completed', methods=['GET'])
 @login_required
+@conditional_get(user_scope)
 def get_completed_records():
-    conn = _get_db_conn()
+    conn = get_db()
     cursor = conn.cursor()
     user_id = current_user.id
     # 查询所有非药品提醒的、已完成的记录，按日期降序
     cursor.execute("""
-        SELECT id, content, date, completion_notes, completion_photos 
+        SELECT id, content, date, completion_notes 
         FROM records 
         WHERE user_id = ? AND status = 'completed' AND category != 'medicine_reminder'
         ORDER BY date DESC
     """, (user_id,))
-    completed_records = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    rows = cursor.fetchall()
+    # 照片用一次索引查询取出
+    photos_by_record = upload_store.load_user_photos(cursor, user_id, 'completion')
+    completed_records = []
+    for row in rows:
+        record = dict(row)
+        record['completion_photos'] = photos_by_record.get(record['id'], [])
+        record['completion_photo_variants'] = [variant_urls(p, 'photo') for p in record['completion_photos']]
+        completed_records.append(record)
     return jsonify(completed_records)
 
 # **新增**: 更新已完成记录的感想和照片
-@app.route('/api/completed_records/<int:record_id>/details', methods=['POST'])
+@main_bp.route('/api/completed_records/<int:record_id>/details', methods=['POST'])
 @login_required
 def update_completed_details(record_id):
     notes = request.form.get('notes')
     photos = request.files.getlist('photos')
     
-    photo_paths = []
-    if photos:
-        upload_folder = 'uploads'
-        if not os.path.exists(upload_folder):
-            os.makedirs(upload_folder)
-        
-        import uuid
-        from werkzeug.utils import secure_filename
-
-        for photo in photos:
-            if photo and photo.filename != '':
-                # 使用 secure_filename 和 uuid 确保文件名安全且唯一
-                base_filename = secure_filename(photo.filename)
-                unique_filename = str(uuid.uuid4()) + os.path.splitext(base_filename)[1]
-                filepath = os.path.join(upload_folder, unique_filename)
-                
-                # **关键修复**: 保存文件到服务器
-                photo.save(filepath)
-                
-                # **关键修复**: 存储 URL 格式的相对路径 (使用正斜杠)
-                url_path = filepath.replace('\\', '/')
-                photo_paths.append(url_path)
+    uploads = []
+    for photo in photos:
+        if photo and photo.filename != '':
+            # 重新编码并生成缩略图，存储主版本的 URL 格式相对路径
+            try:
+                uploads.append(upload_store.prepare_upload(photo, 'photo'))
+            except InvalidImageError as e:
+                return jsonify({"error": str(e)}), 400
 
-    conn = _get_db_conn()
+    conn = get_db()
     cursor = conn.cursor()
     user_id = current_user.id
     try:
-        cursor.execute("SELECT completion_photos FROM records WHERE id = ? AND user_id = ? AND status = 'completed'", (record_id, user_id))
-        record = cursor.fetchone()
-        if not record:
+        # 更新感想，同时确认记录归属
+        cursor.execute(
+            "UPDATE records SET completion_notes = ? WHERE id = ? AND user_id = ? AND status = 'completed' RETURNING id",
+            (notes, record_id, user_id)
+        )
+        if not cursor.fetchone():
             return jsonify({"error": "记录不存在或权限不足"}), 404
         
-        import json
-        # 获取已有的照片列表
-        existing_photos = json.loads(record['completion_photos']) if record['completion_photos'] else []
-        
-        # 将新上传的照片路径追加到列表中
-        all_photos = existing_photos + photo_paths
-        
-        # 更新感想和照片列表
-        cursor.execute("UPDATE records SET completion_notes = ?, completion_photos = ? WHERE id = ?", (notes, json.dumps(all_photos), record_id))
+        # 新上传的照片追加到已有照片之后，每张只插入一行
+        for upload in uploads:
+            path = upload_store.store_upload(cursor, upload)
+            upload_store.add_photo(cursor, path, user_id, 'completion', record_id)
         conn.commit()
     except sqlite3.Error as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
     return jsonify({"status": "success"})
 
 
 # --- 人物 API (已添加用户隔离) ---
-@app.route('/api/people', methods=['GET'])
+@main_bp.route('/api/people', methods=['GET'])
 @login_required
+@conditional_get(user_scope)
 def get_people():
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM people WHERE user_id = ? ORDER BY name", (current_user.id,))
     people = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     return jsonify(people)
 
-@app.route('/api/people', methods=['POST'])
+@main_bp.route('/api/people', methods=['POST'])
 @login_required
 def add_person():
     data = request.get_json()
@@ -404,7 +303,7 @@ def add_person():
     if not name:
         return jsonify({"error": "Name is required"}), 400
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     cursor = conn.cursor()
     user_id = current_user.id
     try:
@@ -420,14 +319,12 @@ def add_person():
         conn.rollback()
         # 捕获其他可能的数据库错误
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
     return jsonify({"status": "success"}), 201
 
-@app.route('/api/people/<int:person_id>', methods=['DELETE'])
+@main_bp.route('/api/people/<int:person_id>', methods=['DELETE'])
 @login_required
 def delete_person(person_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     cursor = conn.cursor()
     user_id = current_user.id
     try:
@@ -441,15 +338,13 @@ def delete_person(person_id):
     except sqlite3.Error as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
     return jsonify({"status": "success"})
 
-@app.route('/api/people/<int:person_id>/details', methods=['GET'])
+@main_bp.route('/api/people/<int:person_id>/details', methods=['GET'])
 @login_required
+@conditional_get(user_scope, daily=True)
 def get_person_details(person_id):
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     user_id = current_user.id
 
@@ -457,68 +352,38 @@ def get_person_details(person_id):
     if not cursor.fetchone():
         return jsonify({"error": "权限不足或人物不存在"}), 403
 
-    cursor.execute("SELECT * FROM records WHERE person_id = ? AND category = 'clothes' AND user_id = ?", (person_id, user_id))
+    # 按类别的视图只包含该类记录使用的列 (见 migrations.py)
+    cursor.execute("SELECT * FROM clothes_records WHERE person_id = ? AND user_id = ?", (person_id, user_id))
     clothes = [dict(row) for row in cursor.fetchall()]
 
-    cursor.execute("SELECT * FROM records WHERE person_id = ? AND category = 'medicine' AND user_id = ?", (person_id, user_id))
-    medicines = [dict(row) for row in cursor.fetchall()]
-
-    conn.close()
+    cursor.execute("SELECT * FROM medicine_records WHERE person_id = ? AND user_id = ?", (person_id, user_id))
+    medicines = []
+    for row in cursor.fetchall():
+        medicine = dict(row)
+        medicine['total_quantity'] = medicine.pop('current_quantity')
+        medicines.append(medicine)
     return jsonify({"clothes": clothes, "medicines": medicines})
 
 # --- 记录 API (已添加用户隔离) ---
-@app.route('/api/records', methods=['GET'])
+@main_bp.route('/api/records', methods=['GET'])
 @login_required
+@conditional_get(user_scope, daily=True)
 def get_records():
     category = request.args.get('category', 'general')
-    conn = None
+    conn = get_db()
     try:
-        conn = sqlite3.connect('database.db', timeout=15)
-        conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         user_id = current_user.id
         records = []
 
         if category == 'medicine':
-            # --- 关键重构：将读和写分离 ---
-            # 步骤1: 读取所有药品
-            cursor.execute("SELECT * FROM records WHERE category = 'medicine' AND user_id = ?", (user_id,))
-            medicines_to_update = cursor.fetchall()
-            today = datetime.now().date()
-            updates_to_perform = []
-
-            for med in medicines_to_update:
-                if med['start_date'] and med['total_quantity'] is not None and med['frequency'] and med['dosage']:
-                    try:
-                        start_date = datetime.strptime(med['start_date'], '%Y-%m-%d').date()
-                        # 确保频率和用量是数字
-                        frequency = int(med['frequency'])
-                        dosage = int(med['dosage'])
-
-                        if start_date < today:
-                            days_passed = (today - start_date).days
-                            total_consumption = days_passed * frequency * dosage
-                            new_quantity = med['total_quantity'] - total_consumption
-                            if new_quantity < 0:
-                                new_quantity = 0
-                            # 收集需要执行的更新，而不是立即执行
-                            updates_to_perform.append((new_quantity, today.strftime('%Y-%m-%d'), med['id']))
-                    except (ValueError, TypeError):
-                        # 如果 frequency 或 dosage 不是有效数字，或者日期格式错误，则安全地跳过
-                        print(f"Skipping update for medicine ID {med['id']} due to invalid data.")
-                        continue
-            
-            # 步骤2: 一次性执行所有更新
-            if updates_to_perform:
-                cursor.executemany("UPDATE records SET total_quantity = ?, start_date = ? WHERE id = ?", updates_to_perform)
-                conn.commit()
-
-            # 步骤3: 重新查询以获取最新数据
-            query = "SELECT p.id as person_id, p.name as person_name, r.* FROM records r JOIN people p ON r.person_id = p.id WHERE r.category = ? AND r.user_id = ? ORDER BY p.name, r.id"
-            cursor.execute(query, (category, user_id))
+            # 当前库存在查询时直接算出 (视图中的 current_quantity)，GET 请求不再写数据库
+            query = "SELECT p.id as person_id, p.name as person_name, r.* FROM medicine_records r JOIN people p ON r.person_id = p.id WHERE r.user_id = ? ORDER BY p.name, r.id"
+            cursor.execute(query, (user_id,))
             items_by_person = {}
             for row_obj in cursor.fetchall():
                 row = dict(row_obj)
+                row['total_quantity'] = row.pop('current_quantity')
                 person_id = row['person_id']
                 if person_id not in items_by_person:
                     items_by_person[person_id] = {"person_id": person_id, "person_name": row['person_name'], "items": []}
@@ -526,8 +391,8 @@ def get_records():
             records = list(items_by_person.values())
         
         elif category in ['clothes']: # **修改**: 将 clothes 也移到这里
-            query = "SELECT p.id as person_id, p.name as person_name, r.* FROM records r JOIN people p ON r.person_id = p.id WHERE r.category = ? AND r.user_id = ? ORDER BY p.name, r.id"
-            cursor.execute(query, (category, user_id))
+            query = "SELECT p.id as person_id, p.name as person_name, r.* FROM clothes_records r JOIN people p ON r.person_id = p.id WHERE r.user_id = ? ORDER BY p.name, r.id"
+            cursor.execute(query, (user_id,))
             items_by_person = {}
             for row_obj in cursor.fetchall():
                 row = dict(row_obj)
@@ -540,106 +405,70 @@ def get_records():
         else: # category == 'general' or 'shopping'
             # **关键修复**: 只有在 category 是 'general' 时才执行提醒逻辑
             if category == 'general':
-                # --- 步骤 1: 执行药品自动消耗计算 (从 medicine 分支复制过来) ---
-                cursor.execute("SELECT * FROM records WHERE category = 'medicine' AND user_id = ?", (user_id,))
-                medicines_to_update = cursor.fetchall()
-                today = datetime.now().date()
-                updates_to_perform = []
-
-                for med in medicines_to_update:
-                    if med['start_date'] and med['total_quantity'] is not None and med['frequency'] and med['dosage']:
-                        try:
-                            start_date = datetime.strptime(med['start_date'], '%Y-%m-%d').date()
-                            if start_date < today:
-                                days_passed = (today - start_date).days
-                                total_consumption = days_passed * int(med['frequency']) * int(med['dosage'])
-                                new_quantity = med['total_quantity'] - total_consumption
-                                if new_quantity < 0: new_quantity = 0
-                                updates_to_perform.append((new_quantity, today.strftime('%Y-%m-%d'), med['id']))
-                        except (ValueError, TypeError):
-                            continue
-                
-                if updates_to_perform:
-                    cursor.executemany("UPDATE records SET total_quantity = ?, start_date = ? WHERE id = ?", updates_to_perform)
-                    conn.commit()
-                
-                # --- 步骤 2: 在更新后的数据基础上生成提醒 ---
+                # 1. 读取提醒
+                # 提醒由 reminders 表的触发器在药品/购物项变化时增量维护 (见 migrations.py)，
+                # 药品库存提醒记录了库存低于阈值的日期，这里只需一次按 active_from 过滤的索引查询
                 reminders = []
                 today_str = datetime.now().strftime('%Y-%m-%d')
-                
-                # 1. 生成药品库存警告
-                cursor.execute("""
-                    SELECT r.id, p.name, r.content, r.total_quantity, r.reminder_threshold 
-                    FROM records r 
-                    LEFT JOIN people p ON r.person_id = p.id 
-                    WHERE r.category = 'medicine' AND r.user_id = ?
-                """, (user_id,))
-                for med_row_obj in cursor.fetchall():
-                    med_row = dict(med_row_obj)
-                    try:
-                        total_quantity = int(med_row['total_quantity'])
-                        reminder_threshold = int(med_row['reminder_threshold'])
-                        if total_quantity < reminder_threshold:
-                            person_name = med_row['name'] or '未知人物'
-                            reminder_content = f"库存警告: {person_name}的'{med_row['content']}'数量不足"
-                            # **关键修复**: 添加 original_medicine_id 字段
-                            reminders.append({
-                                "id": f"med_{med_row['id']}", 
-                                "content": reminder_content, 
-                                "category": "general", 
-                                "date": today_str, 
-                                "time": "08:00", 
-                                "urgency": "高", 
-                                "status": "pending", 
-                                "is_dynamic_reminder": True,
-                                "original_medicine_id": med_row['id'] # <-- 新增的这行是关键
-                            })
-                    except (ValueError, TypeError, KeyError):
-                        continue
-
-                # 2. **新增**: 生成购物提醒
-                cursor.execute("SELECT DISTINCT date FROM records WHERE category = 'shopping' AND status = 'pending' AND date IS NOT NULL AND user_id = ?", (user_id,))
-                shopping_dates = [row['date'] for row in cursor.fetchall()]
-                for s_date in shopping_dates:
-                    # **关键修复**: 使用一个不会与数据库ID冲突的、唯一的字符串ID
-                    # 并且明确标识这是一个购物提醒
-                    reminder_id = f"dynamic_shopping_{s_date}"
-                    reminders.append({
-                        "id": reminder_id, 
-                        "content": f"有计划的购物任务 ({s_date})", 
-                        "category": "general", 
-                        "date": s_date, 
-                        "time": "09:00", 
-                        "urgency": "中", 
-                        "status": "pending", 
-                        "is_dynamic_reminder": True,
-                        "is_shopping_reminder": True # **新增**: 添加一个明确的标识
-                    })
-
-                # 3. 获取普通的通用记录
+                cursor.execute(
+                    "SELECT kind, source_key, content FROM reminders WHERE user_id = ? AND active_from <= ? ORDER BY kind, id",
+                    (user_id, today_str)
+                )
+                for reminder in cursor.fetchall():
+                    if reminder['kind'] == 'medicine':
+                        # **关键修复**: 添加 original_medicine_id 字段
+                        reminders.append({
+                            "id": f"med_{reminder['source_key']}", 
+                            "content": reminder['content'], 
+                            "category": "general", 
+                            "date": today_str, 
+                            "time": "08:00", 
+                            "urgency": "高", 
+                            "status": "pending", 
+                            "is_dynamic_reminder": True,
+                            "original_medicine_id": int(reminder['source_key'])
+                        })
+                    else:
+                        # **关键修复**: 使用一个不会与数据库ID冲突的、唯一的字符串ID
+                        # 并且明确标识这是一个购物提醒
+                        s_date = reminder['source_key']
+                        reminders.append({
+                            "id": f"dynamic_shopping_{s_date}", 
+                            "content": reminder['content'], 
+                            "category": "general", 
+                            "date": s_date, 
+                            "time": "09:00", 
+                            "urgency": "中", 
+                            "status": "pending", 
+                            "is_dynamic_reminder": True,
+                            "is_shopping_reminder": True # **新增**: 添加一个明确的标识
+                        })
+
+                # 2. 获取普通的通用记录
                 sort_by = request.args.get('sort_by', 'urgency')
+                # urgency_rank 是由 urgency 算出的虚拟列，两种排序各有一个部分索引，不需要临时排序
                 order_clause = "ORDER BY date ASC, "
                 if sort_by == 'time':
-                    order_clause += "time ASC, CASE urgency WHEN '高' THEN 1 WHEN '中' THEN 2 WHEN '低' THEN 3 ELSE 4 END"
+                    order_clause += "time ASC, urgency_rank ASC"
                 else:
-                    order_clause += "CASE urgency WHEN '高' THEN 1 WHEN '中' THEN 2 WHEN '低' THEN 3 ELSE 4 END, time ASC"
+                    order_clause += "urgency_rank ASC, time ASC"
 
-                query = f"SELECT * FROM records WHERE category = ? AND status = 'pending' AND user_id = ? {order_clause}"
-                cursor.execute(query, (category, user_id))
+                query = f"SELECT * FROM general_records WHERE status = 'pending' AND user_id = ? {order_clause}"
+                cursor.execute(query, (user_id,))
                 general_records = [dict(row) for row in cursor.fetchall()]
                 
-                # 4. 合并并返回
+                # 3. 合并并返回
                 records = reminders + general_records
             
             # **关键修复**: 为 shopping category 添加独立的、正确的处理逻辑
             elif category == 'shopping':
                 status = request.args.get('status')
                 if status:
-                    query = "SELECT * FROM records WHERE category = ? AND status = ? AND user_id = ? ORDER BY date DESC, id DESC"
-                    cursor.execute(query, (category, status, user_id))
+                    query = "SELECT * FROM shopping_records WHERE status = ? AND user_id = ? ORDER BY date DESC, id DESC"
+                    cursor.execute(query, (status, user_id))
                 else: # 如果没有提供 status，则获取所有购物项
-                    query = "SELECT * FROM records WHERE category = ? AND user_id = ? ORDER BY date DESC, id DESC"
-                    cursor.execute(query, (category, user_id))
+                    query = "SELECT * FROM shopping_records WHERE user_id = ? ORDER BY date DESC, id DESC"
+                    cursor.execute(query, (user_id,))
                 records = [dict(row) for row in cursor.fetchall()]
             
         return jsonify(records)
@@ -647,17 +476,57 @@ def get_records():
         # 添加一个顶层异常捕获，以便调试
         print(f"An unexpected error occurred in get_records: {e}")
         return jsonify({"error": "服务器内部错误"}), 500
-    finally:
-        if conn:
-            conn.close()
 
-@app.route('/api/records', methods=['POST'])
+def _record_insert(category, data, user_id):
+    """返回新增一条记录的 (SQL, 参数)；缺少必填字段时抛出 KeyError"""
+    if category == 'clothes':
+        return ("INSERT INTO records (user_id, content, category, person_id, type, color, quantity) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, data['content'], 'clothes', data.get('person_id'), data['type'], data['color'], data['quantity']))
+    if category == 'medicine':
+        # **关键修复**: 为 reminder_threshold 设置默认值
+        reminder_threshold = data.get('reminder_threshold')
+        if not reminder_threshold:
+            reminder_threshold = 5 # 设置默认值为 5
+        return ("INSERT INTO records (user_id, content, category, person_id, frequency, dosage, style, color, total_quantity, start_date, refill_quantity, reminder_threshold) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, data['content'], 'medicine', data.get('person_id'), data.get('frequency'), data.get('dosage'), data['style'], data['color'], data.get('total_quantity'), data.get('start_date'), data.get('refill_quantity'), reminder_threshold))
+    if category == 'shopping':
+        return ("INSERT INTO records (user_id, content, category, date, quantity, unit, brand) VALUES (?, ?, 'shopping', ?, ?, ?, ?)",
+                (user_id, data['content'], data.get('date'), data.get('quantity'), data.get('unit'), data.get('brand')))
+    return ("INSERT INTO records (user_id, content, category, date, time, urgency, status) VALUES (?, ?, ?, ?, ?, ?, 'pending')",
+            (user_id, data['content'], category, data.get('date'), data.get('time'), data.get('urgency')))
+
+
+def _record_update(category, data, record_id):
+    """返回更新一条记录的 (SQL, 参数)，不支持的类别返回 None；缺少必填字段时抛出 KeyError"""
+    if category == 'general':
+        return ("UPDATE records SET content=?, date=?, time=?, urgency=? WHERE id=?",
+                (data['content'], data['date'], data['time'], data['urgency'], record_id))
+    if category == 'shopping':
+        return ("UPDATE records SET content=?, date=?, quantity=?, unit=?, brand=? WHERE id=?",
+                (data['content'], data.get('date'), data.get('quantity'), data.get('unit'), data.get('brand'), record_id))
+    if category == 'clothes':
+        return ("UPDATE records SET person_id=?, content=?, type=?, color=?, quantity=? WHERE id=?",
+                (data['person_id'], data['content'], data['type'], data['color'], data['quantity'], record_id))
+    if category == 'medicine':
+        # **关键修复**: 为 reminder_threshold 设置默认值
+        reminder_threshold = data.get('reminder_threshold')
+        if not reminder_threshold:
+            reminder_threshold = 5 # 设置默认值为 5
+        return ("UPDATE records SET person_id=?, content=?, frequency=?, dosage=?, style=?, color=?, refill_quantity=?, reminder_threshold=? WHERE id=?",
+                (data['person_id'], data['content'], data.get('frequency'), data.get('dosage'), data['style'], data['color'], data.get('refill_quantity'), reminder_threshold, record_id))
+    return None
+
+@main_bp.route('/api/records', methods=['POST'])
 @login_required
 def add_record():
     data = request.get_json()
     category = data.get('category', 'general')
+    try:
+        dates.normalize_record_fields(data)
+    except ValueError:
+        return jsonify({"error": "无效的日期或时间格式"}), 400
     user_id = current_user.id
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     cursor = conn.cursor()
     try:
         person_id = data.get('person_id')
@@ -667,70 +536,44 @@ def add_record():
             if not cursor.fetchone():
                 return jsonify({"error": "无效的人物ID"}), 403
 
-        if category == 'clothes':
-            cursor.execute("INSERT INTO records (user_id, content, category, person_id, type, color, quantity) VALUES (?, ?, ?, ?, ?, ?, ?)", (user_id, data['content'], 'clothes', person_id, data['type'], data['color'], data['quantity']))
-        elif category == 'medicine':
-            # **关键修复**: 为 reminder_threshold 设置默认值
-            reminder_threshold = data.get('reminder_threshold')
-            if not reminder_threshold:
-                reminder_threshold = 5 # 设置默认值为 5
-
-            cursor.execute("INSERT INTO records (user_id, content, category, person_id, frequency, dosage, style, color, total_quantity, start_date, refill_quantity, reminder_threshold) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", 
-                           (user_id, data['content'], 'medicine', person_id, data.get('frequency'), data.get('dosage'), data['style'], data['color'], data.get('total_quantity'), data.get('start_date'), data.get('refill_quantity'), reminder_threshold))
-        elif category == 'shopping':
-            cursor.execute("INSERT INTO records (user_id, content, category, date, quantity, unit, brand) VALUES (?, ?, 'shopping', ?, ?, ?, ?)", (user_id, data['content'], data.get('date'), data.get('quantity'), data.get('unit'), data.get('brand')))
-        else:
-            cursor.execute("INSERT INTO records (user_id, content, category, date, time, urgency, status) VALUES (?, ?, ?, ?, ?, ?, 'pending')", (user_id, data['content'], category, data.get('date'), data.get('time'), data.get('urgency')))
+        cursor.execute(*_record_insert(category, data, user_id))
         conn.commit()
     except sqlite3.Error as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
     return jsonify({"status": "success"}), 201
 
-@app.route('/api/records/<int:record_id>', methods=['PUT'])
+@main_bp.route('/api/records/<int:record_id>', methods=['PUT'])
 @login_required
 def update_record(record_id):
     data = request.get_json()
     category = data.get('category', 'general')
+    try:
+        dates.normalize_record_fields(data)
+    except ValueError:
+        return jsonify({"error": "无效的日期或时间格式"}), 400
     user_id = current_user.id
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     cursor = conn.cursor()
     try:
         cursor.execute("SELECT id FROM records WHERE id = ? AND user_id = ?", (record_id, user_id))
         if not cursor.fetchone():
             return jsonify({"error": "权限不足或记录不存在"}), 403
         
-        if category == 'general':
-            cursor.execute("UPDATE records SET content=?, date=?, time=?, urgency=? WHERE id=?", (data['content'], data['date'], data['time'], data['urgency'], record_id))
-        elif category == 'shopping':
-            cursor.execute("UPDATE records SET content=?, date=?, quantity=?, unit=?, brand=? WHERE id=?", (data['content'], data.get('date'), data.get('quantity'), data.get('unit'), data.get('brand'), record_id))
-        elif category == 'clothes':
-            cursor.execute("UPDATE records SET person_id=?, content=?, type=?, color=?, quantity=? WHERE id=?", (data['person_id'], data['content'], data['type'], data['color'], data['quantity'], record_id))
-        elif category == 'medicine':
-            # **关键修复**: 为 reminder_threshold 设置默认值
-            reminder_threshold = data.get('reminder_threshold')
-            if not reminder_threshold:
-                reminder_threshold = 5 # 设置默认值为 5
-
-            cursor.execute("UPDATE records SET person_id=?, content=?, frequency=?, dosage=?, style=?, color=?, refill_quantity=?, reminder_threshold=? WHERE id=?", 
-                           (data['person_id'], data['content'], data.get('frequency'), data.get('dosage'), data['style'], data['color'], data.get('refill_quantity'), reminder_threshold, record_id))
+        statement = _record_update(category, data, record_id)
+        if statement:
+            cursor.execute(*statement)
         conn.commit()
     except sqlite3.Error as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
     return jsonify({"status": "success"})
 
-@app.route('/api/records/<int:record_id>', methods=['DELETE'])
+@main_bp.route('/api/records/<int:record_id>', methods=['DELETE'])
 @login_required
 def delete_record(record_id):
-    conn = None
+    conn = get_db()
     try:
-        conn = sqlite3.connect('database.db', timeout=15)
-        conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         user_id = current_user.id
         
@@ -756,14 +599,11 @@ def delete_record(record_id):
         cursor.execute("DELETE FROM records WHERE id = ? AND user_id = ?", (record_id, user_id))
         conn.commit()
     except sqlite3.Error as e:
-        if conn: conn.rollback()
+        conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        if conn:
-            conn.close()
     return jsonify({"status": "success"})
 
-@app.route('/api/records/<int:record_id>/status', methods=['PUT'])
+@main_bp.route('/api/records/<int:record_id>/status', methods=['PUT'])
 @login_required
 def update_record_status(record_id):
     data = request.get_json()
@@ -771,107 +611,238 @@ def update_record_status(record_id):
     if not new_status in ['completed', 'pending']:
         return jsonify({"error": "无效的状态"}), 400
 
-    conn = _get_db_conn()
+    conn = get_db()
     cursor = conn.cursor()
     user_id = current_user.id
     try:
-        # 1. 获取记录信息，并严格检查其类型
-        cursor.execute("SELECT category, source_record_id FROM records WHERE id = ? AND user_id = ?", (record_id, user_id))
+        # 1. 只在状态真正改变时更新，并直接返回记录类型；重复点击不会重复补充库存
+        cursor.execute("""
+            UPDATE records SET status = ?
+            WHERE id = ? AND user_id = ? AND category IN ('general', 'shopping') AND status != ?
+            RETURNING category, source_record_id
+        """, (new_status, record_id, user_id, new_status))
         record = cursor.fetchone()
         if not record:
-            return jsonify({"error": "记录不存在或权限不足"}), 404
+            # 没有更新任何行时再区分原因 (只在少见的情况下多一次查询)
+            cursor.execute("SELECT category FROM records WHERE id = ? AND user_id = ?", (record_id, user_id))
+            existing = cursor.fetchone()
+            if not existing:
+                return jsonify({"error": "记录不存在或权限不足"}), 404
+            if existing['category'] not in ('general', 'shopping'):
+                return jsonify({"error": "此接口只用于更新购物清单项的状态"}), 400
+            if existing['category'] == 'general':
+                return jsonify({"status": "success", "message": "通用记录状态已更新"})
+            return jsonify({"status": "success"})
 
         # **关键修复**: 如果是通用记录，只更新状态，然后立即返回
         if record['category'] == 'general':
-            cursor.execute("UPDATE records SET status = ? WHERE id = ?", (new_status, record_id))
             conn.commit()
             return jsonify({"status": "success", "message": "通用记录状态已更新"})
 
-        # --- 从这里开始，代码只处理 shopping 类型的记录 ---
-        if record['category'] != 'shopping':
-            return jsonify({"error": "此接口只用于更新购物清单项的状态"}), 400
-
+        # 2. 如果购物项来自药品，执行核心联动逻辑：
+        # 完成时补充库存并取消 "需要购买"，撤销时扣回库存并恢复 "需要购买"
+        # 源药品被删除时 apply_refill 不更新任何行，只更新购物项状态
         source_medicine_id = record['source_record_id']
-
-        # 2. 如果购物项来自药品，执行核心联动逻辑
         if source_medicine_id:
-            # 获取源药品的当前数量和预设的补充数量
-            cursor.execute("SELECT total_quantity, refill_quantity FROM records WHERE id = ? AND user_id = ?", (source_medicine_id, user_id))
-            medicine = cursor.fetchone()
-            if not medicine:
-                # 如果源药品被删除了，安全地继续，只更新购物项状态
-                pass
+            if new_status == 'completed':
+                apply_refill(cursor, source_medicine_id, user_id, sign=1, needs_purchase=0)
             else:
-                refill_amount = medicine['refill_quantity']
-                if not refill_amount or refill_amount <= 0:
-                    refill_amount = 0 # 即使未设置，也继续执行
-
-                current_total = medicine['total_quantity'] or 0
-                new_total = current_total
-
-                # 根据新的状态，增加或扣除药品数量
-                if new_status == 'completed':
-                    new_total += refill_amount
-                    cursor.execute("UPDATE records SET needs_purchase = 0 WHERE id = ?", (source_medicine_id,))
-                elif new_status == 'pending':
-                    new_total -= refill_amount
-                    if new_total < 0: new_total = 0
-                    cursor.execute("UPDATE records SET needs_purchase = 1 WHERE id = ?", (source_medicine_id,))
-                
-                new_start_date = datetime.now().strftime('%Y-%m-%d')
-                cursor.execute("UPDATE records SET total_quantity = ?, start_date = ? WHERE id = ?", (new_total, new_start_date, source_medicine_id))
-
-        # 3. 更新购物项本身的状态
-        cursor.execute("UPDATE records SET status = ? WHERE id = ?", (new_status, record_id))
-
-        # 4. **关键修改**: 移除 shopping_source_id 相关逻辑
+                apply_refill(cursor, source_medicine_id, user_id, sign=-1, needs_purchase=1)
 
         conn.commit()
     except (sqlite3.Error, ValueError) as e:
-        if conn: conn.rollback()
+        conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        if conn:
-            conn.close()
     return jsonify({"status": "success"})
 
-# --- 特定功能 API (已添加用户隔离) ---
+MAX_BATCH_OPERATIONS = 500
+BATCH_OPS = ('create', 'update', 'delete', 'status')
+
+
+def _batch_record_id(op):
+    """非 create 操作的记录 ID，不是整数时返回 None"""
+    record_id = op.get('id')
+    return record_id if isinstance(record_id, int) and not isinstance(record_id, bool) else None
+
+
+def _batch_person_key(value):
+    """人物 ID 可能是整数或数字字符串，统一为字符串；其他类型返回 None"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(value)
+    if isinstance(value, str) and value.strip().isdigit():
+        return value.strip()
+    return None
+
+
+def _validate_batch_op(op, owned, people, duplicates):
+    """检查一个批量操作，返回错误信息 (合法时返回 None)；create/update 的 data 中的日期会被统一格式"""
+    kind = op.get('op')
+    if kind not in BATCH_OPS:
+        return "未知的操作类型"
+    if kind == 'create':
+        data = op.get('data')
+        if not isinstance(data, dict) or not data.get('content'):
+            return "缺少记录内容"
+    else:
+        record_id = _batch_record_id(op)
+        if record_id is None:
+            return "无效的记录ID"
+        if record_id in duplicates:
+            return "同一条记录在一个批次中只能出现一次"
+        record = owned.get(record_id)
+        if record is None:
+            return "记录不存在或权限不足"
+        if kind == 'status':
+            if op.get('status') not in ('completed', 'pending'):
+                return "无效的状态"
+            if record['category'] not in ('general', 'shopping'):
+                return "此操作只用于通用记录和购物清单项"
+            return None
+        if kind == 'delete':
+            return None
+        data = op.get('data')
+        if not isinstance(data, dict):
+            return "缺少更新内容"
+    person_id = data.get('person_id')
+    if person_id and _batch_person_key(person_id) not in people:
+        return "无效的人物ID"
+    try:
+        dates.normalize_record_fields(data)
+        category = data.get('category', 'general') if kind == 'create' else record['category']
+        statement = (_record_insert(category, data, 0) if kind == 'create'
+                     else _record_update(category, data, op['id']))
+    except ValueError:
+        return "无效的日期或时间格式"
+    except KeyError as e:
+        return f"缺少字段: {e.args[0]}"
+    if statement is None:
+        return "不支持更新此类记录"
+    return None
+
+
+@main_bp.route('/api/records/batch', methods=['POST'])
+@login_required
+def batch_records():
+    """
+    在一个事务中执行多个记录操作，任何一个操作无效时全部不执行。
+    请求: {"operations": [
+        {"op": "create", "data": {...与 POST /api/records 相同...}},
+        {"op": "update", "id": 1, "data": {...与 PUT /api/records/<id> 相同...}},
+        {"op": "delete", "id": 2},
+        {"op": "status", "id": 3, "status": "completed"}
+    ]}
+    返回: {"results": [{"index": 0, "status": "success", "id": 新记录的 id}, ...]}，
+    有无效操作时返回 400，results 中对应项为 {"status": "error", "error": ...}，其余为 "skipped"。
+    同一条记录在一个批次中只能出现一次。
+    执行顺序不是提交顺序，而是按类型分组: 先 create，再 update，然后 status，最后 delete (组内按提交顺序)。
+    例如同一批中修改药品的补充数量并完成它的购物项时，库存按修改后的补充数量增加。
+    """
+    payload = request.get_json(silent=True) or {}
+    operations = payload.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"error": "operations 不能为空"}), 400
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify({"error": f"一次最多 {MAX_BATCH_OPERATIONS} 个操作"}), 400
+    if not all(isinstance(op, dict) for op in operations):
+        return jsonify({"error": "无效的操作"}), 400
 
-def _get_db_conn():
-    conn = sqlite3.connect('database.db', timeout=15) # 确保这里有 timeout
-    conn.row_factory = sqlite3.Row
-    return conn
+    user_id = current_user.id
+    conn = get_db()
+    # 无效的类型、ID 和人物 ID 在 _validate_batch_op 中逐项报告，这里只收集合法的值
+    record_ids = [_batch_record_id(op) for op in operations if op.get('op') in BATCH_OPS and op.get('op') != 'create']
+    record_ids = [record_id for record_id in record_ids if record_id is not None]
+    duplicates = {record_id for record_id in record_ids if record_ids.count(record_id) > 1}
+    record_ids = list(dict.fromkeys(record_ids))
+    person_ids = {_batch_person_key(op['data'].get('person_id')) for op in operations if isinstance(op.get('data'), dict)}
+    person_ids.discard(None)
 
+    try:
+        # 校验和执行在同一个写事务中，校验结果在提交前不会被其他请求改变
+        conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.cursor()
+        # 所有记录和人物的归属各用一次查询确认
+        owned = {}
+        if record_ids:
+            placeholders = ','.join('?' for _ in record_ids)
+            cursor.execute(
+                f"SELECT id, category, status, source_record_id FROM records WHERE user_id = ? AND id IN ({placeholders})",
+                (user_id, *record_ids)
+            )
+            owned = {row['id']: row for row in cursor.fetchall()}
+        people = set()
+        if person_ids:
+            placeholders = ','.join('?' for _ in person_ids)
+            cursor.execute(f"SELECT id FROM people WHERE user_id = ? AND id IN ({placeholders})",
+                           (user_id, *(int(person_id) for person_id in person_ids)))
+            # 客户端可能以字符串提交人物 ID，统一按字符串比较
+            people = {str(row['id']) for row in cursor.fetchall()}
+
+        errors = {i: _validate_batch_op(op, owned, people, duplicates) for i, op in enumerate(operations)}
+        if any(errors.values()):
+            conn.rollback()
+            return jsonify({"results": [
+                {"index": i, "status": "error", "error": errors[i]} if errors[i] else {"index": i, "status": "skipped"}
+                for i in range(len(operations))
+            ]}), 400
+
+        results = [{"index": i, "status": "success"} for i in range(len(operations))]
+        # 按类型分组执行 (见上面的说明)，相同的语句合并为一次 executemany
+        updates = {}
+        for i, op in enumerate(operations):
+            if op['op'] == 'create':
+                # 需要返回新记录的 id，逐条插入 (仍在同一个事务中)
+                sql, params = _record_insert(op['data'].get('category', 'general'), op['data'], user_id)
+                cursor.execute(sql + " RETURNING id", params)
+                results[i]['id'] = cursor.fetchone()['id']
+            elif op['op'] == 'update':
+                sql, params = _record_update(owned[op['id']]['category'], op['data'], op['id'])
+                updates.setdefault(sql, []).append(params)
+        for sql, params in updates.items():
+            cursor.executemany(sql, params)
+
+        # 状态: 只更新真正改变的记录；来自药品的购物项与 update_record_status 一样联动库存
+        changed = [(op['status'], op['id'], user_id) for op in operations
+                   if op['op'] == 'status' and owned[op['id']]['status'] != op['status']]
+        cursor.executemany("UPDATE records SET status = ? WHERE id = ? AND user_id = ?", changed)
+        for new_status, record_id, _ in changed:
+            source_medicine_id = owned[record_id]['source_record_id']
+            if owned[record_id]['category'] == 'shopping' and source_medicine_id:
+                if new_status == 'completed':
+                    apply_refill(cursor, source_medicine_id, user_id, sign=1, needs_purchase=0)
+                else:
+                    apply_refill(cursor, source_medicine_id, user_id, sign=-1, needs_purchase=1)
+
+        # 删除: 与 delete_record 相同的联动
+        deleted = [op['id'] for op in operations if op['op'] == 'delete']
+        sources = [(owned[record_id]['source_record_id'], user_id) for record_id in deleted
+                   if owned[record_id]['category'] == 'shopping' and owned[record_id]['source_record_id']]
+        cursor.executemany("UPDATE records SET needs_purchase = 0 WHERE id = ? AND user_id = ?", sources)
+        cursor.executemany(
+            "DELETE FROM records WHERE category = 'shopping' AND source_record_id = ? AND user_id = ?",
+            [(record_id, user_id) for record_id in deleted if owned[record_id]['category'] == 'medicine']
+        )
+        cursor.executemany("DELETE FROM records WHERE id = ? AND user_id = ?", [(record_id, user_id) for record_id in deleted])
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"results": results})
 
+# --- 特定功能 API (已添加用户隔离) ---
 
 # **关键修改**: 再次审查并加固此函数
-@app.route('/api/records/<int:record_id>/refill', methods=['POST'])
+@main_bp.route('/api/records/<int:record_id>/refill', methods=['POST'])
 @login_required
 def refill_medicine_from_purchase(record_id):
-    conn = _get_db_conn()
+    conn = get_db()
     cursor = conn.cursor()
     user_id = current_user.id
     try:
-        # 1. 验证药品所有权
-        cursor.execute("SELECT total_quantity, refill_quantity FROM records WHERE id = ? AND user_id = ? AND category = 'medicine'", (record_id, user_id))
-        record = cursor.fetchone()
-        if not record:
+        # 1. 在当前库存的基础上增加补充数量 (未设置时不增加)，并取消 "需要购买" 状态
+        if apply_refill(cursor, record_id, user_id, sign=1, needs_purchase=0) is None:
             return jsonify({"error": "药品不存在或权限不足"}), 404
-        
-        # 2. 计算补充数量，即使未设置也继续执行
-        refill_amount = record['refill_quantity']
-        if not refill_amount or refill_amount <= 0:
-            refill_amount = 0 # 如果未设置，则不增加库存，但后续操作继续
-
-        # 3. 增加库存
-        new_total = (record['total_quantity'] or 0) + refill_amount
-        new_start_date = datetime.now().strftime('%Y-%m-%d')
-        cursor.execute("UPDATE records SET total_quantity = ?, start_date = ? WHERE id = ?", (new_total, new_start_date, record_id))
-
-        # 4. 将药品的“需要购买”状态取消
-        cursor.execute("UPDATE records SET needs_purchase = 0 WHERE id = ?", (record_id,))
 
-        # 5. **联动核心**: 在购物清单中查找对应的项，并将其状态更新为 'completed'
+        # 2. **联动核心**: 在购物清单中查找对应的项，并将其状态更新为 'completed'
         # 无论是否找到，这个操作都是安全的
         cursor.execute("UPDATE records SET status = 'completed' WHERE category = 'shopping' AND source_record_id = ? AND user_id = ?", (record_id, user_id))
 
@@ -880,66 +851,39 @@ def refill_medicine_from_purchase(record_id):
         conn.rollback()
         print(f"Error in refill_medicine_from_purchase: {e}") # 增加日志打印
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
     return jsonify({"status": "success", "message": "药品已补充，购物清单已更新"})
 
 
-def auto_refill_medicine(record_id, user_id):
-    """内部函数，用于补充药品，需要被调用时提供用户上下文"""
-    conn = _get_db_conn()
-    cursor = conn.cursor()
-    try:
-        # 验证药品所有权
-        cursor.execute("SELECT total_quantity, refill_quantity FROM records WHERE id = ? AND user_id = ?", (record_id, user_id))
-        record = cursor.fetchone()
-        if not record or not record['refill_quantity']:
-            raise ValueError("Refill quantity not set or permission denied")
-
-        new_total = (record['total_quantity'] or 0) + record['refill_quantity']
-        new_start_date = datetime.now().strftime('%Y-%m-%d')
-        cursor.execute("UPDATE records SET total_quantity = ?, start_date = ? WHERE id = ?", (new_total, new_start_date, record_id))
-        conn.commit()
-    finally:
-        conn.close()
-
-@app.route('/api/records/<int:record_id>/purchase', methods=['PUT'])
+@main_bp.route('/api/records/<int:record_id>/purchase', methods=['PUT'])
 @login_required
 def toggle_medicine_purchase(record_id):
     data = request.get_json()
     needs_purchase = data.get('needs_purchase', False)
-    conn = _get_db_conn()
+    conn = get_db()
     cursor = conn.cursor()
     user_id = current_user.id
     try:
-        cursor.execute("SELECT id, person_id FROM records WHERE id = ? AND category = 'medicine' AND user_id = ?", (record_id, user_id))
-        medicine_record = cursor.fetchone()
-        if not medicine_record:
+        # 更新标记并确认药品归属，一条语句完成
+        cursor.execute(
+            "UPDATE records SET needs_purchase = ? WHERE id = ? AND category = 'medicine' AND user_id = ? RETURNING id",
+            (1 if needs_purchase else 0, record_id, user_id)
+        )
+        if not cursor.fetchone():
             return jsonify({"error": "药品不存在或权限不足"}), 404
 
-        cursor.execute("UPDATE records SET needs_purchase = ? WHERE id = ?", (1 if needs_purchase else 0, record_id))
-        
         if needs_purchase:
-            # **关键修复**: 使用 LEFT JOIN，并只查询需要的字段
+            # **关键修复**: 人物可能为空 (LEFT JOIN)；已存在对应购物项时不再插入，检查和插入在同一条语句中
+            record_date = datetime.now().strftime('%Y-%m-%d')
             cursor.execute("""
-                SELECT r.content, p.name 
-                FROM records r 
-                LEFT JOIN people p ON r.person_id = p.id 
-                WHERE r.id = ?
-            """, (record_id,))
-            medicine_info = cursor.fetchone()
-
-            # **关键修复**: 即使 medicine_info 存在，也要处理 p.name 可能为 NULL 的情况
-            if medicine_info:
-                person_name = medicine_info['name'] or '未指定人物'
-                shopping_content = f"药品: {person_name} - {medicine_info['content']}"
-                
-                # **关键修复**: 检查是否已存在，如果不存在则插入
-                cursor.execute("SELECT id FROM records WHERE category = 'shopping' AND source_record_id = ? AND user_id = ?", (record_id, user_id))
-                if not cursor.fetchone():
-                    # **关键修复**: 插入时包含 date
-                    record_date = datetime.now().strftime('%Y-%m-%d')
-                    cursor.execute("INSERT INTO records (user_id, content, category, status, source_record_id, date) VALUES (?, ?, 'shopping', 'pending', ?, ?)", (user_id, shopping_content, record_id, record_date))
+                INSERT INTO records (user_id, content, category, status, source_record_id, date)
+                SELECT r.user_id, '药品: ' || COALESCE(p.name, '未指定人物') || ' - ' || COALESCE(r.content, ''),
+                       'shopping', 'pending', r.id, ?
+                FROM records r
+                LEFT JOIN people p ON r.person_id = p.id
+                WHERE r.id = ? AND NOT EXISTS (
+                    SELECT 1 FROM records s WHERE s.category = 'shopping' AND s.source_record_id = r.id AND s.user_id = r.user_id
+                )
+            """, (record_date, record_id))
         else:
             # 当取消购买需求时，直接通过 source_record_id 删除对应的购物项
             cursor.execute("DELETE FROM records WHERE category = 'shopping' AND source_record_id = ? AND user_id = ?", (record_id, user_id))
@@ -948,13 +892,11 @@ def toggle_medicine_purchase(record_id):
     except (sqlite3.Error, ValueError) as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
     return jsonify({"status": "success"})
 
 
 
-@app.route('/api/records/<int:record_id>/quantity', methods=['PUT'])
+@main_bp.route('/api/records/<int:record_id>/quantity', methods=['PUT'])
 @login_required
 def update_medicine_quantity(record_id):
     data = request.get_json()
@@ -962,7 +904,7 @@ def update_medicine_quantity(record_id):
     if new_quantity is None:
         return jsonify({"error": "total_quantity is required"}), 400
 
-    conn = _get_db_conn()
+    conn = get_db()
     cursor = conn.cursor()
     user_id = current_user.id
     try:
@@ -970,18 +912,18 @@ def update_medicine_quantity(record_id):
         if not cursor.fetchone():
             return jsonify({"error": "药品不存在或权限不足"}), 404
         
-        new_start_date = datetime.now().strftime('%Y-%m-%d')
-        cursor.execute("UPDATE records SET total_quantity = ?, start_date = ? WHERE id = ?", (new_quantity, new_start_date, record_id))
+        reset_stock(cursor, record_id, new_quantity)
         conn.commit()
     except sqlite3.Error as e:
         conn.rollback()
-        return jsonify({"status": "success"})
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"status": "success"})
 
-@app.route('/api/shopping/clear', methods=['POST'])
+@main_bp.route('/api/shopping/clear', methods=['POST'])
 @login_required
 def clear_shopping_list():
     """清空当前用户的所有购物清单项（包括已完成和未完成的）"""
-    conn = _get_db_conn()
+    conn = get_db()
     cursor = conn.cursor()
     user_id = current_user.id
     try:
@@ -998,32 +940,29 @@ def clear_shopping_list():
     except sqlite3.Error as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
     return jsonify({"status": "success"})
 
 
 # --- 新增：为 uploads 目录提供静态文件服务 ---
-from flask import send_from_directory
-
-@app.route('/uploads/<filename>')
+@main_bp.route('/uploads/<filename>')
+@login_required
 def uploaded_file(filename):
-    return send_from_directory('uploads', filename)
+    return upload_store.send_upload(filename)
 
 
 # --- 页面服务 ---
-@app.route('/')
+@main_bp.route('/')
 @login_required
 def index():
     return render_template('index.html')
 
-@app.route('/<page_name>')
+@main_bp.route('/<page_name>')
 def show_page(page_name):
     if page_name in ['login', 'register']:
         return render_template(f'{page_name}.html')
     
     if not current_user.is_authenticated:
-        return redirect(url_for('login'))
+        return redirect(url_for('main_bp.login'))
         
     # <--- 3. 添加 'communicate' 到允许的页面列表
     if page_name in ['medicine', 'clothes', 'shopping', 'people', 'profile', 'communicate']: 
@@ -1031,5 +970,44 @@ def show_page(page_name):
         
     return "Page not found", 404
 
+# --- 应用启动 ---
+def create_app():
+    """
+    创建并返回应用，导入本模块本身不会执行迁移或启动后台任务。
+    数据库版本已是最新时只做一次 O(1) 的版本号检查；需要迁移时由第一个进程持锁执行，
+    配合 gunicorn --preload (见 gunicorn.conf.py) 时每次部署只在 master 中执行一次。
+    """
+    started = time.perf_counter()
+    app = Flask(__name__)
+    # 请务必在生产环境中更改此密钥
+    app.secret_key = 'a_very_secret_and_secure_key_for_flask_session'
+    # 前面有 nginx 时设置为其 internal location 的前缀，由 nginx 发送上传的文件 (见 upload_store.send_upload)
+    app.config['UPLOADS_ACCEL_REDIRECT'] = os.environ.get('UPLOADS_ACCEL_REDIRECT')
+
+    login_manager.init_app(app)
+
+    app.register_blueprint(main_bp)
+    app.register_blueprint(communicate_bp) # <--- 2. 注册蓝图
+    app.register_blueprint(search_bp)
+    app.register_blueprint(transfer_bp)
+
+    # --- 数据库连接池初始化 (每个线程复用一个连接，请求结束时自动归还) ---
+    database.init_app(app)
+
+    # --- 按接口统计请求耗时和 SQL 指标，/metrics 输出 Prometheus 格式 ---
+    metrics.init_app(app)
+
+    # --- 在线采样分析 (设置 PROFILER_TOKEN 后启用，见 profiler.py) ---
+    profiler.init_app(app)
+
+    # --- 后台任务 (注销账户后的数据清理等)，每个进程在第一个请求时启动 ---
+    jobs.init_app(app)
+
+    migrations.ensure_schema()
+    boot_ms = (time.perf_counter() - started) * 1000
+    app.config['BOOT_TIME_MS'] = boot_ms
+    print(f"App ready in {boot_ms:.1f} ms (schema version {migrations.SCHEMA_VERSION}, pid {os.getpid()})")
+    return app
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
@@ -0,0 +1,640 @@
+"""
+API 性能基准测试。
+
+生成一个按随机种子确定的合成数据库 (用户、人物、四类记录、帖子、评论、点赞)，
+依次请求 app.py 和 communicate.py 中的每个接口，统计每个接口的 p50/p95/p99 延迟、
+吞吐量和 SQL 语句数，结果保存为 JSON，可以与之前保存的基线比较。
+
+    # 用 Flask 测试客户端运行 (默认在临时目录中生成数据库)
+    python benchmark.py run --scale small --out results.json
+    # 与基线比较，p95 变慢超过 20% 或 SQL 语句数增加时返回非 0
+    python benchmark.py run --baseline baseline.json
+    python benchmark.py compare baseline.json results.json
+
+    # 通过本地 gunicorn 运行: 先生成数据库，在该目录中启动 gunicorn，再指定 --url
+    python benchmark.py seed --dir /tmp/bench --scale medium
+    cd /tmp/bench && gunicorn -c /path/to/gunicorn.conf.py --pythonpath /path/to/app 'app:create_app()'
+    python benchmark.py run --url http://127.0.0.1:8000 --out results.json
+
+通过 HTTP 运行时无法统计服务端的 SQL 语句数，结果中为 null。
+每个接口单线程顺序请求，吞吐量是单个客户端每秒完成的请求数。
+写接口需要的数据 (要删除的记录、帖子等) 在计时之外通过接口本身准备。
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit, quote
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 每个用户的数据量；--set key=value 可以覆盖其中任意一项
+SCALES = {
+    'small': {
+        'users': 20, 'people': 3, 'general': 50, 'medicine': 8, 'clothes': 20, 'shopping': 20,
+        'posts': 5, 'comments': 3, 'likes': 5,
+    },
+    'medium': {
+        'users': 200, 'people': 5, 'general': 200, 'medicine': 15, 'clothes': 60, 'shopping': 50,
+        'posts': 20, 'comments': 5, 'likes': 10,
+    },
+    'large': {
+        'users': 1000, 'people': 8, 'general': 1000, 'medicine': 30, 'clothes': 150, 'shopping': 100,
+        'posts': 50, 'comments': 8, 'likes': 20,
+    },
+}
+
+PASSWORD = 'benchmark'
+DEFAULT_ITERATIONS = 100
+DEFAULT_WARMUP = 5
+REGRESSION_THRESHOLD = 0.2    # p95 延迟增加超过该比例视为变慢
+
+_WORDS = ('买菜', '牛奶', '鸡蛋', '面包', '散步', '体检', '复诊', '交水费', '取快递', '打扫卫生',
+          '公园', '天气', '维生素', '感冒药', '外套', '毛衣', '运动鞋', '生日', '聚餐', '读书')
+_URGENCY = ('高', '中', '低')
+
+
+def _sentence(rng, words=6):
+    return ' '.join(rng.choice(_WORDS) for _ in range(words))
+
+
+# --- 合成数据 ---
+
+def seed_database(directory, scale, seed):
+    """在 directory 中生成 database.db，返回统计信息；同样的 scale 和 seed 生成同样的数据"""
+    # 应用的数据库和上传目录都相对于当前工作目录
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+    sys.path.insert(0, APP_DIR)
+    import database
+    import migrations
+    from werkzeug.security import generate_password_hash
+
+    if os.path.exists(database.DATABASE):
+        raise SystemExit(f"{os.path.abspath(database.DATABASE)} 已存在，请指定一个空目录")
+    migrations.ensure_schema(log=lambda *args: None)
+
+    rng = random.Random(seed)
+    today = datetime.now().date()
+    password_hash = generate_password_hash(PASSWORD)   # 哈希很慢，所有用户共用一个
+    conn = database.connect()
+    started = time.perf_counter()
+    try:
+        conn.execute("BEGIN")
+        cursor = conn.cursor()
+        user_ids = []
+        for u in range(scale['users']):
+            cursor.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (f"user{u}", password_hash))
+            user_ids.append(cursor.lastrowid)
+
+        post_ids = []
+        for user_id in user_ids:
+            person_ids = []
+            for p in range(scale['people']):
+                cursor.execute("INSERT INTO people (user_id, name) VALUES (?, ?)", (user_id, f"家人{p}"))
+                person_ids.append(cursor.lastrowid)
+
+            def day(offset):
+                return (today + timedelta(days=offset)).strftime('%Y-%m-%d')
+
+            cursor.executemany(
+                "INSERT INTO records (user_id, content, category, date, time, urgency, status, completion_notes) "
+                "VALUES (?, ?, 'general', ?, ?, ?, ?, ?)",
+                [(user_id, _sentence(rng), day(rng.randint(-30, 30)), f"{rng.randint(6, 22):02d}:{rng.choice((0, 15, 30, 45)):02d}",
+                  rng.choice(_URGENCY), status, _sentence(rng, 12) if status == 'completed' else None)
+                 for status in (rng.choice(('pending', 'pending', 'completed')) for _ in range(scale['general']))]
+            )
+            if person_ids:
+                cursor.executemany(
+                    "INSERT INTO records (user_id, content, category, person_id, frequency, dosage, style, color, "
+                    "total_quantity, start_date, refill_quantity, reminder_threshold) "
+                    "VALUES (?, ?, 'medicine', ?, ?, ?, '片', '白色', ?, ?, ?, 5)",
+                    [(user_id, rng.choice(('维生素', '感冒药', '降压药', '钙片')), rng.choice(person_ids),
+                      str(rng.randint(1, 3)), str(rng.randint(1, 2)), rng.randint(10, 100), day(-rng.randint(0, 20)),
+                      rng.choice((30, 60, 100)))
+                     for _ in range(scale['medicine'])]
+                )
+                cursor.executemany(
+                    "INSERT INTO records (user_id, content, category, person_id, type, color, quantity) "
+                    "VALUES (?, ?, 'clothes', ?, ?, ?, ?)",
+                    [(user_id, rng.choice(('外套', '毛衣', '衬衫', '运动鞋')), rng.choice(person_ids),
+                      rng.choice(('上衣', '裤子', '鞋')), rng.choice(('红色', '蓝色', '黑色')), str(rng.randint(1, 3)))
+                     for _ in range(scale['clothes'])]
+                )
+            cursor.executemany(
+                "INSERT INTO records (user_id, content, category, date, quantity, unit, brand, status) "
+                "VALUES (?, ?, 'shopping', ?, ?, '个', NULL, ?)",
+                [(user_id, rng.choice(_WORDS), day(rng.randint(-10, 10)), str(rng.randint(1, 5)),
+                  rng.choice(('pending', 'completed')))
+                 for _ in range(scale['shopping'])]
+            )
+            for _ in range(scale['posts']):
+                timestamp = datetime.now() - timedelta(minutes=rng.randint(1, 60 * 24 * 90))
+                cursor.execute(
+                    "INSERT INTO posts (user_id, content, timestamp) VALUES (?, ?, ?)",
+                    (user_id, _sentence(rng, 10), timestamp.strftime('%Y-%m-%d %H:%M:%S'))
+                )
+                post_ids.append((cursor.lastrowid, timestamp))
+
+        for post_id, timestamp in post_ids:
+            cursor.executemany(
+                "INSERT INTO comments (post_id, user_id, content, timestamp) VALUES (?, ?, ?, ?)",
+                [(post_id, rng.choice(user_ids), _sentence(rng, 4),
+                  (timestamp + timedelta(minutes=rng.randint(1, 600))).strftime('%Y-%m-%d %H:%M:%S'))
+                 for _ in range(scale['comments'])]
+            )
+            cursor.executemany(
+                "INSERT INTO likes (post_id, user_id) VALUES (?, ?)",
+                [(post_id, user_id) for user_id in rng.sample(user_ids, min(scale['likes'], len(user_ids)))]
+            )
+        conn.commit()
+        conn.execute("ANALYZE")
+    finally:
+        conn.close()
+    return {
+        "path": os.path.abspath(database.DATABASE),
+        "seed_ms": round((time.perf_counter() - started) * 1000, 1),
+        "size_bytes": os.path.getsize(database.DATABASE),
+    }
+
+
+# --- 客户端 ---
+
+class TestClient:
+    """通过 Flask 测试客户端请求，并统计每个请求在服务端执行的 SQL 语句数"""
+
+    def __init__(self):
+        sys.path.insert(0, APP_DIR)
+        import database
+        from app import create_app
+        self._database = database
+        self._client = create_app().test_client()
+        self._statements = 0
+
+    def _trace(self, statement):
+        # 触发器中的语句以注释开头，只统计应用发出的语句
+        if not statement.startswith('--'):
+            self._statements += 1
+
+    def request(self, method, path, json=None, data=None):
+        """返回 (状态码, 响应体, SQL 语句数)"""
+        # 测试客户端在当前线程中处理请求，使用的是当前线程的池化连接
+        conn = self._database.get_connection()
+        self._statements = 0
+        conn.set_trace_callback(self._trace)
+        try:
+            response = self._client.open(path, method=method, json=json, data=data)
+            body = response.get_data()
+        finally:
+            conn.set_trace_callback(None)
+        return response.status_code, body, self._statements
+
+
+class HttpClient:
+    """通过 HTTP 请求已经启动的服务 (例如本地 gunicorn)，保持连接复用和登录 cookie"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self._host, self._port = parts.hostname, parts.port or 80
+        self._prefix = parts.path.rstrip('/')
+        self._conn = None
+        self._cookies = SimpleCookie()
+
+    def request(self, method, path, json=None, data=None):
+        from werkzeug.test import EnvironBuilder
+        # 复用测试客户端的编码方式生成 JSON 或 multipart 请求体
+        environ = EnvironBuilder(path=path, method=method, json=json, data=data).get_environ()
+        body = environ['wsgi.input'].read()
+        headers = {'Content-Length': str(len(body))}
+        if environ.get('CONTENT_TYPE'):
+            headers['Content-Type'] = environ['CONTENT_TYPE']
+        if self._cookies:
+            headers['Cookie'] = '; '.join(f"{k}={v.value}" for k, v in self._cookies.items())
+        target = self._prefix + path
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = http.client.HTTPConnection(self._host, self._port, timeout=60)
+            try:
+                self._conn.request(method, target, body=body, headers=headers)
+                response = self._conn.getresponse()
+                payload = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # 服务端关闭了空闲连接时重连一次
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+        for header in response.headers.get_all('Set-Cookie') or []:
+            self._cookies.load(header)
+        return response.status, payload, None
+
+
+# --- 测试场景 ---
+# 每个场景接收 (session, i)，在计时之外完成准备工作，返回要计时的请求 (method, path, json, data)。
+
+class Session:
+    def __init__(self, client, username, rng):
+        self.client = client
+        self.username = username
+        self.rng = rng
+        self.counter = 0
+        self.ids = {}
+        self.upload_path = None
+
+    def call(self, method, path, body=None, data=None, expect=None):
+        """计时之外的请求，返回解析后的 JSON (不是 JSON 时返回 None)"""
+        status, payload, _ = self.client.request(method, path, json=body, data=data)
+        if expect and status != expect:
+            raise RuntimeError(f"{method} {path} 返回 {status}: {payload[:200]!r}")
+        try:
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    def unique(self, prefix):
+        self.counter += 1
+        return f"{prefix}-{os.getpid()}-{self.counter}"
+
+    def login(self, username=None):
+        # 已登录时 /login 直接重定向，相当于空操作
+        self.call('POST', '/login', body={"username": username or self.username, "password": PASSWORD})
+
+    def logout(self):
+        self.call('GET', '/logout')
+
+    def pick(self, key, i):
+        ids = self.ids.get(key)
+        if not ids:
+            raise RuntimeError(f"没有可用于测试的 {key} 数据，请增大数据规模")
+        return ids[i % len(ids)]
+
+    def discover(self):
+        """通过接口取得当前用户可以操作的数据 id"""
+        self.ids['people'] = [p['id'] for p in self.call('GET', '/api/people')]
+        self.ids['general'] = [r['id'] for r in self.call('GET', '/api/records?category=general')
+                               if not r.get('is_dynamic_reminder')]
+        for category in ('medicine', 'clothes'):
+            self.ids[category] = [item['id'] for group in self.call('GET', f'/api/records?category={category}')
+                                  for item in group['items']]
+        self.ids['completed'] = [r['id'] for r in self.call('GET', '/api/records/completed')]
+        feed = self.call('GET', '/api/posts')
+        self.ids['posts'] = [p['id'] for p in feed['posts']]
+        self.ids['own_posts'] = [p['id'] for p in feed['posts'] if p['is_author']] or [_new_post(self)['id']]
+        self.feed_cursor = feed['next_cursor']
+
+
+def _image(rng):
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new('RGB', (640, 480), tuple(rng.randrange(256) for _ in range(3))).save(buf, 'JPEG')
+    buf.seek(0)
+    return buf
+
+
+def _find(items, content):
+    for item in items:
+        if item.get('content') == content:
+            return item
+    raise RuntimeError(f"没有找到刚创建的数据: {content}")
+
+
+def _login(s, i):
+    s.logout()
+    return 'POST', '/login', {"username": s.username, "password": PASSWORD}, None
+
+
+def _register(s, i):
+    s.logout()
+    return 'POST', '/register', {"username": s.unique('bench'), "password": PASSWORD}, None
+
+
+def _logout(s, i):
+    s.login()
+    return 'GET', '/logout', None, None
+
+
+def _delete_account(s, i):
+    # 注销一个临时账户，不影响其他场景使用的数据
+    username = s.unique('bench')
+    s.logout()
+    s.call('POST', '/register', body={"username": username, "password": PASSWORD}, expect=201)
+    s.login(username)
+    return 'DELETE', '/api/user/delete', None, None
+
+
+def _upload_avatar(s, i):
+    return 'POST', '/api/user/avatar', None, {"avatar": (_image(s.rng), 'avatar.jpg')}
+
+
+def _get_upload(s, i):
+    if s.upload_path is None:
+        s.call('POST', '/api/user/avatar', data={"avatar": (_image(s.rng), 'avatar.jpg')}, expect=200)
+        s.upload_path = s.call('GET', '/api/user/current')['avatar']
+    return 'GET', '/' + s.upload_path.lstrip('/'), None, None
+
+
+def _add_person(s, i):
+    return 'POST', '/api/people', {"name": s.unique('人物')}, None
+
+
+def _delete_person(s, i):
+    name = s.unique('人物')
+    s.call('POST', '/api/people', body={"name": name}, expect=201)
+    person = next(p for p in s.call('GET', '/api/people') if p['name'] == name)
+    return 'DELETE', f"/api/people/{person['id']}", None, None
+
+
+def _general_record(s):
+    return {
+        "category": "general", "content": _sentence(s.rng), "urgency": s.rng.choice(_URGENCY),
+        "date": (datetime.now() + timedelta(days=s.rng.randint(0, 30))).strftime('%Y-%m-%d'),
+        "time": f"{s.rng.randint(6, 22):02d}:00",
+    }
+
+
+def _update_record(s, i):
+    return 'PUT', f"/api/records/{s.pick('general', i)}", _general_record(s), None
+
+
+def _delete_record(s, i):
+    content = s.unique('待删除')
+    s.call('POST', '/api/records', body={"category": "shopping", "content": content}, expect=201)
+    record = _find(s.call('GET', '/api/records?category=shopping'), content)
+    return 'DELETE', f"/api/records/{record['id']}", None, None
+
+
+def _update_status(s, i):
+    # 同一条记录交替完成和撤销，每次都是真实的状态变化
+    status = 'completed' if i % 2 == 0 else 'pending'
+    return 'PUT', f"/api/records/{s.pick('general', i // 2)}/status", {"status": status}, None
+
+
+def _batch_status(s, i):
+    # 一个批次中交替完成和撤销 10 条不同的记录
+    ids = s.ids['general'][:10]
+    status = 'completed' if i % 2 == 0 else 'pending'
+    return 'POST', '/api/records/batch', {"operations": [{"op": "status", "id": record_id, "status": status} for record_id in ids]}, None
+
+
+def _toggle_purchase(s, i):
+    return 'PUT', f"/api/records/{s.pick('medicine', i // 2)}/purchase", {"needs_purchase": i % 2 == 0}, None
+
+
+def _completed_details(s, i):
+    return 'POST', f"/api/completed_records/{s.pick('completed', i)}/details", None, {"notes": _sentence(s.rng, 12)}
+
+
+def _create_post(s, i):
+    return 'POST', '/api/posts', None, {"content": _sentence(s.rng, 10)}
+
+
+def _new_post(s):
+    content = s.unique('帖子')
+    s.call('POST', '/api/posts', data={"content": content}, expect=201)
+    return _find(s.call('GET', '/api/posts?limit=5')['posts'], content)
+
+
+def _delete_post(s, i):
+    return 'DELETE', f"/api/posts/{_new_post(s)['id']}", None, None
+
+
+def _delete_comment(s, i):
+    post = _new_post(s)
+    content = s.unique('评论')
+    s.call('POST', f"/api/posts/{post['id']}/comments", body={"content": content}, expect=201)
+    post = _find(s.call('GET', '/api/posts?limit=5')['posts'], post['content'])
+    return 'DELETE', f"/api/comments/{_find(post['comments'], content)['id']}", None, None
+
+
+_PAGES = ('medicine', 'clothes', 'shopping', 'people', 'profile', 'communicate')
+
+# (名称, 场景)，按顺序执行；会清空数据的场景放在最后
+SCENARIOS = [
+    ('GET /', lambda s, i: ('GET', '/', None, None)),
+    ('GET /<page_name>', lambda s, i: ('GET', f"/{_PAGES[i % len(_PAGES)]}", None, None)),
+    ('POST /login', _login),
+    ('POST /register', _register),
+    ('GET /logout', _logout),
+    ('GET /api/user/current', lambda s, i: ('GET', '/api/user/current', None, None)),
+    ('POST /api/user/avatar', _upload_avatar),
+    ('GET /uploads/<filename>', _get_upload),
+    ('GET /api/records/completed', lambda s, i: ('GET', '/api/records/completed', None, None)),
+    ('POST /api/completed_records/<id>/details', _completed_details),
+    ('GET /api/people', lambda s, i: ('GET', '/api/people', None, None)),
+    ('POST /api/people', _add_person),
+    ('GET /api/people/<id>/details', lambda s, i: ('GET', f"/api/people/{s.pick('people', i)}/details", None, None)),
+    ('DELETE /api/people/<id>', _delete_person),
+    ('GET /api/records?category=general', lambda s, i: ('GET', '/api/records?category=general', None, None)),
+    ('GET /api/records?category=general&sort_by=time', lambda s, i: ('GET', '/api/records?category=general&sort_by=time', None, None)),
+    ('GET /api/records?category=medicine', lambda s, i: ('GET', '/api/records?category=medicine', None, None)),
+    ('GET /api/records?category=clothes', lambda s, i: ('GET', '/api/records?category=clothes', None, None)),
+    ('GET /api/records?category=shopping', lambda s, i: ('GET', '/api/records?category=shopping', None, None)),
+    ('POST /api/records', lambda s, i: ('POST', '/api/records', _general_record(s), None)),
+    ('PUT /api/records/<id>', _update_record),
+    ('DELETE /api/records/<id>', _delete_record),
+    ('PUT /api/records/<id>/status', _update_status),
+    ('POST /api/records/batch', _batch_status),
+    ('POST /api/records/<id>/refill', lambda s, i: ('POST', f"/api/records/{s.pick('medicine', i)}/refill", None, None)),
+    ('PUT /api/records/<id>/purchase', _toggle_purchase),
+    ('PUT /api/records/<id>/quantity', lambda s, i: ('PUT', f"/api/records/{s.pick('medicine', i)}/quantity", {"total_quantity": s.rng.randint(10, 100)}, None)),
+    ('GET /api/posts', lambda s, i: ('GET', '/api/posts', None, None)),
+    ('GET /api/posts?before=<cursor>', lambda s, i: ('GET', f"/api/posts?before={quote(s.feed_cursor or '')}", None, None)),
+    ('POST /api/posts', _create_post),
+    ('PUT /api/posts/<id>', lambda s, i: ('PUT', f"/api/posts/{s.pick('own_posts', i)}", None, {"content": _sentence(s.rng, 10), "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S')})),
+    ('DELETE /api/posts/<id>', _delete_post),
+    ('POST /api/posts/<id>/like', lambda s, i: ('POST', f"/api/posts/{s.pick('posts', i // 2)}/like", None, None)),
+    ('POST /api/posts/<id>/comments', lambda s, i: ('POST', f"/api/posts/{s.pick('posts', i)}/comments", {"content": _sentence(s.rng, 4)}, None)),
+    ('DELETE /api/comments/<id>', _delete_comment),
+    ('GET /api/search', lambda s, i: ('GET', f"/api/search?q={s.rng.choice(('打扫卫生', '维生素', '运动鞋'))}", None, None)),
+    ('GET /api/search (short term)', lambda s, i: ('GET', f"/api/search?q={s.rng.choice(('牛奶', '外套', '天气'))}", None, None)),
+    ('GET /api/export', lambda s, i: ('GET', '/api/export', None, None)),
+    ('GET /api/export?format=csv&type=records', lambda s, i: ('GET', '/api/export?format=csv&type=records', None, None)),
+    ('POST /api/shopping/clear', lambda s, i: ('POST', '/api/shopping/clear', None, None)),
+    ('DELETE /api/user/delete', _delete_account),
+]
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(session, name, scenario, iterations, warmup):
+    timings, queries, errors = [], [], 0
+    for i in range(warmup + iterations):
+        method, path, json_body, data = scenario(session, i)
+        started = time.perf_counter()
+        status, _, statements = session.client.request(method, path, json=json_body, data=data)
+        elapsed = time.perf_counter() - started
+        if i < warmup:
+            continue
+        timings.append(elapsed)
+        if statements is not None:
+            queries.append(statements)
+        if status >= 400:
+            errors += 1
+    session.login()
+
+    total = sum(timings)
+    timings.sort()
+    ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        "count": len(timings),
+        "errors": errors,
+        "mean_ms": ms(total / len(timings)),
+        "p50_ms": ms(_percentile(timings, 50)),
+        "p95_ms": ms(_percentile(timings, 95)),
+        "p99_ms": ms(_percentile(timings, 99)),
+        "throughput_rps": round(len(timings) / total, 1) if total else None,
+        "queries": round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    scale = _scale(args)
+    meta = {
+        "created_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "git_commit": _git_commit(),
+        "scale": args.scale, "params": scale, "seed": args.seed,
+        "iterations": args.iterations, "warmup": args.warmup,
+        "mode": 'http' if args.url else 'test_client',
+        "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+    }
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        directory = args.dir or tempfile.mkdtemp(prefix='benchmark-')
+        meta['database'] = seed_database(directory, scale, args.seed)
+        print(f"Seeded {meta['database']['path']} in {meta['database']['seed_ms']} ms")
+        # 应用引用的模板目录相对于 app.py，上传文件相对于当前工作目录 (已在生成数据时切换)
+        client = TestClient()
+
+    session = Session(client, 'user0', random.Random(args.seed))
+    session.login()
+    session.discover()
+    selected = [(name, scenario) for name, scenario in SCENARIOS
+                if not args.only or any(part in name for part in args.only)]
+    results = {}
+    for name, scenario in selected:
+        results[name] = run_scenario(session, name, scenario, args.iterations, args.warmup)
+        r = results[name]
+        print(f"{name:<52} p50 {r['p50_ms']:>8.2f} ms  p95 {r['p95_ms']:>8.2f} ms  p99 {r['p99_ms']:>8.2f} ms  "
+              f"{r['throughput_rps']:>8.1f} req/s  queries {r['queries'] if r['queries'] is not None else '-':>6}"
+              + (f"  errors {r['errors']}" if r['errors'] else ''))
+    report = {"meta": meta, "endpoints": results}
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.out}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            return compare(json.load(f), report, args.threshold)
+    return 0
+
+
+# --- 与基线比较 ---
+
+def compare(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """打印每个接口与基线的差异，有接口变慢或 SQL 语句数增加时返回 1"""
+    if baseline['meta'].get('params') != current['meta'].get('params'):
+        print("警告: 两次运行的数据规模不同，结果不可直接比较")
+    regressions = []
+    print(f"{'endpoint':<52} {'p50 base':>9} {'p50 now':>9} {'p95 base':>9} {'p95 now':>9} {'change':>8} {'queries':>11}")
+    for name, now in current['endpoints'].items():
+        base = baseline['endpoints'].get(name)
+        if base is None:
+            print(f"{name:<52} {'-':>9} {now['p50_ms']:>9.2f} {'-':>9} {now['p95_ms']:>9.2f} {'new':>8}")
+            continue
+        change = (now['p95_ms'] - base['p95_ms']) / base['p95_ms'] if base['p95_ms'] else 0
+        query_note = ''
+        if base['queries'] is not None and now['queries'] is not None:
+            query_note = f"{base['queries']:g} -> {now['queries']:g}"
+            if now['queries'] > base['queries']:
+                regressions.append(f"{name}: SQL 语句数 {query_note}")
+        if change > threshold:
+            regressions.append(f"{name}: p95 {base['p95_ms']:.2f} -> {now['p95_ms']:.2f} ms ({change:+.0%})")
+        print(f"{name:<52} {base['p50_ms']:>9.2f} {now['p50_ms']:>9.2f} {base['p95_ms']:>9.2f} {now['p95_ms']:>9.2f} "
+              f"{change:>+8.0%} {query_note:>11}")
+    if regressions:
+        print(f"\n{len(regressions)} regression(s):")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    return 0
+
+
+def _scale(args):
+    scale = dict(SCALES[args.scale])
+    for item in args.set or []:
+        key, sep, value = item.partition('=')
+        if not sep or key not in scale:
+            raise SystemExit(f"无效的规模参数: {item} (可用: {', '.join(scale)})")
+        scale[key] = int(value)
+    return scale
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='API 性能基准测试')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_scale_args(p):
+        p.add_argument('--scale', choices=SCALES, default='small')
+        p.add_argument('--set', action='append', metavar='KEY=VALUE', help='覆盖数据规模中的一项，例如 --set users=50')
+        p.add_argument('--seed', type=int, default=42)
+
+    seed_parser = commands.add_parser('seed', help='只生成数据库')
+    add_scale_args(seed_parser)
+    seed_parser.add_argument('--dir', required=True, help='生成 database.db 的目录 (必须还没有数据库)')
+
+    run_parser = commands.add_parser('run', help='生成数据并运行基准测试')
+    add_scale_args(run_parser)
+    run_parser.add_argument('--dir', help='生成数据库的目录，默认使用临时目录')
+    run_parser.add_argument('--url', help='请求已启动的服务 (例如 http://127.0.0.1:8000)，不再生成数据库')
+    run_parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+    run_parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP)
+    run_parser.add_argument('--only', action='append', help='只运行名称包含该字符串的接口，可以重复')
+    run_parser.add_argument('--out', help='结果 JSON 的保存路径')
+    run_parser.add_argument('--baseline', help='与该基线 JSON 比较')
+    run_parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+
+    compare_parser = commands.add_parser('compare', help='比较两次结果')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+
+    args = parser.parse_args(argv)
+    if args.command == 'seed':
+        print(seed_database(os.path.abspath(args.dir), _scale(args), args.seed))
+        return 0
+    if args.command == 'run':
+        return run(args)
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)
+    return compare(baseline, current, args.threshold)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
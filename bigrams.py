@@ -0,0 +1,38 @@
+import re
+
+# --- 二元分词 (短词检索) ---
+# trigram 索引无法匹配少于 3 个字符的查询词 (如 "牛奶")。这类查询使用另一组 FTS5 索引 (见 migrations.py)，
+# 写入索引的是预先切分好的文本: 每段连续的字母数字拆成相邻两个字符一组，最后一个字符单独一组，
+# 例如 "喝牛奶" -> "喝牛 牛奶 奶"，再由 unicode61 按空格分词。这样每个位置的字符都是某个词的开头:
+#   1 个字符的查询词  -> 前缀查询 "牛" *
+#   2 个及以上字符    -> 由其二元组组成的短语 "牛奶 奶糖"，二元组在索引中相邻即原文中连续出现
+# 切分函数注册为 SQL 函数 bigrams() (见 database.connect)，由触发器在写入时调用。
+
+# 与 unicode61 的分词字符一致: 字母和数字 (不含下划线)
+_WORD = re.compile(r'[^\W_]+')
+
+
+def _words(text):
+    return _WORD.findall((text or '').lower())
+
+
+def bigram_text(text):
+    """把文本切分为写入索引的二元组，词之间以空格分隔"""
+    if text is None:
+        return None
+    tokens = []
+    for word in _words(text):
+        tokens.extend(word[i:i + 2] for i in range(len(word)))
+    return ' '.join(tokens)
+
+
+def match_expression(terms):
+    """把查询词转换为二元组索引的 MATCH 表达式，多个词之间为 AND；没有可检索的字符时返回 None"""
+    phrases = []
+    for term in terms:
+        for word in _words(term):
+            if len(word) == 1:
+                phrases.append(f'"{word}" *')
+            else:
+                phrases.append('"' + ' '.join(word[i:i + 2] for i in range(len(word) - 1)) + '"')
+    return ' '.join(phrases) or None
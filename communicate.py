@@ -1,66 +1,117 @@
 from flask import Blueprint, request, jsonify
 from flask_login import login_required, current_user
 import sqlite3
-from datetime import datetime
 import json
-import os
-from werkzeug.utils import secure_filename
-import uuid
+from database import get_db
+from images import variant_urls, InvalidImageError
+import upload_store
+import dates
+from versions import conditional_get, FEED_SCOPE
 
 # 创建一个蓝图
 communicate_bp = Blueprint('communicate_bp', __name__)
 
-def _get_db_conn():
-    """获取数据库连接的辅助函数"""
-    conn = sqlite3.connect('database.db', timeout=15)
-    conn.row_factory = sqlite3.Row
-    return conn
-
 # --- 帖子 API ---
 
-@communicate_bp.route('/api/posts', methods=['GET'])
-@login_required
-def get_posts():
-    """获取所有帖子，包含作者、评论和点赞信息"""
-    conn = _get_db_conn()
-    cursor = conn.cursor()
-    
-    # **关键修改**: 确保查询按 timestamp 降序排列
-    cursor.execute("""
-        SELECT p.id, p.content, p.timestamp, p.photos, u.username as author_username, u.avatar as author_avatar, p.user_id
+FEED_PAGE_SIZE = 20
+FEED_MAX_PAGE_SIZE = 100
+
+def _parse_feed_cursor(before):
+    """解析 before=<timestamp,id> 形式的游标，无效时返回 None"""
+    if not before:
+        return None
+    timestamp, sep, post_id = before.rpartition(',')
+    if not sep or not timestamp:
+        return None
+    try:
+        return timestamp, int(post_id)
+    except ValueError:
+        return None
+
+def _build_feed_page(cursor, user_id, before=None, limit=FEED_PAGE_SIZE):
+    """
+    构建一页动态。
+    无论页面大小如何，固定只执行三条查询：帖子 (含点赞数、评论数和当前用户是否已点赞)、照片、评论。
+    返回 (posts, next_cursor)。
+    """
+    # 多取一条用于判断是否还有下一页
+    # 已注销、等待后台删除的用户的帖子和评论不再显示 (点赞数和评论数在注销时已扣除，见 migrations.py 第 15 步)
+    params = [user_id]
+    where_clause = "WHERE u.deleted_at IS NULL"
+    if before:
+        where_clause += " AND (p.timestamp, p.id) < (?, ?)"
+        params.extend(before)
+    params.append(limit + 1)
+    cursor.execute(f"""
+        SELECT p.id, p.content, p.timestamp, u.username as author_username, u.avatar as author_avatar, p.user_id,
+               p.like_count, p.comment_count,
+               EXISTS (SELECT 1 FROM likes l WHERE l.post_id = p.id AND l.user_id = ?) AS liked_by_me
         FROM posts p
         JOIN users u ON p.user_id = u.id
-        ORDER BY p.timestamp DESC
-    """)
+        {where_clause}
+        ORDER BY p.timestamp DESC, p.id DESC
+        LIMIT ?
+    """, params)
     posts = [dict(row) for row in cursor.fetchall()]
 
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        last = posts[-1]
+        next_cursor = f"{last['timestamp']},{last['id']}"
+
+    if not posts:
+        return posts, next_cursor
+
+    photos_by_post = upload_store.load_photos(cursor, 'post', [post['id'] for post in posts])
+    posts_by_id = {}
     for post in posts:
-        # 获取每个帖子的评论
-        cursor.execute("""
-            SELECT c.id, c.content, c.timestamp, u.username as author_username
-            FROM comments c
-            JOIN users u ON c.user_id = u.id
-            WHERE c.post_id = ?
-            ORDER BY c.timestamp ASC
-        """, (post['id'],))
-        post['comments'] = [dict(row) for row in cursor.fetchall()]
-
-        # 获取每个帖子的点赞用户ID列表
-        cursor.execute("SELECT user_id FROM likes WHERE post_id = ?", (post['id'],))
-        post['likes'] = [row['user_id'] for row in cursor.fetchall()]
-        
+        post['comments'] = []
+        post['liked_by_me'] = bool(post['liked_by_me'])
         # 检查当前用户是否是作者
-        post['is_author'] = (post['user_id'] == current_user.id)
-        
-        # 解析照片
-        try:
-            post['photos'] = json.loads(post['photos']) if post['photos'] else []
-        except (json.JSONDecodeError, TypeError):
-            post['photos'] = []
+        post['is_author'] = (post['user_id'] == user_id)
+        # 照片，并附上缩略图/原图和头像各尺寸的地址
+        post['photos'] = photos_by_post[post['id']]
+        post['photo_variants'] = [variant_urls(p, 'photo') for p in post['photos']]
+        post['author_avatar_variants'] = variant_urls(post['author_avatar'], 'avatar')
+        posts_by_id[post['id']] = post
+
+    placeholders = ','.join('?' for _ in posts_by_id)
+    post_ids = list(posts_by_id)
 
+    # 一次性获取本页所有帖子的评论
+    cursor.execute(f"""
+        SELECT c.id, c.post_id, c.content, c.timestamp, u.username as author_username
+        FROM comments c
+        JOIN users u ON c.user_id = u.id
+        WHERE c.post_id IN ({placeholders}) AND u.deleted_at IS NULL
+        ORDER BY c.timestamp ASC, c.id ASC
+    """, post_ids)
+    for row in cursor.fetchall():
+        comment = dict(row)
+        posts_by_id[comment.pop('post_id')]['comments'].append(comment)
 
-    conn.close()
-    return jsonify(posts)
+    return posts, next_cursor
+
+@communicate_bp.route('/api/posts', methods=['GET'])
+@login_required
+@conditional_get(lambda: FEED_SCOPE)
+def get_posts():
+    """
+    分页获取帖子，包含作者、评论和点赞信息。
+    查询参数: before=<timestamp,id> (上一页返回的 next_cursor), limit=<每页数量>
+    """
+    before_arg = request.args.get('before')
+    before = _parse_feed_cursor(before_arg)
+    if before_arg and before is None:
+        return jsonify({"error": "无效的游标"}), 400
+
+    limit = request.args.get('limit', FEED_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, FEED_MAX_PAGE_SIZE))
+
+    conn = get_db()
+    posts, next_cursor = _build_feed_page(conn.cursor(), current_user.id, before, limit)
+    return jsonify({"posts": posts, "next_cursor": next_cursor})
 
 @communicate_bp.route('/api/posts', methods=['POST'])
 @login_required
@@ -70,7 +121,7 @@ def create_post():
     可以接收直接上传的文件 (photos) 或已存在的文件路径 (existing_photos)。
     """
     content = request.form.get('content')
-    timestamp_str = request.form.get('timestamp', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    timestamp_str = request.form.get('timestamp') or dates.now_timestamp()
     
     # 从表单中获取新上传的文件和已存在的路径
     new_photos = request.files.getlist('photos')
@@ -78,42 +129,47 @@ def create_post():
 
     if not content:
         return jsonify({"error": "内容不能为空"}), 400
+    try:
+        # 统一为本地时间 YYYY-MM-DD HH:MM:SS，动态按时间排序和翻页都依赖这个格式
+        timestamp_str = dates.normalize_timestamp(timestamp_str)
+    except ValueError:
+        return jsonify({"error": "无效的日期格式"}), 400
 
-    # 处理已存在的照片路径
+    # 处理已存在的照片路径 (例如从完成记录分享到社区时引用的照片)
     try:
-        photo_paths = json.loads(existing_photos_json)
-        if not isinstance(photo_paths, list):
-            photo_paths = []
+        existing_photos = json.loads(existing_photos_json)
+        if not isinstance(existing_photos, list):
+            existing_photos = []
     except json.JSONDecodeError:
-        photo_paths = []
-
-    # 处理新上传的照片
-    if new_photos:
-        upload_folder = 'uploads'
-        if not os.path.exists(upload_folder):
-            os.makedirs(upload_folder)
-        for photo in new_photos:
-            if photo and photo.filename != '':
-                base_filename = secure_filename(photo.filename)
-                unique_filename = str(uuid.uuid4()) + os.path.splitext(base_filename)[1]
-                filepath = os.path.join(upload_folder, unique_filename)
-                photo.save(filepath)
-                url_path = filepath.replace('\\', '/')
-                photo_paths.append(url_path)
-
-    conn = _get_db_conn()
+        existing_photos = []
+    existing_photos = [p for p in existing_photos if isinstance(p, str)]
+
+    # 处理新上传的照片：重新编码并生成缩略图
+    uploads = []
+    for photo in new_photos:
+        if photo and photo.filename != '':
+            try:
+                uploads.append(upload_store.prepare_upload(photo, 'photo'))
+            except InvalidImageError as e:
+                return jsonify({"error": str(e)}), 400
+
+    conn = get_db()
     cursor = conn.cursor()
     try:
+        # 已存在的照片直接引用同一个文件，只接受已登记的上传文件
+        photo_paths = upload_store.known_paths(cursor, existing_photos)
+        photo_paths += [upload_store.store_upload(cursor, upload) for upload in uploads]
         cursor.execute(
-            "INSERT INTO posts (user_id, content, timestamp, photos) VALUES (?, ?, ?, ?)",
-            (current_user.id, content, timestamp_str, json.dumps(photo_paths))
+            "INSERT INTO posts (user_id, content, timestamp) VALUES (?, ?, ?)",
+            (current_user.id, content, timestamp_str)
         )
+        post_id = cursor.lastrowid
+        for path in photo_paths:
+            upload_store.add_photo(cursor, path, current_user.id, 'post', post_id)
         conn.commit()
     except sqlite3.Error as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
     return jsonify({"status": "success"}), 201
 
 @communicate_bp.route('/api/posts/<int:post_id>', methods=['PUT'])
@@ -125,8 +181,12 @@ def update_post(post_id):
 
     if not content or not timestamp_str:
         return jsonify({"error": "内容和日期不能为空"}), 400
+    try:
+        timestamp_str = dates.normalize_timestamp(timestamp_str)
+    except ValueError:
+        return jsonify({"error": "无效的日期格式"}), 400
 
-    conn = _get_db_conn()
+    conn = get_db()
     cursor = conn.cursor()
     try:
         # 验证权限
@@ -143,15 +203,13 @@ def update_post(post_id):
     except sqlite3.Error as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
     return jsonify({"status": "success"})
 
 @communicate_bp.route('/api/posts/<int:post_id>', methods=['DELETE'])
 @login_required
 def delete_post(post_id):
     """删除一个帖子"""
-    conn = _get_db_conn()
+    conn = get_db()
     cursor = conn.cursor()
     try:
         # 验证当前用户是否是帖子的作者
@@ -168,8 +226,6 @@ def delete_post(post_id):
     except sqlite3.Error as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
     return jsonify({"status": "success"})
 
 # --- 点赞 API ---
@@ -178,27 +234,28 @@ def delete_post(post_id):
 @login_required
 def toggle_like(post_id):
     """点赞或取消点赞一个帖子"""
-    conn = _get_db_conn()
+    conn = get_db()
     cursor = conn.cursor()
     try:
-        # 检查是否已点赞
-        cursor.execute("SELECT id FROM likes WHERE user_id = ? AND post_id = ?", (current_user.id, post_id))
-        like = cursor.fetchone()
-
-        if like:
-            # 如果已点赞，则取消点赞
-            cursor.execute("DELETE FROM likes WHERE id = ?", (like['id'],))
-        else:
-            # 如果未点赞，则添加点赞
-            cursor.execute("INSERT INTO likes (user_id, post_id) VALUES (?, ?)", (current_user.id, post_id))
-        
+        # 已点赞则取消；DELETE 取得写锁，同一用户的并发请求在这里排队，不会重复插入
+        cursor.execute("DELETE FROM likes WHERE user_id = ? AND post_id = ? RETURNING id", (current_user.id, post_id))
+        liked = cursor.fetchone() is None
+        if liked:
+            # 未点赞则添加；帖子不存在时不插入
+            cursor.execute("""
+                INSERT INTO likes (user_id, post_id) SELECT ?, id FROM posts WHERE id = ?
+                ON CONFLICT(post_id, user_id) DO NOTHING
+            """, (current_user.id, post_id))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                return jsonify({"error": "帖子不存在"}), 404
+        cursor.execute("SELECT like_count FROM posts WHERE id = ?", (post_id,))
+        post = cursor.fetchone()
         conn.commit()
     except sqlite3.Error as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
-    return jsonify({"status": "success"})
+    return jsonify({"status": "success", "liked": liked, "like_count": post['like_count'] if post else 0})
 
 # --- 评论 API ---
 
@@ -211,26 +268,24 @@ def add_comment(post_id):
     if not content:
         return jsonify({"error": "评论内容不能为空"}), 400
 
-    conn = _get_db_conn()
+    conn = get_db()
     cursor = conn.cursor()
     try:
         cursor.execute(
             "INSERT INTO comments (post_id, user_id, content, timestamp) VALUES (?, ?, ?, ?)",
-            (post_id, current_user.id, content, datetime.now())
+            (post_id, current_user.id, content, dates.now_timestamp())
         )
         conn.commit()
     except sqlite3.Error as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
     return jsonify({"status": "success"}), 201
 
 @communicate_bp.route('/api/comments/<int:comment_id>', methods=['DELETE'])
 @login_required
 def delete_comment(comment_id):
     """删除一条评论"""
-    conn = _get_db_conn()
+    conn = get_db()
     cursor = conn.cursor()
     try:
         # 验证当前用户是否是评论的作者
@@ -244,6 +299,4 @@ def delete_comment(comment_id):
     except sqlite3.Error as e:
         conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
     return jsonify({"status": "success"})
\ No newline at end of file
@@ -0,0 +1,72 @@
+import os
+import sqlite3
+import threading
+from flask import g
+import metrics
+import bigrams
+
+# 数据库文件路径
+DATABASE = 'database.db'
+
+# 等待写锁的最长时间（秒）
+BUSY_TIMEOUT = 15
+
+# 每个连接建立时执行的 PRAGMA
+# - WAL: 读写互不阻塞，写入只追加到 -wal 文件
+# - synchronous=NORMAL: WAL 模式下安全且大幅减少 fsync
+# - cache_size 为负数时单位是 KiB，这里约 16MB
+# - mmap_size: 用内存映射读取数据库文件，减少 read() 系统调用
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+)
+
+_local = threading.local()
+
+
+def connect(path=None):
+    """创建一个新的、已调优的数据库连接（调用方负责关闭）；请求中执行的语句计入 /metrics (见 metrics.py)"""
+    conn = sqlite3.connect(path or DATABASE, timeout=BUSY_TIMEOUT, factory=metrics.Connection)
+    conn.row_factory = sqlite3.Row
+    # 短词检索索引的触发器调用 bigrams() (见 bigrams.py)，所有连接都需要注册
+    conn.create_function('bigrams', 1, bigrams.bigram_text, deterministic=True)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_connection():
+    """
+    获取当前线程的池化连接。
+    每个线程只建立一次连接并在后续请求中复用；
+    fork 之后（如 gunicorn --preload）子进程会重新建立自己的连接。
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+    conn = connect()
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+def get_db():
+    """获取请求范围内的数据库连接，同一请求中多次调用返回同一个连接"""
+    if 'db' not in g:
+        g.db = get_connection()
+    return g.db
+
+
+def release_db(exception=None):
+    """请求结束时归还连接：回滚未提交的事务，但不关闭连接"""
+    conn = g.pop('db', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+def init_app(app):
+    """在 Flask 应用上注册连接的请求生命周期钩子"""
+    app.teardown_appcontext(release_db)
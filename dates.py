@@ -0,0 +1,59 @@
+from datetime import datetime, date, time
+
+# --- 日期时间的统一格式 ---
+# 数据库中的日期时间都保存为定长的本地时间字符串，字典序即时间顺序，可以直接用于索引排序和比较:
+#   时间戳 (帖子、评论)  YYYY-MM-DD HH:MM:SS
+#   日期 (记录)          YYYY-MM-DD
+#   时间 (记录)          HH:MM
+# 客户端可能传入 ISO 8601 (含 T、毫秒、Z 或时区偏移)，写入前统一转换；无法识别时抛出 ValueError。
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATE_FORMAT = '%Y-%m-%d'
+TIME_FORMAT = '%H:%M'
+
+
+def now_timestamp():
+    return datetime.now().strftime(TIMESTAMP_FORMAT)
+
+
+def normalize_timestamp(value):
+    """把各种 ISO 8601 格式的时间转换为本地时间的 YYYY-MM-DD HH:MM:SS"""
+    parsed = datetime.fromisoformat(value.strip())
+    if parsed.tzinfo is not None:
+        # 带时区的时间 (如 toISOString() 的 UTC 时间) 转换为服务器本地时间
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed.strftime(TIMESTAMP_FORMAT)
+
+
+def normalize_date(value):
+    """转换为 YYYY-MM-DD，空值返回 None"""
+    if value is None or not str(value).strip():
+        return None
+    value = str(value).strip()
+    try:
+        return date.fromisoformat(value).strftime(DATE_FORMAT)
+    except ValueError:
+        # 也接受完整的时间戳，只保留日期部分
+        return normalize_timestamp(value)[:10]
+
+
+def normalize_time(value):
+    """转换为 HH:MM，空值返回 None；也接受没有前导零的 H:MM (如 "9:05")，原先的客户端会这样提交"""
+    if value is None or not str(value).strip():
+        return None
+    value = str(value).strip()
+    try:
+        return time.fromisoformat(value).strftime(TIME_FORMAT)
+    except ValueError:
+        return datetime.strptime(value, TIME_FORMAT).strftime(TIME_FORMAT)
+
+
+_RECORD_FIELDS = {'date': normalize_date, 'start_date': normalize_date, 'time': normalize_time}
+
+
+def normalize_record_fields(data):
+    """就地统一记录中的日期和时间字段 (只处理请求中出现的字段)"""
+    for field, normalize in _RECORD_FIELDS.items():
+        if field in data:
+            data[field] = normalize(data[field])
+    return data
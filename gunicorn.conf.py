@@ -0,0 +1,35 @@
+# gunicorn 配置: gunicorn -c gunicorn.conf.py 'app:create_app()'
+import gc
+import os
+import tempfile
+
+bind = os.environ.get('BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+# 各 worker 的 /metrics 指标写入这个目录，任意 worker 响应 /metrics 时合并输出 (见 metrics.py)
+# 必须在导入应用之前设置
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), f"home_use_metrics_{bind.replace(':', '_')}"))
+
+# 在 master 中导入应用：数据库迁移每次部署只执行一次，
+# 导入的模块和模板由各 worker 通过写时复制共享
+preload_app = True
+
+
+def on_starting(server):
+    # 清除上次运行留下的指标，计数从 0 开始
+    import metrics
+    metrics.reset_dir()
+
+
+def when_ready(server):
+    # 把 preload 阶段创建的对象移出 GC 跟踪，避免 worker 中的垃圾回收触碰这些页面导致复制
+    gc.freeze()
+
+# 上传的图片通过 wsgi.file_wrapper 用 sendfile 零拷贝发送 (gunicorn 默认开启，这里显式声明)
+sendfile = True
+
+
+def post_fork(server, worker):
+    # 每个 worker 启动自己的后台任务调度线程 (线程不会随 fork 复制)
+    import jobs
+    jobs.start()
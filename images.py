@@ -0,0 +1,95 @@
+import io
+import os
+import re
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# --- 上传图片处理 ---
+# 上传的图片统一重新编码为 WebP (不写入 EXIF 等元数据)，并生成固定尺寸的版本 (由 upload_store 保存)。
+# 数据库中只保存主版本的路径 (每种类型的第一个版本)，其余版本按命名约定放在同一目录:
+#   uploads/<name>.webp          主版本
+#   uploads/<name>_<版本>.webp   其他版本
+# 旧的、未经处理的上传文件没有其他版本，所有版本都回退到原文件。
+
+UPLOAD_FOLDER = 'uploads'
+
+# 类型 -> [(版本名, 最大尺寸, 是否居中裁剪为该尺寸)]
+VARIANTS = {
+    'avatar': [('128', (128, 128), True), ('64', (64, 64), True)],
+    'photo': [('full', (1600, 1600), False), ('thumb', (320, 320), False)],
+}
+
+IMAGE_FORMAT = 'WEBP'
+IMAGE_EXTENSION = '.webp'
+IMAGE_QUALITY = 80
+
+_PROCESSED_NAME = re.compile(r'^[0-9a-f]+\.webp$')
+
+
+class InvalidImageError(ValueError):
+    pass
+
+
+def _open_image(data, max_size):
+    try:
+        img = Image.open(io.BytesIO(data))
+        # 对 JPEG 直接在解码时按 1/2、1/4、1/8 缩小，避免完整解码大尺寸相机照片
+        img.draft('RGB', max_size)
+        img.load()
+    except Image.DecompressionBombError as e:
+        # 像素数超过 Image.MAX_IMAGE_PIXELS 的两倍，拒绝解码
+        raise InvalidImageError("图片尺寸过大") from e
+    except (UnidentifiedImageError, OSError) as e:
+        raise InvalidImageError("不支持的图片格式") from e
+    # 按 EXIF 方向旋转后再丢弃元数据
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+    return img
+
+
+def _resize(img, size, crop):
+    if crop:
+        return ImageOps.fit(img, size, Image.LANCZOS)
+    resized = img.copy()
+    resized.thumbnail(size, Image.LANCZOS)
+    return resized
+
+
+def primary_path(name):
+    """根据文件名 (不含扩展名) 返回主版本的路径"""
+    return f"{UPLOAD_FOLDER}/{name}{IMAGE_EXTENSION}"
+
+
+def render_variants(data, kind):
+    """
+    把上传的原始字节处理为各个版本，返回 {版本名: 编码后的字节}。
+    无法识别的文件会抛出 InvalidImageError。
+    """
+    variants = VARIANTS[kind]
+    img = _open_image(data, variants[0][1])
+    rendered = {}
+    for variant, size, crop in variants:
+        buffer = io.BytesIO()
+        _resize(img, size, crop).save(buffer, IMAGE_FORMAT, quality=IMAGE_QUALITY)
+        rendered[variant] = buffer.getvalue()
+    return rendered
+
+
+def variant_paths(path, kind):
+    """返回 path 对应的所有版本的路径 (URL 格式)，主版本也包含在内"""
+    variants = VARIANTS[kind]
+    directory, filename = os.path.split(path)
+    if not _PROCESSED_NAME.match(filename):
+        return {variant: path for variant, _, _ in variants}
+    stem = filename[:-len(IMAGE_EXTENSION)]
+    paths = {variants[0][0]: path}
+    for variant, _, _ in variants[1:]:
+        paths[variant] = f"{directory}/{stem}_{variant}{IMAGE_EXTENSION}"
+    return paths
+
+
+def variant_urls(path, kind):
+    """与 variant_paths 相同，但返回以 / 开头的 URL，path 为空时返回 None"""
+    if not path:
+        return None
+    return {variant: f"/{p}" for variant, p in variant_paths(path, kind).items()}
@@ -0,0 +1,48 @@
+# --- 药品库存计算 ---
+# records 表中药品的 total_quantity 是 start_date 当天的库存 (锚点)，
+# 当前库存在查询时按 "锚点库存 - 已过天数 * 每天次数 * 每次用量" 直接算出，最低为 0。
+# 读取时不再回写数据库；只有补充、手动修改数量、购物项完成/撤销等真实事件才会重设锚点。
+
+# frequency / dosage 是 TEXT 列，只有纯数字时才参与计算 (与原先 int() 失败即跳过的行为一致)
+_STOCK_SQL_TEMPLATE = """(CASE
+    WHEN {r}.total_quantity IS NOT NULL
+         AND {r}.start_date IS NOT NULL AND date({r}.start_date) = {r}.start_date
+         AND {r}.start_date < date('now', 'localtime')
+         AND {r}.frequency <> '' AND {r}.frequency NOT GLOB '*[^0-9]*'
+         AND {r}.dosage <> '' AND {r}.dosage NOT GLOB '*[^0-9]*'
+    THEN MAX(0, {r}.total_quantity
+                - CAST(julianday(date('now', 'localtime')) - julianday({r}.start_date) AS INTEGER)
+                  * CAST({r}.frequency AS INTEGER) * CAST({r}.dosage AS INTEGER))
+    ELSE {r}.total_quantity
+END)"""
+
+
+def current_stock_sql(alias='records'):
+    """返回计算当前库存的 SQL 表达式，alias 为 records 表在查询中的别名"""
+    return _STOCK_SQL_TEMPLATE.format(r=alias)
+
+
+def reset_stock(cursor, record_id, quantity):
+    """把药品的库存锚点重设为今天的 quantity"""
+    cursor.execute(
+        "UPDATE records SET total_quantity = ?, start_date = date('now', 'localtime') WHERE id = ?",
+        (quantity, record_id)
+    )
+
+
+def apply_refill(cursor, record_id, user_id, sign=1, needs_purchase=None):
+    """
+    在当前库存上加上 (sign=1) 或扣除 (sign=-1) 一次补充数量并重设锚点，结果最低为 0；
+    needs_purchase 不为 None 时同时更新该标记。
+    单条 UPDATE 完成读取和写入，并发请求之间不会相互覆盖。
+    药品不存在或不属于该用户时返回 None，否则返回新的库存。
+    """
+    row = cursor.execute(f"""
+        UPDATE records SET
+            total_quantity = MAX(0, COALESCE({current_stock_sql()}, 0) + ? * COALESCE(MAX(refill_quantity, 0), 0)),
+            start_date = date('now', 'localtime'),
+            needs_purchase = COALESCE(?, needs_purchase)
+        WHERE id = ? AND user_id = ? AND category = 'medicine'
+        RETURNING total_quantity
+    """, (sign, needs_purchase, record_id, user_id)).fetchone()
+    return row['total_quantity'] if row else None
@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import database
+
+# --- 本地持久化后台任务队列 ---
+# 任务保存在 jobs 表中，与产生它的数据修改在同一事务中提交，进程重启后不会丢失。
+# 每个进程有一个调度线程，从表中认领任务交给线程池执行；认领是一条 UPDATE ... RETURNING，
+# 多个 gunicorn worker 同时运行时每个任务只会被一个进程认领。
+# 认领时写入租约到期时间，进程在执行中途退出后，任务会在租约到期后被重新认领，
+# 因此任务处理函数必须可以重复执行。
+# 周期任务 (handler 的 every 参数) 由调度线程维护: 每个进程第一次调度时确认已有一个等待中的任务，
+# 每次执行结束 (成功，或重试次数用完) 后加入下一次，处理函数本身不需要再加入。
+
+MAX_WORKERS = 2
+POLL_INTERVAL = 5          # 没有被唤醒时多久检查一次新任务 (秒)
+LEASE_SECONDS = 300        # 认领后多久未完成视为执行者已退出
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 30           # 失败后重试的基础间隔 (秒)，按次数线性增加
+
+_handlers = {}
+_recurring = {}            # 周期任务类型 -> 间隔 (秒)
+_wakeup = threading.Event()
+_state_lock = threading.Lock()
+_state = {"pid": None, "executor": None, "running": 0}
+
+
+def handler(kind, every=None):
+    """注册任务处理函数: 接收 (conn, payload)，conn 是执行线程的池化连接；every 不为空时每隔 every 秒执行一次"""
+    def decorator(func):
+        _handlers[kind] = func
+        if every is not None:
+            _recurring[kind] = every
+        return func
+    return decorator
+
+
+def _now():
+    return time.time()
+
+
+def enqueue(cursor, kind, payload, delay=0):
+    """在调用方的事务中加入一个任务，提交后调用 wake() 让它尽快执行"""
+    cursor.execute(
+        "INSERT INTO jobs (kind, payload, status, attempts, run_after, created_at) VALUES (?, ?, 'pending', 0, ?, ?)",
+        (kind, json.dumps(payload), _now() + delay, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    )
+    return cursor.lastrowid
+
+
+def _ensure_recurring(conn):
+    """
+    每个周期任务确认有一个等待中或执行中的任务，没有时加入 (间隔之后执行)。
+    先只读检查，通常不需要取得写锁；多个进程同时加入时 WHERE NOT EXISTS 保证只有一个。
+    """
+    for kind, interval in _recurring.items():
+        if conn.execute(
+            "SELECT 1 FROM jobs WHERE kind = ? AND status IN ('pending', 'running') LIMIT 1", (kind,)
+        ).fetchone():
+            continue
+        conn.execute("""
+            INSERT INTO jobs (kind, payload, status, attempts, run_after, created_at)
+            SELECT ?, '{}', 'pending', 0, ?, ?
+            WHERE NOT EXISTS (SELECT 1 FROM jobs WHERE kind = ? AND status IN ('pending', 'running'))
+        """, (kind, _now() + interval, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), kind))
+        conn.commit()
+
+
+def _claim(conn):
+    """认领一个到期的任务，没有时返回 None"""
+    now = _now()
+    row = conn.execute("""
+        UPDATE jobs SET status = 'running', attempts = attempts + 1, run_after = ?
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE status IN ('pending', 'running') AND run_after <= ?
+            ORDER BY run_after, id
+            LIMIT 1
+        )
+        RETURNING id, kind, payload, attempts
+    """, (now + LEASE_SECONDS, now)).fetchone()
+    conn.commit()
+    return row
+
+
+def _finish(conn, job, error=None):
+    job_id, attempts = job['id'], job['attempts']
+    # 周期任务在本次结束 (成功或不再重试) 时加入下一次，失败不会让它停止
+    interval = _recurring.get(job['kind'])
+    if interval is not None and (error is None or attempts >= MAX_ATTEMPTS):
+        enqueue(conn.cursor(), job['kind'], {}, delay=interval)
+    if error is None:
+        conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+    elif attempts >= MAX_ATTEMPTS:
+        conn.execute("UPDATE jobs SET status = 'failed', last_error = ? WHERE id = ?", (error, job_id))
+    else:
+        conn.execute(
+            "UPDATE jobs SET status = 'pending', last_error = ?, run_after = ? WHERE id = ?",
+            (error, _now() + RETRY_DELAY * attempts, job_id)
+        )
+    conn.commit()
+
+
+def _run(job):
+    conn = database.get_connection()
+    try:
+        func = _handlers.get(job['kind'])
+        if func is None:
+            raise LookupError(f"未知的任务类型: {job['kind']}")
+        func(conn, json.loads(job['payload']))
+        error = None
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        error = traceback.format_exc()
+        print(f"Job {job['id']} ({job['kind']}) failed: {error}")
+    try:
+        _finish(conn, job, error)
+    finally:
+        with _state_lock:
+            _state['running'] -= 1
+        _wakeup.set()
+
+
+def _dispatch_loop(executor):
+    conn = database.get_connection()
+    try:
+        _ensure_recurring(conn)
+    except Exception as e:
+        if conn.in_transaction:
+            conn.rollback()
+        print(f"Job dispatcher error: {e}")
+    while True:
+        _wakeup.wait(POLL_INTERVAL)
+        _wakeup.clear()
+        try:
+            while True:
+                with _state_lock:
+                    if _state['running'] >= MAX_WORKERS:
+                        break
+                job = _claim(conn)
+                if job is None:
+                    break
+                with _state_lock:
+                    _state['running'] += 1
+                executor.submit(_run, job)
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            print(f"Job dispatcher error: {e}")
+
+
+def start():
+    """启动当前进程的调度线程和线程池；fork 之后 (如 gunicorn --preload) 子进程会重新启动自己的"""
+    with _state_lock:
+        if _state['pid'] == os.getpid():
+            return
+        executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='job')
+        _state.update(pid=os.getpid(), executor=executor, running=0)
+    threading.Thread(target=_dispatch_loop, args=(executor,), name='job-dispatcher', daemon=True).start()
+    _wakeup.set()
+
+
+def wake():
+    """提交新任务后调用，让调度线程立即检查"""
+    start()
+    _wakeup.set()
+
+
+def run_pending(conn=None):
+    """在当前线程中执行所有到期的任务 (命令行或测试使用)，返回执行的任务数"""
+    conn = conn or database.get_connection()
+    count = 0
+    while True:
+        job = _claim(conn)
+        if job is None:
+            return count
+        with _state_lock:
+            _state['running'] += 1
+        _run(job)
+        count += 1
+
+
+def init_app(app):
+    """在第一个请求时启动当前进程的任务调度，接手重启前未完成的任务"""
+    app.before_request(start)
@@ -0,0 +1,377 @@
+import json
+import os
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from flask import request, g, current_app, abort
+import slow_queries
+
+# --- 按接口统计的请求和 SQL 指标 ---
+# database.connect() 创建的连接使用这里的 Connection/Cursor 子类，请求处理期间执行的每条语句
+# 都计入当前请求: 语句数、SQL 耗时 (execute 和 fetch)、等待写锁的时间和返回的行数；请求结束时再记录耗时和响应大小，
+# 按 Flask endpoint 汇总。/metrics 以 Prometheus 文本格式输出。
+#
+# 开销: 每条语句和每次 fetch 各两次 perf_counter 和一次线程局部变量读取，请求之外 (后台任务等) 的语句不统计。
+# 同一个钩子也检查慢查询 (见 slow_queries.py)，按 execute 和 fetch 的总耗时判断。
+# 等待写锁的时间无法从 sqlite3 模块直接取得，这里记录取得写锁的那条语句 (BEGIN IMMEDIATE 或
+# 事务中的第一条写语句) 的耗时，包含该语句本身的执行时间，是一个上界。
+#
+# 多个 gunicorn worker 时，每个进程的指标每秒最多一次写入 METRICS_DIR 中该进程的 JSON 文件，
+# /metrics 合并所有进程的文件后输出 (已退出的 worker 的文件保留，计数不会倒退；
+# master 启动时清空该目录，见 gunicorn.conf.py)。未设置 METRICS_DIR 时只输出当前进程的指标。
+
+# 请求耗时直方图的上界 (秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FLUSH_INTERVAL = 1.0
+METRICS_DIR = os.environ.get('METRICS_DIR')
+
+# 每个 (endpoint, method) 的累计值，依次为: 各直方图桶 (不含 +Inf)、请求数、总耗时、SQL 语句数、
+# SQL 耗时、写锁等待时间、返回行数、响应字节数
+_FIELDS = ('count', 'seconds', 'queries', 'sql_seconds', 'lock_wait_seconds', 'rows', 'response_bytes')
+_BUCKET_COUNT = len(LATENCY_BUCKETS)
+
+_local = threading.local()
+_lock = threading.Lock()
+_endpoints = {}        # (endpoint, method) -> [桶..., 各字段...]
+_statuses = {}         # (endpoint, method, status) -> 请求数
+_last_flush = [0.0]
+_flush_names = {}      # pid -> 文件名；加上启动时间，pid 被复用时不会覆盖已退出进程的文件
+_caches = {}           # 名称 -> 返回 {"hits", "misses", "evictions", "size"} 的函数
+_CACHE_FIELDS = ('hits', 'misses', 'evictions', 'size')
+
+
+class _RequestStats:
+    __slots__ = ('queries', 'sql_seconds', 'lock_wait_seconds', 'rows')
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.lock_wait_seconds = 0.0
+        self.rows = 0
+
+
+# --- 连接和游标 ---
+
+class Cursor(sqlite3.Cursor):
+    # 等待慢查询检查的语句: [sql, 参数, 累计耗时, many]。SELECT 的大部分工作在 fetch 中完成，
+    # 语句结束 (结果取完、游标关闭或释放、游标执行下一条语句) 时再按 execute 和 fetch 的总耗时检查
+    _statement = None
+
+    def _timed(self, method, sql, parameters, many=False):
+        stats = getattr(_local, 'stats', None)
+        if stats is None and not slow_queries.ENABLED:
+            return method(self, sql, parameters)
+        self._finish_statement()
+        idle = not self.connection.in_transaction
+        started = time.perf_counter()
+        try:
+            return method(self, sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            if stats is not None:
+                stats.queries += 1
+                stats.sql_seconds += elapsed
+                # 这条语句开启了事务 (隐式 BEGIN 之后的第一条写语句，或显式的 BEGIN IMMEDIATE)，写锁在这里取得
+                if idle and self.connection.in_transaction:
+                    stats.lock_wait_seconds += elapsed
+            # 慢查询日志也记录请求之外 (后台任务等) 的语句
+            if slow_queries.ENABLED:
+                self._statement = [sql, parameters, elapsed, many]
+                # 没有结果集的语句 (INSERT、UPDATE、DDL 等) 到这里已经执行完
+                if self.description is None:
+                    self._finish_statement()
+
+    def _finish_statement(self):
+        statement, self._statement = self._statement, None
+        if statement is not None:
+            slow_queries.check(self.connection, *statement)
+
+    def execute(self, sql, parameters=()):
+        return self._timed(sqlite3.Cursor.execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(sqlite3.Cursor.executemany, sql, seq_of_parameters, many=True)
+
+    def _fetch(self, method, *args):
+        """
+        **关键修复**: SELECT 在 execute 中只执行到第一行，其余的扫描发生在 fetch 中，
+        这里把 fetch 的耗时也计入 SQL 耗时和慢查询检查，否则大范围扫描的开销几乎全部漏记。
+        """
+        stats = getattr(_local, 'stats', None)
+        statement = self._statement
+        if stats is None and statement is None:
+            return method(self, *args)
+        started = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            if stats is not None:
+                stats.sql_seconds += elapsed
+            if statement is not None:
+                statement[2] += elapsed
+
+    def _count_rows(self, n):
+        stats = getattr(_local, 'stats', None)
+        if stats is not None:
+            stats.rows += n
+
+    def fetchone(self):
+        row = self._fetch(sqlite3.Cursor.fetchone)
+        if row is None:
+            self._finish_statement()
+        else:
+            self._count_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._fetch(sqlite3.Cursor.fetchmany, size)
+        self._count_rows(len(rows))
+        if len(rows) < size:
+            self._finish_statement()
+        return rows
+
+    def fetchall(self):
+        rows = self._fetch(sqlite3.Cursor.fetchall)
+        self._count_rows(len(rows))
+        self._finish_statement()
+        return rows
+
+    def __next__(self):
+        try:
+            row = self._fetch(sqlite3.Cursor.__next__)
+        except StopIteration:
+            self._finish_statement()
+            raise
+        self._count_rows(1)
+        return row
+
+    def close(self):
+        self._finish_statement()
+        super().close()
+
+    def __del__(self):
+        # 没有取完结果就被丢弃的游标 (例如只 fetchone 一次) 在这里结束检查
+        try:
+            self._finish_statement()
+        except Exception:
+            pass
+
+
+class Connection(sqlite3.Connection):
+    """database.connect() 使用的连接类: 所有游标 (包括 conn.execute 的隐式游标) 都带统计"""
+
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute 不经过 cursor()，这里显式转发
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            return super().commit()
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            stats.sql_seconds += time.perf_counter() - started
+
+
+def register_cache(name, stats):
+    """登记一个进程内缓存，stats() 返回其命中、未命中、淘汰次数和当前条目数，在 /metrics 中输出"""
+    _caches[name] = stats
+
+
+# --- 请求钩子 ---
+
+def _before_request():
+    _local.stats = _RequestStats()
+    g.metrics_started = time.perf_counter()
+
+
+def _after_request(response):
+    g.metrics_status = response.status_code
+    # 文件和流式响应在这里还没有生成内容，使用 Content-Length (没有时计为 0)
+    g.metrics_bytes = response.content_length or 0
+    return response
+
+
+def _teardown_request(exception=None):
+    stats = getattr(_local, 'stats', None)
+    _local.stats = None
+    started = g.pop('metrics_started', None)
+    if stats is None or started is None:
+        return
+    elapsed = time.perf_counter() - started
+    key = (request.endpoint or 'unmatched', request.method)
+    status = g.pop('metrics_status', 500)
+    response_bytes = g.pop('metrics_bytes', 0)
+    with _lock:
+        values = _endpoints.get(key)
+        if values is None:
+            values = _endpoints[key] = [0] * (_BUCKET_COUNT + len(_FIELDS))
+        bucket = bisect_left(LATENCY_BUCKETS, elapsed)
+        if bucket < _BUCKET_COUNT:
+            values[bucket] += 1
+        for i, value in enumerate((1, elapsed, stats.queries, stats.sql_seconds,
+                                   stats.lock_wait_seconds, stats.rows, response_bytes)):
+            values[_BUCKET_COUNT + i] += value
+        status_key = (*key, status)
+        _statuses[status_key] = _statuses.get(status_key, 0) + 1
+    if METRICS_DIR and time.monotonic() - _last_flush[0] >= FLUSH_INTERVAL:
+        flush()
+
+
+# --- 多进程汇总 ---
+
+def _snapshot():
+    caches = [[name, *(stats()[field] for field in _CACHE_FIELDS)] for name, stats in _caches.items()]
+    with _lock:
+        return {
+            "endpoints": [[*key, *values] for key, values in _endpoints.items()],
+            "statuses": [[*key, count] for key, count in _statuses.items()],
+            "caches": caches,
+        }
+
+
+def flush():
+    """把当前进程的指标写入 METRICS_DIR 中该进程的文件 (先写临时文件再重命名)"""
+    _last_flush[0] = time.monotonic()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(_snapshot(), f)
+        name = _flush_names.setdefault(os.getpid(), f"{os.getpid()}_{time.time_ns()}.json")
+        os.replace(tmp_path, os.path.join(METRICS_DIR, name))
+    except OSError as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        print(f"Error writing metrics: {e}")
+
+
+def reset_dir():
+    """清空 METRICS_DIR，在 gunicorn master 启动时调用"""
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return
+    for name in os.listdir(METRICS_DIR):
+        if name.endswith('.json') or name.endswith('.tmp'):
+            os.remove(os.path.join(METRICS_DIR, name))
+
+
+def _collect():
+    """合并所有进程的指标，返回 (endpoints, statuses, caches)"""
+    if not METRICS_DIR:
+        snapshots = [_snapshot()]
+    else:
+        flush()
+        snapshots = []
+        for name in os.listdir(METRICS_DIR):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    endpoints, statuses, caches = {}, {}, {}
+    for snapshot in snapshots:
+        for endpoint, method, *values in snapshot['endpoints']:
+            merged = endpoints.setdefault((endpoint, method), [0] * len(values))
+            for i, value in enumerate(values):
+                merged[i] += value
+        for endpoint, method, status, count in snapshot['statuses']:
+            statuses[(endpoint, method, status)] = statuses.get((endpoint, method, status), 0) + count
+        # 各进程的缓存相互独立，计数和条目数直接相加 (已退出的 worker 保留最后一次写入的条目数)
+        for name, *values in snapshot.get('caches', ()):
+            merged = caches.setdefault(name, [0] * len(values))
+            for i, value in enumerate(values):
+                merged[i] += value
+    return endpoints, statuses, caches
+
+
+# --- Prometheus 文本格式 ---
+
+def _labels(endpoint, method, **extra):
+    pairs = [('endpoint', endpoint), ('method', method), *extra.items()]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+def render():
+    endpoints, statuses, caches = _collect()
+    lines = [
+        '# HELP http_requests_total Requests by endpoint, method and status.',
+        '# TYPE http_requests_total counter',
+    ]
+    for (endpoint, method, status), count in sorted(statuses.items()):
+        lines.append(f"http_requests_total{_labels(endpoint, method, status=status)} {count}")
+
+    lines += [
+        '# HELP http_request_duration_seconds Request latency by endpoint.',
+        '# TYPE http_request_duration_seconds histogram',
+    ]
+    for (endpoint, method), values in sorted(endpoints.items()):
+        totals = dict(zip(_FIELDS, values[_BUCKET_COUNT:]))
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, values[:_BUCKET_COUNT]):
+            cumulative += count
+            lines.append(f"http_request_duration_seconds_bucket{_labels(endpoint, method, le=bound)} {cumulative}")
+        lines.append(f"http_request_duration_seconds_bucket{_labels(endpoint, method, le='+Inf')} {totals['count']}")
+        lines.append(f"http_request_duration_seconds_sum{_labels(endpoint, method)} {totals['seconds']:.6f}")
+        lines.append(f"http_request_duration_seconds_count{_labels(endpoint, method)} {totals['count']}")
+
+    counters = (
+        ('sql_queries_total', 'queries', 'SQL statements executed while handling requests.'),
+        ('sql_seconds_total', 'sql_seconds', 'Time spent executing SQL statements, fetching their rows and committing.'),
+        ('sql_lock_wait_seconds_total', 'lock_wait_seconds', 'Time spent in statements that acquired the write lock (upper bound of lock wait).'),
+        ('sql_rows_total', 'rows', 'Rows fetched from SQL results.'),
+        ('http_response_bytes_total', 'response_bytes', 'Response body bytes (Content-Length).'),
+    )
+    for name, field, help_text in counters:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        index = _BUCKET_COUNT + _FIELDS.index(field)
+        for (endpoint, method), values in sorted(endpoints.items()):
+            value = values[index]
+            lines.append(f"{name}{_labels(endpoint, method)} {value:.6f}" if isinstance(value, float)
+                         else f"{name}{_labels(endpoint, method)} {value}")
+
+    cache_metrics = (
+        ('cache_hits_total', 'counter', 'hits', 'In-process cache lookups that found a live entry.'),
+        ('cache_misses_total', 'counter', 'misses', 'In-process cache lookups that missed or found an expired entry.'),
+        ('cache_evictions_total', 'counter', 'evictions', 'Entries evicted because the cache was full.'),
+        ('cache_entries', 'gauge', 'size', 'Entries currently held (summed over processes).'),
+    )
+    for name, metric_type, field, help_text in cache_metrics:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+        index = _CACHE_FIELDS.index(field)
+        for cache, values in sorted(caches.items()):
+            lines.append(f'{name}{{cache="{cache}"}} {values[index]}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view():
+    # 需要 Authorization: Bearer <METRICS_TOKEN>；未设置 METRICS_TOKEN 时不开放 (与 /admin/profile 相同)
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        abort(404)
+    if not secrets.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {token}".encode()):
+        abort(401)
+    return render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+def init_app(app):
+    """注册请求钩子和 /metrics"""
+    app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
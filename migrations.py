@@ -0,0 +1,840 @@
+"""
+数据库结构迁移。
+
+版本号保存在 PRAGMA user_version 中，每个迁移在独立的事务中执行，
+执行耗时记录到 schema_migrations 表，便于在大型数据库上受控地迁移。
+直接运行本文件可以查看并执行待迁移项: python migrations.py [数据库路径]
+"""
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import database
+import dates
+import images
+from inventory import current_stock_sql
+
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 fcntl，退化为只依赖 BEGIN IMMEDIATE 后的版本复查
+    fcntl = None
+
+
+def _table_columns(cursor, table):
+    return [col[1] for col in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _m001_base_schema(cursor):
+    """基础表结构 (兼容未使用版本号的旧数据库)"""
+    # --- 创建 users 表 (如果不存在) ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            password_hash TEXT NOT NULL,
+            avatar TEXT
+        )
+    ''')
+
+    # --- 创建 people 表 (如果不存在) ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS people (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            name TEXT NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            UNIQUE(user_id, name)
+        )
+    ''')
+
+    # --- 创建 records 表 (如果不存在) ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER, content TEXT, category TEXT NOT NULL DEFAULT "general",
+            date TEXT, time TEXT, urgency TEXT, status TEXT NOT NULL DEFAULT "pending",
+            quantity TEXT, unit TEXT, brand TEXT, person_id INTEGER, type TEXT, color TEXT,
+            frequency TEXT, style TEXT, needs_purchase INTEGER DEFAULT 0, dosage TEXT,
+            total_quantity INTEGER, start_date TEXT, refill_quantity INTEGER,
+            reminder_threshold INTEGER, source_record_id INTEGER, shopping_source_id INTEGER,
+            completion_notes TEXT, completion_photos TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            FOREIGN KEY(person_id) REFERENCES people(id)
+        )
+    ''')
+
+    # --- 确保所有字段都存在 (用于旧数据库的迁移) ---
+    columns = _table_columns(cursor, 'records')
+    fields_to_add = {
+        'user_id': 'INTEGER',
+        'category': 'TEXT NOT NULL DEFAULT "general"', 'date': 'TEXT', 'time': 'TEXT', 'urgency': 'TEXT',
+        'status': 'TEXT NOT NULL DEFAULT "pending"', 'quantity': 'TEXT', 'unit': 'TEXT', 'brand': 'TEXT',
+        'person_id': 'INTEGER', 'type': 'TEXT', 'color': 'TEXT', 'frequency': 'TEXT', 'style': 'TEXT',
+        'needs_purchase': 'INTEGER DEFAULT 0', 'dosage': 'TEXT', 'total_quantity': 'INTEGER',
+        'start_date': 'TEXT', 'refill_quantity': 'INTEGER', 'reminder_threshold': 'INTEGER',
+        'source_record_id': 'INTEGER', 'shopping_source_id': 'INTEGER',
+        'completion_notes': 'TEXT',
+        'completion_photos': 'TEXT'
+    }
+    for field, definition in fields_to_add.items():
+        if field not in columns:
+            cursor.execute(f'ALTER TABLE records ADD COLUMN {field} {definition}')
+
+    # --- 帖子、评论和点赞的表 ---
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            timestamp DATETIME NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+    if 'photos' not in _table_columns(cursor, 'posts'):
+        cursor.execute('ALTER TABLE posts ADD COLUMN photos TEXT')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS comments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            timestamp DATETIME NOT NULL,
+            FOREIGN KEY(post_id) REFERENCES posts(id),
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS likes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            FOREIGN KEY(post_id) REFERENCES posts(id),
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            UNIQUE(post_id, user_id)
+        )
+    ''')
+
+
+def _m002_indexes(cursor):
+    """为各路由的 WHERE / ORDER BY 添加复合索引"""
+    # get_records: category = ? AND user_id = ? [AND status = ?] ORDER BY date
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_records_user_category_status_date ON records(user_id, category, status, date)")
+    # get_records(shopping): category = ? AND user_id = ? ORDER BY date DESC, id DESC
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_records_user_category_date ON records(user_id, category, date, id)")
+    # get_completed_records: user_id = ? AND status = 'completed' ORDER BY date DESC
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_records_user_status_date ON records(user_id, status, date)")
+    # category = 'shopping' AND source_record_id = ? (药品与购物清单联动)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_records_source_record ON records(source_record_id, category) WHERE source_record_id IS NOT NULL")
+    # get_person_details / delete_person: person_id = ? AND category = ?
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_records_person_category ON records(person_id, category)")
+    # get_posts: ORDER BY timestamp DESC, id DESC 及 (timestamp, id) < (?, ?) 游标
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_timestamp_id ON posts(timestamp, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_user ON posts(user_id)")
+    # 动态评论: post_id IN (...) ORDER BY timestamp, id
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_post_timestamp ON comments(post_id, timestamp, id)")
+    # 点赞按 post_id 查找由 UNIQUE(post_id, user_id) 覆盖，这里补充按用户查找
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_likes_user ON likes(user_id)")
+
+
+# 药品库存提醒从哪一天开始生效 (与 inventory.current_stock_sql 的计算方式一致)：
+# 锚点库存已低于阈值时立即生效 ('0000-00-00')；
+# 否则为库存第一次低于阈值的日期 start_date + ((库存 - 阈值) / 每日消耗 + 1) 天；
+# 永远不会低于阈值时为 NULL (不生成提醒)。
+_REMINDER_ACTIVE_FROM_SQL = """(CASE
+    WHEN typeof({r}.total_quantity) <> 'integer' OR typeof({r}.reminder_threshold) <> 'integer' THEN NULL
+    WHEN {r}.total_quantity < {r}.reminder_threshold THEN '0000-00-00'
+    WHEN {r}.reminder_threshold > 0
+         AND {r}.start_date IS NOT NULL AND date({r}.start_date) = {r}.start_date
+         AND {r}.frequency <> '' AND {r}.frequency NOT GLOB '*[^0-9]*'
+         AND {r}.dosage <> '' AND {r}.dosage NOT GLOB '*[^0-9]*'
+         AND CAST({r}.frequency AS INTEGER) * CAST({r}.dosage AS INTEGER) > 0
+    THEN date({r}.start_date, '+' || (({r}.total_quantity - {r}.reminder_threshold)
+                                      / (CAST({r}.frequency AS INTEGER) * CAST({r}.dosage AS INTEGER)) + 1) || ' days')
+    ELSE NULL
+END)"""
+
+
+def _medicine_reminder_insert_sql(r, from_clause):
+    """生成 "为药品行 r 写入库存提醒" 的 INSERT 语句，r 可以是触发器中的 NEW 或查询中的表别名"""
+    active_from = _REMINDER_ACTIVE_FROM_SQL.format(r=r)
+    return f"""
+        INSERT OR REPLACE INTO reminders (user_id, kind, source_key, content, active_from)
+        SELECT {r}.user_id, 'medicine', CAST({r}.id AS TEXT),
+               '库存警告: ' || COALESCE(p.name, '未知人物') || '的''' || COALESCE({r}.content, '') || '''数量不足',
+               {active_from}
+        FROM {from_clause} LEFT JOIN people p ON p.id = {r}.person_id
+        WHERE {r}.category = 'medicine' AND {r}.user_id IS NOT NULL AND {active_from} IS NOT NULL
+    """
+
+
+def _shopping_reminder_insert_sql(r, from_clause=None):
+    """生成 "为购物项 r 的日期写入购物提醒" 的 INSERT 语句"""
+    return f"""
+        INSERT OR IGNORE INTO reminders (user_id, kind, source_key, content, active_from)
+        SELECT DISTINCT {r}.user_id, 'shopping', {r}.date, '有计划的购物任务 (' || {r}.date || ')', '0000-00-00'
+        {f'FROM {from_clause}' if from_clause else ''}
+        WHERE {r}.category = 'shopping' AND {r}.status = 'pending' AND {r}.date IS NOT NULL AND {r}.user_id IS NOT NULL
+    """
+
+
+def _shopping_reminder_cleanup_sql(r):
+    """生成 "购物项 r 的日期已没有待购项时删除购物提醒" 的 DELETE 语句"""
+    return f"""
+        DELETE FROM reminders
+        WHERE kind = 'shopping' AND user_id = {r}.user_id AND source_key = {r}.date
+          AND NOT EXISTS (
+              SELECT 1 FROM records
+              WHERE user_id = {r}.user_id AND category = 'shopping' AND status = 'pending' AND date = {r}.date
+          )
+    """
+
+
+def _m003_reminders(cursor):
+    """由触发器增量维护的提醒表"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,           -- 'medicine' (库存警告) 或 'shopping' (购物日期)
+            source_key TEXT NOT NULL,     -- 药品记录ID 或 购物日期
+            content TEXT NOT NULL,
+            active_from TEXT NOT NULL,    -- 从这一天起显示，'0000-00-00' 表示立即显示
+            UNIQUE(user_id, kind, source_key)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reminders_user_active ON reminders(user_id, active_from)")
+
+    # --- 药品：库存锚点、用量、阈值、名称或人物变化时重新计算 ---
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_reminders_medicine_insert
+        AFTER INSERT ON records WHEN NEW.category = 'medicine'
+        BEGIN
+            {_medicine_reminder_insert_sql('NEW', '(SELECT 1)')};
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_reminders_medicine_update
+        AFTER UPDATE OF category, content, person_id, total_quantity, start_date, frequency, dosage, reminder_threshold ON records
+        WHEN OLD.category = 'medicine' OR NEW.category = 'medicine'
+        BEGIN
+            DELETE FROM reminders WHERE kind = 'medicine' AND source_key = CAST(OLD.id AS TEXT) AND user_id = OLD.user_id;
+            {_medicine_reminder_insert_sql('NEW', '(SELECT 1)')};
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_reminders_medicine_delete
+        AFTER DELETE ON records WHEN OLD.category = 'medicine'
+        BEGIN
+            DELETE FROM reminders WHERE kind = 'medicine' AND source_key = CAST(OLD.id AS TEXT) AND user_id = OLD.user_id;
+        END
+    """)
+
+    # --- 购物：某天出现待购项或该天的待购项全部完成/删除时，增删该日期的提醒 ---
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_reminders_shopping_insert
+        AFTER INSERT ON records WHEN NEW.category = 'shopping'
+        BEGIN
+            {_shopping_reminder_insert_sql('NEW')};
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_reminders_shopping_update
+        AFTER UPDATE OF category, status, date, user_id ON records
+        WHEN OLD.category = 'shopping' OR NEW.category = 'shopping'
+        BEGIN
+            {_shopping_reminder_cleanup_sql('OLD')};
+            {_shopping_reminder_insert_sql('NEW')};
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_reminders_shopping_delete
+        AFTER DELETE ON records WHEN OLD.category = 'shopping'
+        BEGIN
+            {_shopping_reminder_cleanup_sql('OLD')};
+        END
+    """)
+
+    # --- 根据现有数据回填 ---
+    cursor.execute("DELETE FROM reminders")
+    cursor.execute(_medicine_reminder_insert_sql('r', 'records r'))
+    cursor.execute(_shopping_reminder_insert_sql('r', 'records r'))
+
+
+def _bump_version_sql(scope):
+    return f"""
+        INSERT INTO data_versions (scope, version) SELECT {scope}, 1 WHERE {scope} IS NOT NULL
+        ON CONFLICT(scope) DO UPDATE SET version = version + 1
+    """
+
+
+def _m004_data_versions(cursor):
+    """数据版本号，供 GET 接口生成 ETag (见 versions.py)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            scope TEXT PRIMARY KEY,       -- 'user:<id>' (该用户的记录和人物) 或 'feed' (交流社区)
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+    # 记录和人物的任何变化都会让所属用户的版本号加一，与数据修改在同一事务中提交
+    for table in ('records', 'people'):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_versions_{table}_insert AFTER INSERT ON {table}
+            BEGIN {_bump_version_sql("'user:' || NEW.user_id")}; END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_versions_{table}_update AFTER UPDATE ON {table}
+            BEGIN
+                {_bump_version_sql("'user:' || NEW.user_id")};
+                {_bump_version_sql("'user:' || OLD.user_id")};
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_versions_{table}_delete AFTER DELETE ON {table}
+            BEGIN {_bump_version_sql("'user:' || OLD.user_id")}; END
+        """)
+
+    # 帖子、评论、点赞的变化会改变所有人看到的动态
+    for table in ('posts', 'comments', 'likes'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_versions_{table}_{event.lower()} AFTER {event} ON {table}
+                BEGIN {_bump_version_sql("'feed'")}; END
+            """)
+
+    # 用户名和头像同时出现在个人信息和动态中
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_versions_users_update AFTER UPDATE OF username, avatar ON users
+        BEGIN
+            {_bump_version_sql("'user:' || NEW.id")};
+            {_bump_version_sql("'feed'")};
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_versions_users_delete AFTER DELETE ON users
+        BEGIN
+            {_bump_version_sql("'user:' || OLD.id")};
+            {_bump_version_sql("'feed'")};
+        END
+    """)
+
+
+def _upload_ref_cleanup_sql(owner_kind, owner_id):
+    return f"DELETE FROM upload_refs WHERE owner_kind = '{owner_kind}' AND owner_id = {owner_id}"
+
+
+def _json_paths(value):
+    try:
+        paths = json.loads(value) if value else []
+    except (TypeError, ValueError):
+        return []
+    return [p for p in paths if isinstance(p, str) and p] if isinstance(paths, list) else []
+
+
+def _m005_upload_store(cursor):
+    """按内容寻址的上传文件登记表和引用表 (见 upload_store.py)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            path TEXT PRIMARY KEY,        -- 主版本路径，如 uploads/<sha256>.webp
+            kind TEXT NOT NULL,           -- 'avatar' 或 'photo'，决定有哪些版本
+            size INTEGER NOT NULL DEFAULT 0,   -- 所有版本的字节数之和
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_refs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT NOT NULL,
+            user_id INTEGER NOT NULL,     -- 建立引用的用户
+            owner_kind TEXT NOT NULL,     -- 'avatar' (owner_id 为 users.id) / 'post' (posts.id) / 'completion' (records.id)
+            owner_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_upload_refs_owner ON upload_refs (owner_kind, owner_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_upload_refs_user ON upload_refs (user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_upload_refs_path ON upload_refs (path)")
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_upload_refs_insert AFTER INSERT ON upload_refs
+        BEGIN UPDATE uploads SET ref_count = ref_count + 1 WHERE path = NEW.path; END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_upload_refs_delete AFTER DELETE ON upload_refs
+        BEGIN UPDATE uploads SET ref_count = ref_count - 1 WHERE path = OLD.path; END
+    ''')
+    # 删除帖子、记录、用户时释放它们的引用；文件本身由 upload_store.purge_unreferenced 删除
+    for table, owner_kind in (('posts', 'post'), ('records', 'completion'), ('users', 'avatar')):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_upload_refs_{table}_delete AFTER DELETE ON {table}
+            BEGIN {_upload_ref_cleanup_sql(owner_kind, 'OLD.id')}; END
+        """)
+
+    # 登记已有的上传文件
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    refs = []
+    cursor.execute("SELECT id, avatar FROM users WHERE avatar IS NOT NULL AND avatar != ''")
+    refs.extend((row[1], 'avatar', row[0], 'avatar', row[0]) for row in cursor.fetchall())
+    cursor.execute("SELECT id, user_id, photos FROM posts WHERE photos IS NOT NULL")
+    for post_id, user_id, photos in cursor.fetchall():
+        refs.extend((p, 'photo', user_id, 'post', post_id) for p in _json_paths(photos))
+    cursor.execute("SELECT id, user_id, completion_photos FROM records WHERE completion_photos IS NOT NULL AND user_id IS NOT NULL")
+    for record_id, user_id, photos in cursor.fetchall():
+        refs.extend((p, 'photo', user_id, 'completion', record_id) for p in _json_paths(photos))
+
+    for path, kind, user_id, owner_kind, owner_id in refs:
+        size = sum(os.path.getsize(p) for p in set(images.variant_paths(path, kind).values()) if os.path.exists(p))
+        cursor.execute(
+            "INSERT INTO uploads (path, kind, size, ref_count, created_at) VALUES (?, ?, ?, 0, ?) ON CONFLICT(path) DO NOTHING",
+            (path, kind, size, now)
+        )
+        cursor.execute(
+            "INSERT INTO upload_refs (path, user_id, owner_kind, owner_id) VALUES (?, ?, ?, ?)",
+            (path, user_id, owner_kind, owner_id)
+        )
+
+
+def _m006_jobs(cursor):
+    """后台任务队列 (见 jobs.py) 和用户的注销标记"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,        -- JSON
+            status TEXT NOT NULL,         -- 'pending' / 'running' / 'failed'，完成的任务直接删除
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after REAL NOT NULL,      -- Unix 时间戳；running 状态下为租约到期时间
+            last_error TEXT,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON jobs (status, run_after)")
+    # 注销账户时先写入注销时间，数据由后台任务分批删除
+    if 'deleted_at' not in _table_columns(cursor, 'users'):
+        cursor.execute('ALTER TABLE users ADD COLUMN deleted_at TEXT')
+
+
+def _m007_upload_gc(cursor):
+    """记录上传文件失去最后一个引用的时间，供 upload_gc 按宽限期清理"""
+    if 'orphaned_at' not in _table_columns(cursor, 'uploads'):
+        cursor.execute('ALTER TABLE uploads ADD COLUMN orphaned_at TEXT')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_uploads_orphaned AFTER UPDATE OF ref_count ON uploads
+        WHEN NEW.ref_count <= 0 AND OLD.ref_count > 0
+        BEGIN UPDATE uploads SET orphaned_at = datetime('now', 'localtime') WHERE path = NEW.path; END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_uploads_adopted AFTER UPDATE OF ref_count ON uploads
+        WHEN NEW.ref_count > 0 AND NEW.orphaned_at IS NOT NULL
+        BEGIN UPDATE uploads SET orphaned_at = NULL WHERE path = NEW.path; END
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_uploads_orphaned ON uploads (orphaned_at) WHERE ref_count <= 0")
+    cursor.execute("UPDATE uploads SET orphaned_at = created_at WHERE ref_count <= 0 AND orphaned_at IS NULL")
+
+
+def _m008_post_counters(cursor):
+    """帖子的点赞数和评论数，由触发器在点赞、评论增删时维护"""
+    columns = _table_columns(cursor, 'posts')
+    for column in ('like_count', 'comment_count'):
+        if column not in columns:
+            cursor.execute(f'ALTER TABLE posts ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+
+    for table, column in (('likes', 'like_count'), ('comments', 'comment_count')):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_posts_{column}_insert AFTER INSERT ON {table}
+            BEGIN UPDATE posts SET {column} = {column} + 1 WHERE id = NEW.post_id; END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_posts_{column}_delete AFTER DELETE ON {table}
+            BEGIN UPDATE posts SET {column} = {column} - 1 WHERE id = OLD.post_id; END
+        """)
+        cursor.execute(f"""
+            UPDATE posts SET {column} = (SELECT COUNT(*) FROM {table} WHERE {table}.post_id = posts.id)
+        """)
+
+
+# (全文索引表, 源表, 被索引的列)
+_FTS_TABLES = (
+    ('records_fts', 'records', ('content', 'completion_notes')),
+    ('posts_fts', 'posts', ('content',)),
+    ('comments_fts', 'comments', ('content',)),
+)
+
+
+def _m009_fulltext_search(cursor):
+    """FTS5 全文索引 (见 search.py)，由触发器与源表保持同步"""
+    for fts, table, columns in _FTS_TABLES:
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f'NEW.{c}' for c in columns)
+        old_values = ', '.join(f'OLD.{c}' for c in columns)
+        # trigram 分词不依赖空格，中文也能按任意子串检索 (查询词至少 3 个字符)
+        cursor.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                {column_list}, content='{table}', content_rowid='id', tokenize='trigram'
+            )
+        """)
+        # 外部内容表: 删除和修改时需要用旧值从索引中删除
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_insert AFTER INSERT ON {table}
+            BEGIN INSERT INTO {fts} (rowid, {column_list}) VALUES (NEW.id, {new_values}); END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_delete AFTER DELETE ON {table}
+            BEGIN INSERT INTO {fts} ({fts}, rowid, {column_list}) VALUES ('delete', OLD.id, {old_values}); END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_update AFTER UPDATE OF {column_list} ON {table}
+            BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {column_list}) VALUES ('delete', OLD.id, {old_values});
+                INSERT INTO {fts} (rowid, {column_list}) VALUES (NEW.id, {new_values});
+            END
+        """)
+        cursor.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+
+def _m010_photos(cursor):
+    """帖子照片和完成记录照片改为 photos 表 (每张照片一行)，替代 JSON 数组列"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS photos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner_kind TEXT NOT NULL,     -- 'post' (owner_id 为 posts.id) 或 'completion' (records.id)
+            owner_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,     -- 上传照片的用户
+            position INTEGER NOT NULL,    -- 在所属帖子/记录中的顺序，从 0 开始
+            path TEXT NOT NULL,           -- uploads 表中的主版本路径
+            UNIQUE(owner_kind, owner_id, position)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_photos_user ON photos (user_id, owner_kind)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_photos_path ON photos (path)")
+
+    # 照片和头像引用 (upload_refs) 一样计入上传文件的引用计数
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_photos_insert AFTER INSERT ON photos
+        BEGIN UPDATE uploads SET ref_count = ref_count + 1 WHERE path = NEW.path; END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_photos_delete AFTER DELETE ON photos
+        BEGIN UPDATE uploads SET ref_count = ref_count - 1 WHERE path = OLD.path; END
+    ''')
+    for table, owner_kind in (('posts', 'post'), ('records', 'completion')):
+        cursor.execute(f"DROP TRIGGER IF EXISTS trg_upload_refs_{table}_delete")
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_photos_{table}_delete AFTER DELETE ON {table}
+            BEGIN DELETE FROM photos WHERE owner_kind = '{owner_kind}' AND owner_id = OLD.id; END
+        """)
+
+    # 按 JSON 数组中的顺序迁移已有照片；先插入新行再删除旧引用，引用计数不会中途归零
+    cursor.execute("SELECT id, user_id, photos FROM posts WHERE photos IS NOT NULL AND user_id IS NOT NULL")
+    rows = [('post', owner_id, user_id, photos) for owner_id, user_id, photos in cursor.fetchall()]
+    cursor.execute("SELECT id, user_id, completion_photos FROM records WHERE completion_photos IS NOT NULL AND user_id IS NOT NULL")
+    rows += [('completion', owner_id, user_id, photos) for owner_id, user_id, photos in cursor.fetchall()]
+    for owner_kind, owner_id, user_id, photos in rows:
+        cursor.executemany(
+            "INSERT INTO photos (owner_kind, owner_id, user_id, position, path) VALUES (?, ?, ?, ?, ?)",
+            [(owner_kind, owner_id, user_id, position, path) for position, path in enumerate(_json_paths(photos))]
+        )
+    cursor.execute("DELETE FROM upload_refs WHERE owner_kind IN ('post', 'completion')")
+
+    cursor.execute('ALTER TABLE posts DROP COLUMN photos')
+    cursor.execute('ALTER TABLE records DROP COLUMN completion_photos')
+
+
+# 各类记录的视图只包含该类记录使用的列 (见 _m011_record_views)
+_RECORD_VIEW_COLUMNS = {
+    'general_records': ('id', 'user_id', 'category', 'content', 'date', 'time', 'urgency', 'status'),
+    'shopping_records': ('id', 'user_id', 'category', 'content', 'date', 'quantity', 'unit', 'brand', 'status', 'source_record_id'),
+    'clothes_records': ('id', 'user_id', 'person_id', 'content', 'type', 'color', 'quantity'),
+    'medicine_records': ('id', 'user_id', 'person_id', 'content', 'frequency', 'dosage', 'style', 'color',
+                         'total_quantity', 'start_date', 'refill_quantity', 'reminder_threshold', 'needs_purchase'),
+}
+
+
+def _create_record_view(cursor, view, columns):
+    category = view[:-len('_records')]
+    column_list = ', '.join(columns)
+    if category == 'medicine':
+        # 当前库存按日期算出 (见 inventory.py)，total_quantity 仍是锚点库存
+        column_list += f", {current_stock_sql()} AS current_quantity"
+    cursor.execute(f"DROP VIEW IF EXISTS {view}")
+    cursor.execute(f"CREATE VIEW {view} AS SELECT {column_list} FROM records WHERE category = '{category}'")
+
+
+def _m011_record_views(cursor):
+    """
+    按类别划分的记录视图。
+    records 表保持不拆分: SQLite 中值为 NULL 的列只占记录头中的 1 个字节，拆表几乎不会让页变小，
+    却要给每次读写增加连接，并重写 records 上的全部触发器。读取改为通过只含所需列的视图进行，
+    视图在查询时展开，仍然使用 records 上已有的 (user_id, category, ...) 索引。
+    """
+    for view, columns in _RECORD_VIEW_COLUMNS.items():
+        _create_record_view(cursor, view, columns)
+
+
+def _normalize_column(cursor, table, column, normalize):
+    """把 table.column 中能识别的值统一为定长格式 (见 dates.py)，无法识别的值保持不变"""
+    cursor.execute(f"SELECT id, {column} FROM {table} WHERE {column} IS NOT NULL")
+    updates = []
+    for row_id, value in cursor.fetchall():
+        try:
+            normalized = normalize(value)
+        except (TypeError, ValueError):
+            continue
+        if normalized != value:
+            updates.append((normalized, row_id))
+    cursor.executemany(f"UPDATE {table} SET {column} = ? WHERE id = ?", updates)
+
+
+def _m012_typed_dates(cursor):
+    """统一日期时间格式，增加可索引的紧急程度，通用记录和动态按索引顺序返回"""
+    _normalize_column(cursor, 'posts', 'timestamp', dates.normalize_timestamp)
+    _normalize_column(cursor, 'comments', 'timestamp', dates.normalize_timestamp)
+    _normalize_column(cursor, 'records', 'date', dates.normalize_date)
+    _normalize_column(cursor, 'records', 'time', dates.normalize_time)
+    _normalize_column(cursor, 'records', 'start_date', dates.normalize_date)
+
+    # 由 urgency 算出的虚拟列，不占存储，但可以建索引
+    if 'urgency_rank' not in [col[1] for col in cursor.execute("PRAGMA table_xinfo(records)").fetchall()]:
+        cursor.execute("""
+            ALTER TABLE records ADD COLUMN urgency_rank INTEGER
+            GENERATED ALWAYS AS (CASE urgency WHEN '高' THEN 1 WHEN '中' THEN 2 WHEN '低' THEN 3 ELSE 4 END) VIRTUAL
+        """)
+    _create_record_view(cursor, 'general_records', _RECORD_VIEW_COLUMNS['general_records'] + ('urgency_rank',))
+
+    # 首页的两种排序方式各一个部分索引 (只含待办的通用记录)，ORDER BY 不再需要排序
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_general_pending_urgency ON records(user_id, date, urgency_rank, time)
+        WHERE category = 'general' AND status = 'pending'
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_general_pending_time ON records(user_id, date, time, urgency_rank)
+        WHERE category = 'general' AND status = 'pending'
+    """)
+
+
+def _m013_user_tombstone_versions(cursor):
+    """注销账户 (写入 deleted_at) 会让该用户的帖子和评论从动态中消失，同样需要更新动态的版本号"""
+    cursor.execute("DROP TRIGGER IF EXISTS trg_versions_users_update")
+    cursor.execute(f"""
+        CREATE TRIGGER trg_versions_users_update AFTER UPDATE OF username, avatar, deleted_at ON users
+        BEGIN
+            {_bump_version_sql("'user:' || NEW.id")};
+            {_bump_version_sql("'feed'")};
+        END
+    """)
+
+
+def _m014_short_times(cursor):
+    """第 12 步不识别没有前导零的时间 (如 "9:05")，这些值原样保留，排序错误；现在可以识别，重新统一一次"""
+    _normalize_column(cursor, 'records', 'time', dates.normalize_time)
+
+
+def _m015_counters_skip_tombstoned(cursor):
+    """
+    动态不显示已注销用户的评论 (见 communicate._build_feed_page)，点赞数和评论数也不再计入这些用户。
+    注销时一次性扣除该用户的点赞和评论；之后后台删除这些行时不再重复扣除。
+    """
+    # 注销时按用户查找评论 (后台删除也按用户分批删除评论)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_user ON comments(user_id)")
+
+    for table, column in (('likes', 'like_count'), ('comments', 'comment_count')):
+        cursor.execute(f"DROP TRIGGER IF EXISTS trg_posts_{column}_insert")
+        cursor.execute(f"DROP TRIGGER IF EXISTS trg_posts_{column}_delete")
+        cursor.execute(f"""
+            CREATE TRIGGER trg_posts_{column}_insert AFTER INSERT ON {table}
+            WHEN (SELECT deleted_at FROM users WHERE id = NEW.user_id) IS NULL
+            BEGIN UPDATE posts SET {column} = {column} + 1 WHERE id = NEW.post_id; END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER trg_posts_{column}_delete AFTER DELETE ON {table}
+            WHEN (SELECT deleted_at FROM users WHERE id = OLD.user_id) IS NULL
+            BEGIN UPDATE posts SET {column} = {column} - 1 WHERE id = OLD.post_id; END
+        """)
+        cursor.execute(f"""
+            UPDATE posts SET {column} = (
+                SELECT COUNT(*) FROM {table} t JOIN users u ON u.id = t.user_id
+                WHERE t.post_id = posts.id AND u.deleted_at IS NULL
+            )
+        """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_posts_counters_user_tombstone AFTER UPDATE OF deleted_at ON users
+        WHEN OLD.deleted_at IS NULL AND NEW.deleted_at IS NOT NULL
+        BEGIN
+            UPDATE posts SET like_count = like_count - (
+                SELECT COUNT(*) FROM likes l WHERE l.post_id = posts.id AND l.user_id = NEW.id
+            ) WHERE id IN (SELECT post_id FROM likes WHERE user_id = NEW.id);
+            UPDATE posts SET comment_count = comment_count - (
+                SELECT COUNT(*) FROM comments c WHERE c.post_id = posts.id AND c.user_id = NEW.id
+            ) WHERE id IN (SELECT post_id FROM comments WHERE user_id = NEW.id);
+        END
+    """)
+
+
+# (二元组索引表, 源表, 被索引的列)
+_BIGRAM_TABLES = (
+    ('records_bigram', 'records', ('content', 'completion_notes')),
+    ('posts_bigram', 'posts', ('content',)),
+    ('comments_bigram', 'comments', ('content',)),
+)
+
+
+def _m016_bigram_search(cursor):
+    """
+    少于 3 个字符的查询词 (如 "牛奶") 不能使用 trigram 索引，原先退化为扫描全部帖子和评论的 LIKE 查询。
+    为这类查询增加二元组索引 (见 bigrams.py)，写入时由 bigrams() 切分。
+    索引只保存词项不保存原文 (contentless)，片段仍从源表生成；删除和修改时同样需要用旧值从索引中删除。
+    """
+    for fts, table, columns in _BIGRAM_TABLES:
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f'bigrams(NEW.{c})' for c in columns)
+        old_values = ', '.join(f'bigrams(OLD.{c})' for c in columns)
+        # prefix='1': 单个字符的前缀查询直接使用前缀索引
+        cursor.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                {column_list}, content='', tokenize='unicode61 remove_diacritics 0', prefix='1'
+            )
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_insert AFTER INSERT ON {table}
+            BEGIN INSERT INTO {fts} (rowid, {column_list}) VALUES (NEW.id, {new_values}); END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_delete AFTER DELETE ON {table}
+            BEGIN INSERT INTO {fts} ({fts}, rowid, {column_list}) VALUES ('delete', OLD.id, {old_values}); END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{fts}_update AFTER UPDATE OF {column_list} ON {table}
+            BEGIN
+                INSERT INTO {fts} ({fts}, rowid, {column_list}) VALUES ('delete', OLD.id, {old_values});
+                INSERT INTO {fts} (rowid, {column_list}) VALUES (NEW.id, {new_values});
+            END
+        """)
+        cursor.execute(f"INSERT INTO {fts} (rowid, {column_list}) SELECT id, {new_values.replace('NEW.', '')} FROM {table}")
+
+
+# (版本号, 说明, 迁移函数)，版本号必须连续递增
+MIGRATIONS = [
+    (1, '基础表结构', _m001_base_schema),
+    (2, '复合索引', _m002_indexes),
+    (3, '提醒表', _m003_reminders),
+    (4, '数据版本号', _m004_data_versions),
+    (5, '上传文件登记', _m005_upload_store),
+    (6, '后台任务队列', _m006_jobs),
+    (7, '上传文件清理', _m007_upload_gc),
+    (8, '点赞数和评论数', _m008_post_counters),
+    (9, '全文索引', _m009_fulltext_search),
+    (10, '照片表', _m010_photos),
+    (11, '分类记录视图', _m011_record_views),
+    (12, '日期格式和紧急程度', _m012_typed_dates),
+    (13, '注销账户更新动态版本', _m013_user_tombstone_versions),
+    (14, '补充统一时间格式', _m014_short_times),
+    (15, '计数不含已注销用户', _m015_counters_skip_tombstoned),
+    (16, '短词检索索引', _m016_bigram_search),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def pending_migrations(conn):
+    current = get_schema_version(conn)
+    return [m for m in MIGRATIONS if m[0] > current]
+
+
+def migrate(conn, log=print):
+    """
+    执行所有待迁移项，返回 [(版本号, 说明, 耗时毫秒), ...]。
+    每个迁移单独使用一个 BEGIN IMMEDIATE 事务，失败时回滚且不更新版本号。
+    """
+    applied = []
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None  # 手动管理事务，保证 DDL 与版本号一起提交
+    try:
+        for version, name, func in pending_migrations(conn):
+            started = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 在持有写锁后重新检查版本号，避免多个进程重复执行同一个迁移
+                if get_schema_version(conn) >= version:
+                    conn.execute("ROLLBACK")
+                    continue
+                cursor = conn.cursor()
+                func(cursor)
+                duration_ms = (time.perf_counter() - started) * 1000
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        applied_at TEXT NOT NULL,
+                        duration_ms REAL NOT NULL
+                    )
+                ''')
+                cursor.execute(
+                    "INSERT OR REPLACE INTO schema_migrations (version, name, applied_at, duration_ms) VALUES (?, ?, ?, ?)",
+                    (version, name, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), duration_ms)
+                )
+                cursor.execute(f"PRAGMA user_version = {int(version)}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            applied.append((version, name, duration_ms))
+            log(f"Applied migration {version} ({name}) in {duration_ms:.1f} ms")
+
+        if applied:
+            # 更新查询优化器的统计信息，让新索引立即生效
+            started = time.perf_counter()
+            conn.execute("ANALYZE")
+            log(f"ANALYZE finished in {(time.perf_counter() - started) * 1000:.1f} ms")
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
+
+
+@contextmanager
+def _migration_lock(path):
+    """跨进程的迁移文件锁，保证同一时刻只有一个进程在迁移"""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.migrate.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def ensure_schema(path=None, log=print):
+    """
+    启动时调用。版本号已是最新时只读取一次 PRAGMA user_version (O(1)，不加写锁)；
+    否则获取迁移文件锁后再执行迁移，其他进程等待锁释放后复查版本号即可直接返回。
+    返回本次执行的迁移列表。
+    """
+    path = path or database.DATABASE
+    conn = database.connect(path)
+    try:
+        if get_schema_version(conn) >= SCHEMA_VERSION:
+            return []
+        with _migration_lock(path):
+            return migrate(conn, log)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    conn = database.connect(sys.argv[1] if len(sys.argv) > 1 else None)
+    try:
+        print(f"Current schema version: {get_schema_version(conn)} (latest: {SCHEMA_VERSION})")
+        for version, name, _ in pending_migrations(conn):
+            print(f"  pending: {version} {name}")
+        migrate(conn)
+    finally:
+        conn.close()
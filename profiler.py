@@ -0,0 +1,254 @@
+import os
+import secrets
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from flask import request, current_app, jsonify, abort, g
+
+# --- 在线采样分析 ---
+# 统计式采样: 后台线程每隔 interval 读取一次 sys._current_frames()，把每个线程的调用栈
+# 按 "线程;外层函数;...;内层函数 次数" 的 collapsed 格式计数，可以直接交给 flamegraph.pl
+# 或 speedscope 生成火焰图。不修改被分析的代码，开销只是采样线程本身 (默认每秒 100 次)。
+#
+#   POST /admin/profile?seconds=10&interval_ms=10   在处理该请求的 worker 中开始采样，立即返回 id
+#   GET  /admin/profile/<id>                        采样完成后返回 collapsed 文本 (?format=json 返回 JSON)
+#   任意请求带上 X-Profile 头                         只分析这一个请求，响应头 X-Profile-Id 给出结果的 id
+#
+# 单个请求通常只有几毫秒，采样得不到有意义的结果，因此改用 sys.setprofile 记录该线程的每次调用，
+# 结果同样是 collapsed 格式，计数是每个调用栈自身耗费的微秒数。只影响带了 X-Profile 头的请求。
+#
+# gunicorn 的 sync worker 一次只处理一个请求，采样在后台进行，开始采样的请求立即返回，
+# 随后该 worker 处理的请求都会被采到。结果写入 PROFILE_DIR，任意 worker 都可以返回。
+# 只有设置了 PROFILER_TOKEN 时才启用，请求需要带 Authorization: Bearer <token> (X-Profile 头的值即 token)。
+
+DEFAULT_SECONDS = 10
+MAX_SECONDS = 120
+DEFAULT_INTERVAL_MS = 10
+MIN_INTERVAL_MS = 1
+RETENTION = 24 * 3600          # 结果文件保留时间 (秒)
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'home_use_profiles')
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Sampler(threading.Thread):
+    """采样线程: 运行到 duration 秒或 stop() 为止；thread_ids 不为空时只采样这些线程"""
+
+    def __init__(self, interval, duration, thread_ids=None):
+        super().__init__(name='profiler', daemon=True)
+        self.interval = interval
+        self.duration = duration
+        self.thread_ids = thread_ids
+        self.stacks = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        deadline = time.monotonic() + self.duration
+        while not self._stopped.is_set() and time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or (self.thread_ids and thread_id not in self.thread_ids):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def collapsed(self):
+        return _collapsed(self.stacks)
+
+
+class RequestTracer:
+    """记录当前线程从 start() 到 stop() 之间的所有调用，按调用栈累计自身耗时 (微秒)"""
+
+    def __init__(self):
+        self.stacks = Counter()
+        self._stack = []
+        self._last = 0
+
+    def start(self):
+        # 从 start 自身开始记录外层调用栈，之后 start 返回的事件正好弹出它自己
+        frame = sys._getframe()
+        while frame is not None:
+            self._stack.append(_frame_label(frame.f_code))
+            frame = frame.f_back
+        self._stack.append(threading.current_thread().name)
+        self._stack.reverse()
+        self._last = time.perf_counter_ns()
+        sys.setprofile(self._event)
+
+    def stop(self):
+        sys.setprofile(None)
+
+    def _event(self, frame, event, arg):
+        now = time.perf_counter_ns()
+        self.stacks[';'.join(self._stack)] += (now - self._last) // 1000
+        if event == 'call':
+            self._stack.append(_frame_label(frame.f_code))
+        elif event == 'c_call':
+            self._stack.append(f"{getattr(arg, '__qualname__', arg)} (builtin)")
+        elif len(self._stack) > 1:
+            # return / c_return / c_exception
+            self._stack.pop()
+        self._last = time.perf_counter_ns()
+
+    def collapsed(self):
+        return _collapsed(self.stacks)
+
+
+def _collapsed(stacks):
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common() if count)
+
+
+# --- 结果文件 ---
+
+def _path(profile_id, suffix):
+    return os.path.join(PROFILE_DIR, f"{profile_id}.{suffix}")
+
+
+def _prune():
+    now = time.time()
+    for name in os.listdir(PROFILE_DIR):
+        path = os.path.join(PROFILE_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > RETENTION:
+                os.remove(path)
+        except OSError:
+            continue
+
+
+def _save(profile_id, profile, **meta):
+    """先写临时文件再重命名，读取方看不到写了一半的结果；第一行是 "# 键 值 ..." 形式的说明"""
+    header = '# ' + ' '.join(f"{key} {value}" for key, value in {"pid": os.getpid(), **meta}.items()) + '\n'
+    fd, tmp_path = tempfile.mkstemp(dir=PROFILE_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(header + profile.collapsed())
+    os.replace(tmp_path, _path(profile_id, 'collapsed'))
+    try:
+        os.remove(_path(profile_id, 'running'))
+    except FileNotFoundError:
+        pass
+
+
+def _new_profile():
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    _prune()
+    profile_id = secrets.token_hex(8)
+    open(_path(profile_id, 'running'), 'w').close()
+    return profile_id
+
+
+def _run_in_background(profile_id, sampler):
+    sampler.join()
+    try:
+        _save(profile_id, sampler, mode='sample', samples=sampler.samples, interval_ms=f"{sampler.interval * 1000:g}")
+    except OSError as e:
+        print(f"Error saving profile {profile_id}: {e}")
+
+
+# --- 接口 ---
+
+def _authorized(token_value):
+    token = current_app.config.get('PROFILER_TOKEN')
+    return bool(token) and secrets.compare_digest(token_value or '', token)
+
+
+def _require_admin():
+    if not current_app.config.get('PROFILER_TOKEN'):
+        abort(404)
+    auth = request.headers.get('Authorization', '')
+    if not _authorized(auth[len('Bearer '):] if auth.startswith('Bearer ') else None):
+        abort(401)
+
+
+def start_profile():
+    _require_admin()
+    try:
+        seconds = min(max(float(request.args.get('seconds', DEFAULT_SECONDS)), 0.1), MAX_SECONDS)
+        interval_ms = max(float(request.args.get('interval_ms', DEFAULT_INTERVAL_MS)), MIN_INTERVAL_MS)
+    except ValueError:
+        return jsonify({"error": "无效的采样参数"}), 400
+    profile_id = _new_profile()
+    sampler = Sampler(interval_ms / 1000, seconds)
+    sampler.start()
+    threading.Thread(target=_run_in_background, args=(profile_id, sampler), name='profiler-save', daemon=True).start()
+    return jsonify({"id": profile_id, "pid": os.getpid(), "seconds": seconds, "interval_ms": interval_ms}), 202
+
+
+def get_profile(profile_id):
+    _require_admin()
+    if not profile_id.isalnum():
+        abort(404)
+    path = _path(profile_id, 'collapsed')
+    if not os.path.exists(path):
+        if os.path.exists(_path(profile_id, 'running')):
+            return jsonify({"id": profile_id, "status": "running"}), 202
+        abort(404)
+    with open(path, encoding='utf-8') as f:
+        header, *lines = f.read().splitlines()
+    if request.args.get('format') == 'json':
+        fields = header.lstrip('# ').split()
+        result = {"id": profile_id, **dict(zip(fields[::2], fields[1::2]))}
+        result['stacks'] = {}
+        for line in lines:
+            stack, _, count = line.rpartition(' ')
+            result['stacks'][stack] = int(count)
+        return jsonify(result)
+    return '\n'.join([header, *lines]) + '\n', 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+
+# --- 单个请求的分析 ---
+
+def _before_request():
+    value = request.headers.get('X-Profile')
+    if value is None or not _authorized(value):
+        return
+    tracer = RequestTracer()
+    g.profile = (_new_profile(), tracer)
+    tracer.start()
+
+
+def _finish_request_profile():
+    profile = g.pop('profile', None)
+    if profile is None:
+        return None
+    profile_id, tracer = profile
+    tracer.stop()
+    _save(profile_id, tracer, mode='trace', unit='us')
+    return profile_id
+
+
+def _after_request(response):
+    profile_id = _finish_request_profile()
+    if profile_id is not None:
+        response.headers['X-Profile-Id'] = profile_id
+    return response
+
+
+def _teardown_request(exception=None):
+    # 视图抛出异常时不会执行 after_request，在这里结束分析 (结果仍然保存，只是响应中没有 id)
+    _finish_request_profile()
+
+
+def init_app(app):
+    """注册采样接口和 X-Profile 请求钩子"""
+    app.config.setdefault('PROFILER_TOKEN', os.environ.get('PROFILER_TOKEN'))
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/admin/profile', 'start_profile', start_profile, methods=['POST'])
+    app.add_url_rule('/admin/profile/<profile_id>', 'get_profile', get_profile, methods=['GET'])
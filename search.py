@@ -0,0 +1,174 @@
+from flask import Blueprint, request, jsonify
+from flask_login import login_required, current_user
+import html
+import re
+from database import get_db
+import bigrams
+
+# --- 全文检索 ---
+# 记录 (内容、完成感想) 只在当前用户自己的数据中检索，帖子和评论在所有人可见的动态中检索。
+# 索引表见 migrations.py (FTS5 + trigram 分词)，按 bm25 相关度排序并返回高亮片段。
+# trigram 无法匹配少于 3 个字符的词 (如 "牛奶")，含有这种词的查询改用二元组索引 (见 bigrams.py)，
+# 片段在 Python 中从原文生成。
+
+search_bp = Blueprint('search_bp', __name__)
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_TYPES = ('all', 'records', 'posts')
+SNIPPET_TOKENS = 32      # FTS 片段的长度 (trigram 下约等于字符数)
+SNIPPET_CHARS = 24       # 二元组索引命中时匹配位置前后保留的字符数
+
+# snippet() 用控制字符标记匹配位置，转义 HTML 之后再替换为 <mark>，避免用户内容注入标签
+_MARK_START = '\x02'
+_MARK_END = '\x03'
+
+
+def _parse_terms(q):
+    return q.split()[:8]
+
+
+def _match_expression(terms):
+    """每个词作为一个短语 (双引号转义)，多个词之间为 AND"""
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def _render_snippet(text):
+    escaped = html.escape(text or '')
+    return escaped.replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def _highlight(text, terms):
+    """二元组索引不保存原文，在 Python 中生成与 snippet() 相同格式的片段"""
+    text = text or ''
+    lowered = text.lower()
+    positions = [lowered.find(term.lower()) for term in terms]
+    positions = [pos for pos in positions if pos >= 0]
+    start = max(0, min(positions) - SNIPPET_CHARS) if positions else 0
+    end = min(len(text), (max(positions) if positions else 0) + SNIPPET_CHARS * 2)
+    excerpt = text[start:end]
+    pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+    parts, last = [], 0
+    for match in pattern.finditer(excerpt):
+        parts.append(html.escape(excerpt[last:match.start()]))
+        parts.append(f"<mark>{html.escape(match.group())}</mark>")
+        last = match.end()
+    parts.append(html.escape(excerpt[last:]))
+    return ('…' if start > 0 else '') + ''.join(parts) + ('…' if end < len(text) else '')
+
+
+def _fts_queries(search_type):
+    """返回各类结果的 SQL，结果列相同，可以用 UNION ALL 合并后统一排序"""
+    snippet = f"'{_MARK_START}', '{_MARK_END}', '…', {SNIPPET_TOKENS}"
+    queries = []
+    if search_type in ('all', 'records'):
+        queries.append(f"""
+            SELECT 'record' AS type, r.id AS id, NULL AS post_id, r.category AS category, r.date AS date,
+                   snippet(records_fts, -1, {snippet}) AS snippet, bm25(records_fts, 1.0, 0.5) AS rank
+            FROM records_fts JOIN records r ON r.id = records_fts.rowid
+            WHERE records_fts MATCH :match AND r.user_id = :user_id
+        """)
+    if search_type in ('all', 'posts'):
+        queries.append(f"""
+            SELECT 'post' AS type, p.id AS id, p.id AS post_id, NULL AS category, p.timestamp AS date,
+                   snippet(posts_fts, 0, {snippet}) AS snippet, bm25(posts_fts) AS rank
+            FROM posts_fts JOIN posts p ON p.id = posts_fts.rowid JOIN users u ON u.id = p.user_id
+            WHERE posts_fts MATCH :match AND u.deleted_at IS NULL
+        """)
+        queries.append(f"""
+            SELECT 'comment' AS type, c.id AS id, c.post_id AS post_id, NULL AS category, c.timestamp AS date,
+                   snippet(comments_fts, 0, {snippet}) AS snippet, bm25(comments_fts) AS rank
+            FROM comments_fts JOIN comments c ON c.id = comments_fts.rowid JOIN users u ON u.id = c.user_id
+            WHERE comments_fts MATCH :match AND u.deleted_at IS NULL
+        """)
+    return queries
+
+
+def _bigram_queries(search_type):
+    """短词查询: 与 _fts_queries 相同，但使用二元组索引，snippet 列返回原文"""
+    queries = []
+    if search_type in ('all', 'records'):
+        queries.append("""
+            SELECT 'record' AS type, r.id AS id, NULL AS post_id, r.category AS category, r.date AS date,
+                   COALESCE(r.content, '') || ' ' || COALESCE(r.completion_notes, '') AS snippet,
+                   bm25(records_bigram, 1.0, 0.5) AS rank
+            FROM records_bigram JOIN records r ON r.id = records_bigram.rowid
+            WHERE records_bigram MATCH :match AND r.user_id = :user_id
+        """)
+    if search_type in ('all', 'posts'):
+        queries.append("""
+            SELECT 'post' AS type, p.id AS id, p.id AS post_id, NULL AS category, p.timestamp AS date,
+                   p.content AS snippet, bm25(posts_bigram) AS rank
+            FROM posts_bigram JOIN posts p ON p.id = posts_bigram.rowid JOIN users u ON u.id = p.user_id
+            WHERE posts_bigram MATCH :match AND u.deleted_at IS NULL
+        """)
+        queries.append("""
+            SELECT 'comment' AS type, c.id AS id, c.post_id AS post_id, NULL AS category, c.timestamp AS date,
+                   c.content AS snippet, bm25(comments_bigram) AS rank
+            FROM comments_bigram JOIN comments c ON c.id = comments_bigram.rowid JOIN users u ON u.id = c.user_id
+            WHERE comments_bigram MATCH :match AND u.deleted_at IS NULL
+        """)
+    return queries
+
+
+def search(cursor, user_id, q, search_type='all', limit=SEARCH_PAGE_SIZE, offset=0):
+    """执行检索，返回 (results, next_offset)"""
+    terms = _parse_terms(q)
+    if not terms:
+        return [], None
+    params = {"user_id": user_id, "limit": limit + 1, "offset": offset}
+    use_fts = all(len(term) >= 3 for term in terms)
+    if use_fts:
+        queries = _fts_queries(search_type)
+        params['match'] = _match_expression(terms)
+    else:
+        params['match'] = bigrams.match_expression(terms)
+        if params['match'] is None:
+            # 只有标点等不会被索引的字符
+            return [], None
+        queries = _bigram_queries(search_type)
+    # 多取一条用于判断是否还有下一页
+    cursor.execute(
+        ' UNION ALL '.join(queries) + " ORDER BY rank, date DESC, id DESC LIMIT :limit OFFSET :offset",
+        params
+    )
+    results = []
+    for row in cursor.fetchall():
+        result = dict(row)
+        del result['rank']
+        if use_fts:
+            result['snippet'] = _render_snippet(result['snippet'])
+        else:
+            result['snippet'] = _highlight(result['snippet'], terms)
+        if result['type'] != 'record':
+            del result['category']
+        results.append(result)
+
+    next_offset = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_offset = offset + limit
+    return results, next_offset
+
+
+@search_bp.route('/api/search', methods=['GET'])
+@login_required
+def search_api():
+    """
+    全文检索。
+    查询参数: q=<关键词，空格分隔>, type=all|records|posts, limit=<每页数量>, offset=<上一页返回的 next_offset>
+    """
+    q = request.args.get('q', '').strip()
+    search_type = request.args.get('type', 'all')
+    if not q:
+        return jsonify({"error": "搜索内容不能为空"}), 400
+    if search_type not in SEARCH_TYPES:
+        return jsonify({"error": "无效的搜索类型"}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_PAGE_SIZE)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({"error": "无效的分页参数"}), 400
+
+    results, next_offset = search(get_db().cursor(), current_user.id, q, search_type, limit, offset)
+    return jsonify({"results": results, "next_offset": next_offset})
@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+from flask import has_request_context, request
+
+# --- 慢查询日志 ---
+# metrics.Cursor 执行的每条语句结束时 (结果取完、游标关闭或释放) 在这里按 execute 和 fetch 的总耗时检查: 超过 SLOW_QUERY_MS 毫秒，或按 SLOW_QUERY_SAMPLE
+# 的比例随机抽中的语句，连同 EXPLAIN QUERY PLAN 的结果写入按大小轮转的 JSONL 日志，例如:
+#   {"ts": "...", "route": "get_records", "sql": "SELECT ... WHERE category = ? ...",
+#    "params": ["int", "str"], "duration_ms": 153.2, "plan": ["SCAN records", ...]}
+# SQL 中的空白和 IN (?, ?, ...) 列表被归一化，相同的查询可以直接分组统计；参数只记录类型，不记录值。
+# 只有被记录的语句才会执行 EXPLAIN，未命中时的开销只是一次比较。
+#
+# 配置 (环境变量):
+#   SLOW_QUERY_MS      记录阈值 (毫秒)，默认 100，0 表示不按耗时记录
+#   SLOW_QUERY_SAMPLE  随机记录的比例 (0~1)，默认 0
+#   SLOW_QUERY_LOG     日志文件，默认 slow_queries.jsonl (相对于当前工作目录)
+
+THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+SAMPLE_RATE = float(os.environ.get('SLOW_QUERY_SAMPLE', 0))
+LOG_PATH = os.environ.get('SLOW_QUERY_LOG', 'slow_queries.jsonl')
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+ENABLED = THRESHOLD_MS > 0 or SAMPLE_RATE > 0
+
+# 只有这些语句可以 EXPLAIN (BEGIN、COMMIT、PRAGMA 等没有查询计划)
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+_logger = None
+_logger_lock = threading.Lock()
+
+
+def _get_logger():
+    global _logger
+    if _logger is None:
+        with _logger_lock:
+            if _logger is None:
+                logger = logging.getLogger('slow_queries')
+                logger.propagate = False
+                logger.setLevel(logging.INFO)
+                handler = RotatingFileHandler(LOG_PATH, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                              encoding='utf-8', delay=True)
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                logger.addHandler(handler)
+                _logger = logger
+    return _logger
+
+
+def normalize_sql(sql):
+    """合并空白，把 IN (?, ?, ...) 统一为 IN (?...)，使参数个数不同的同一个查询归为一类"""
+    return _IN_LIST.sub('(?...)', _WHITESPACE.sub(' ', sql).strip())
+
+
+def parameter_shape(parameters):
+    """参数的类型 (不含值): 位置参数为列表，命名参数为字典"""
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    return [type(value).__name__ for value in parameters or ()]
+
+
+def explain(conn, sql, parameters):
+    """返回 EXPLAIN QUERY PLAN 的每一行 (按层级缩进)，无法 EXPLAIN 时返回 None"""
+    if not _EXPLAINABLE.match(sql):
+        return None
+    try:
+        # 使用基础游标，避免再次进入统计和慢查询检查
+        rows = sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error as e:
+        return [f"EXPLAIN failed: {e}"]
+    depth = {0: 0}
+    plan = []
+    for row in rows:
+        node_id, parent_id, detail = row[0], row[1], row[3]
+        depth[node_id] = depth.get(parent_id, 0) + 1
+        plan.append('  ' * (depth[node_id] - 1) + detail)
+    return plan
+
+
+def check(conn, sql, parameters, elapsed, many=False):
+    """语句结束后调用 (elapsed 包含 execute 和各次 fetch 的耗时)；需要记录时执行 EXPLAIN 并写入日志"""
+    duration_ms = elapsed * 1000
+    slow = THRESHOLD_MS > 0 and duration_ms >= THRESHOLD_MS
+    if not slow and not (SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE):
+        return
+    # executemany 用第一组参数 EXPLAIN
+    if many:
+        parameters = next(iter(parameters), ()) if isinstance(parameters, (list, tuple)) else ()
+    entry = {
+        "ts": time.strftime('%Y-%m-%d %H:%M:%S'),
+        "pid": os.getpid(),
+        "route": request.endpoint if has_request_context() else threading.current_thread().name,
+        "sql": normalize_sql(sql),
+        "params": parameter_shape(parameters),
+        "many": many,
+        "duration_ms": round(duration_ms, 3),
+        "reason": 'slow' if slow else 'sampled',
+        "plan": explain(conn, sql, parameters),
+    }
+    try:
+        _get_logger().info(json.dumps(entry, ensure_ascii=False))
+    except Exception as e:
+        # 日志写入失败不影响请求
+        print(f"Error writing slow query log: {e}")
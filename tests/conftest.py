@@ -0,0 +1,27 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """在临时目录中启动应用 (database.db、上传文件和日志都写在这里)"""
+    os.chdir(tmp_path_factory.mktemp('app'))
+    from app import create_app
+    flask_app = create_app()
+    flask_app.config['TESTING'] = True
+    return flask_app
+
+
+@pytest.fixture
+def login(app):
+    """返回一个函数: 注册 (如果需要) 并登录用户，得到该用户的测试客户端"""
+    def _login(username, password='password'):
+        client = app.test_client()
+        client.post('/register', json={'username': username, 'password': password})
+        response = client.post('/login', json={'username': username, 'password': password})
+        assert response.status_code == 200, response.get_data(as_text=True)
+        return client
+    return _login
@@ -0,0 +1,52 @@
+import database
+
+
+def query(sql, parameters=()):
+    conn = database.connect()
+    try:
+        return conn.execute(sql, parameters).fetchall()
+    finally:
+        conn.close()
+
+
+def batch(client, operations):
+    response = client.post('/api/records/batch', json={'operations': operations})
+    return response.status_code, response.get_json()
+
+
+def test_invalid_ops_are_reported_per_op(login):
+    client = login('batch_invalid')
+    status, body = batch(client, [
+        {'op': 'create', 'data': {'category': 'general', 'content': 'a', 'person_id': [1]}},
+        {'op': 'bogus'},
+        {'op': 'delete', 'id': 'x'},
+        {'op': 'create', 'data': {'category': 'general', 'content': 'b'}},
+    ])
+    assert status == 400
+    assert [(r['status'], r.get('error')) for r in body['results']] == [
+        ('error', '无效的人物ID'),
+        ('error', '未知的操作类型'),
+        ('error', '无效的记录ID'),
+        ('skipped', None),
+    ]
+
+
+def test_ops_are_applied_grouped_by_kind(login):
+    client = login('batch_order')
+    assert client.post('/api/records', json={
+        'category': 'medicine', 'content': '钙片', 'style': '片剂', 'color': '白色',
+        'total_quantity': 10, 'refill_quantity': 30,
+    }).status_code == 201
+    medicine_id = query("SELECT id FROM records WHERE category = 'medicine' ORDER BY id DESC LIMIT 1")[0]['id']
+    assert client.put(f'/api/records/{medicine_id}/purchase', json={'needs_purchase': True}).status_code == 200
+    item_id = query("SELECT id FROM records WHERE source_record_id = ?", (medicine_id,))[0]['id']
+
+    # status 写在 update 之前提交，但 update 先执行: 完成购物项时按新的补充数量 50 增加库存
+    status, body = batch(client, [
+        {'op': 'status', 'id': item_id, 'status': 'completed'},
+        {'op': 'update', 'id': medicine_id, 'data': {
+            'content': '钙片', 'person_id': None, 'style': '片剂', 'color': '白色', 'refill_quantity': 50,
+        }},
+    ])
+    assert status == 200, body
+    assert query("SELECT total_quantity FROM records WHERE id = ?", (medicine_id,))[0]['total_quantity'] == 60
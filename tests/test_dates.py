@@ -0,0 +1,28 @@
+import pytest
+import dates
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('09:05', '09:05'),
+    ('9:05', '09:05'),
+    (' 9:05 ', '09:05'),
+    ('21:30:15', '21:30'),
+    ('', None),
+    (None, None),
+])
+def test_normalize_time(value, expected):
+    assert dates.normalize_time(value) == expected
+
+
+@pytest.mark.parametrize('value', ['9', '25:00', '9:5x', 'noon'])
+def test_normalize_time_rejects_invalid(value):
+    with pytest.raises(ValueError):
+        dates.normalize_time(value)
+
+
+def test_record_accepts_time_without_leading_zero(login):
+    client = login('short_time')
+    response = client.post('/api/records', json={'category': 'general', 'content': '吃药', 'date': '2026-10-20', 'time': '9:05'})
+    assert response.status_code == 201, response.get_data(as_text=True)
+    records = client.get('/api/records?category=general').get_json()
+    assert [r['time'] for r in records if r['content'] == '吃药'] == ['09:05']
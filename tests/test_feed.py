@@ -0,0 +1,42 @@
+import database
+
+
+def feed_post(client, post_id):
+    posts = client.get('/api/posts').get_json()['posts']
+    return next(post for post in posts if post['id'] == post_id)
+
+
+def test_counts_exclude_tombstoned_users(login):
+    from app import purge_account
+
+    author = login('feed_author')
+    assert author.post('/api/posts', data={'content': 'hello'}).status_code in (200, 201)
+    conn = database.connect()
+    try:
+        post_id = conn.execute("SELECT id FROM posts ORDER BY id DESC LIMIT 1").fetchone()['id']
+    finally:
+        conn.close()
+
+    stays, leaves = login('feed_stays'), login('feed_leaves')
+    for client in (stays, leaves, leaves):
+        assert client.post(f'/api/posts/{post_id}/comments', json={'content': 'nice'}).status_code in (200, 201)
+    for client in (stays, leaves):
+        assert client.post(f'/api/posts/{post_id}/like').status_code == 200
+    leaver_id = leaves.get('/api/user/current').get_json()['id']
+
+    post = feed_post(author, post_id)
+    assert (post['comment_count'], len(post['comments']), post['like_count']) == (3, 3, 2)
+
+    # 注销后评论立即从动态中消失，计数同时扣除
+    assert leaves.delete('/api/user/delete').status_code == 200
+    post = feed_post(author, post_id)
+    assert (post['comment_count'], len(post['comments']), post['like_count']) == (1, 1, 1)
+
+    # 后台删除这些行时不再重复扣除
+    conn = database.connect()
+    try:
+        purge_account(conn, {"user_id": leaver_id})
+    finally:
+        conn.close()
+    post = feed_post(author, post_id)
+    assert (post['comment_count'], len(post['comments']), post['like_count']) == (1, 1, 1)
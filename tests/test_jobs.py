@@ -0,0 +1,52 @@
+import time
+import database
+import jobs
+
+
+def test_recurring_job_is_rescheduled_after_final_failure(app):
+    calls = []
+
+    @jobs.handler('test_recurring_failure', every=3600)
+    def always_fails(conn, payload):
+        calls.append(payload)
+        raise RuntimeError("boom")
+
+    conn = database.connect()
+    try:
+        job_id = jobs.enqueue(conn.cursor(), 'test_recurring_failure', {})
+        # 这已经是最后一次尝试
+        conn.execute("UPDATE jobs SET attempts = ? WHERE id = ?", (jobs.MAX_ATTEMPTS - 1, job_id))
+        conn.commit()
+        jobs.run_pending()
+
+        # 后台调度线程也可能认领这个任务，等它结束
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            status = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()['status']
+            if status == 'failed':
+                break
+            time.sleep(0.05)
+        assert status == 'failed'
+        pending = conn.execute(
+            "SELECT run_after FROM jobs WHERE kind = 'test_recurring_failure' AND status = 'pending'"
+        ).fetchall()
+        assert len(pending) == 1 and pending[0]['run_after'] > time.time() + 3000
+    finally:
+        conn.execute("DELETE FROM jobs WHERE kind = 'test_recurring_failure'")
+        conn.commit()
+        conn.close()
+        jobs._handlers.pop('test_recurring_failure', None)
+        jobs._recurring.pop('test_recurring_failure', None)
+
+
+def test_recurring_jobs_are_ensured_once(app):
+    conn = database.connect()
+    try:
+        conn.execute("DELETE FROM jobs WHERE kind = 'collect_uploads'")
+        conn.commit()
+        jobs._ensure_recurring(conn)
+        jobs._ensure_recurring(conn)
+        rows = conn.execute("SELECT status FROM jobs WHERE kind = 'collect_uploads'").fetchall()
+        assert [row['status'] for row in rows] == ['pending']
+    finally:
+        conn.close()
@@ -0,0 +1,16 @@
+def test_metrics_requires_token(app):
+    client = app.test_client()
+    try:
+        # 未设置 METRICS_TOKEN 时不开放
+        app.config['METRICS_TOKEN'] = None
+        assert client.get('/metrics').status_code == 404
+
+        app.config['METRICS_TOKEN'] = 'secret'
+        assert client.get('/metrics').status_code == 401
+        assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+        assert client.get('/metrics', headers={'Authorization': 'Bearer 密钥'}).status_code == 401
+        response = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+        assert response.status_code == 200
+        assert 'http_requests_total' in response.get_data(as_text=True)
+    finally:
+        app.config['METRICS_TOKEN'] = None
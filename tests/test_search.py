@@ -0,0 +1,37 @@
+import database
+
+
+def search_ids(client, q):
+    response = client.get('/api/search', query_string={'q': q, 'type': 'posts'})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return [(result['type'], result['id']) for result in response.get_json()['results']]
+
+
+def test_short_terms_use_bigram_index(login):
+    client = login('search_short')
+    assert client.post('/api/posts', data={'content': '今天喝了牛奶 OK'}).status_code in (200, 201)
+    conn = database.connect()
+    try:
+        post_id = conn.execute("SELECT id FROM posts ORDER BY id DESC LIMIT 1").fetchone()['id']
+    finally:
+        conn.close()
+    post = ('post', post_id)
+
+    # 1 个和 2 个字符的词，包括词尾的字符和大小写不同的英文
+    for q in ('牛奶', '奶', '喝 天', 'ok', '今天喝了牛奶'):
+        assert post in search_ids(client, q), q
+    for q in ('奶牛', '牛奶 咖啡', '天喝牛', 'ko'):
+        assert post not in search_ids(client, q), q
+
+    response = client.get('/api/search', query_string={'q': '牛奶', 'type': 'posts'})
+    snippet = next(r['snippet'] for r in response.get_json()['results'] if r['id'] == post_id)
+    assert '<mark>牛奶</mark>' in snippet
+
+    # 修改和删除后索引同步更新
+    assert client.put(f'/api/posts/{post_id}', data={
+        'content': '改喝咖啡', 'timestamp': '2024-01-01 08:00:00'
+    }).status_code == 200
+    assert post not in search_ids(client, '牛奶')
+    assert post in search_ids(client, '咖啡')
+    assert client.delete(f'/api/posts/{post_id}').status_code == 200
+    assert post not in search_ids(client, '咖啡')
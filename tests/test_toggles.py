@@ -0,0 +1,93 @@
+import threading
+import pytest
+import database
+
+THREADS = 8
+ROUNDS = 5
+
+
+def run_parallel(clients, action):
+    """每个客户端一个线程，同时开始执行 action(client)，返回所有响应"""
+    barrier = threading.Barrier(len(clients))
+    responses = []
+    lock = threading.Lock()
+
+    def worker(client):
+        barrier.wait()
+        result = action(client)
+        with lock:
+            responses.extend(result if isinstance(result, list) else [result])
+
+    threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return responses
+
+
+def query(sql, parameters=()):
+    conn = database.connect()
+    try:
+        return conn.execute(sql, parameters).fetchall()
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def medicine(login):
+    """一个带补充数量的药品，返回 (客户端列表, 药品 id)；所有客户端是同一个用户"""
+    clients = [login('toggle_owner') for _ in range(THREADS)]
+    response = clients[0].post('/api/records', json={
+        'category': 'medicine', 'content': '维生素', 'style': '片剂', 'color': '白色',
+        'total_quantity': 10, 'refill_quantity': 30,
+    })
+    assert response.status_code == 201, response.get_data(as_text=True)
+    rows = query("SELECT id FROM records WHERE category = 'medicine' ORDER BY id DESC LIMIT 1")
+    return clients, rows[0]['id']
+
+
+def test_parallel_likes_keep_like_count_consistent(login):
+    author = login('like_author')
+    assert author.post('/api/posts', data={'content': 'hello'}).status_code in (200, 201)
+    post_id = query("SELECT id FROM posts ORDER BY id DESC LIMIT 1")[0]['id']
+
+    # 每个用户点赞奇数次 (最终为已点赞)，另外一个用户的多个客户端同时反复点赞
+    clients = [login(f'liker{i}') for i in range(THREADS)]
+    spammer = [login('like_spammer') for _ in range(4)]
+    responses = run_parallel(clients + spammer, lambda client: [
+        client.post(f'/api/posts/{post_id}/like') for _ in range(ROUNDS)
+    ])
+    assert all(r.status_code == 200 for r in responses), [r.get_data(as_text=True) for r in responses if r.status_code != 200]
+
+    likes = query("SELECT COUNT(*) AS n FROM likes WHERE post_id = ?", (post_id,))[0]['n']
+    like_count = query("SELECT like_count FROM posts WHERE id = ?", (post_id,))[0]['like_count']
+    assert like_count == likes
+    # 普通用户各点赞 5 次 → 已点赞；spammer 共 20 次 → 未点赞
+    assert likes == THREADS
+
+
+def test_parallel_purchase_toggles_create_one_shopping_item(medicine):
+    clients, medicine_id = medicine
+    responses = run_parallel(clients, lambda client: client.put(
+        f'/api/records/{medicine_id}/purchase', json={'needs_purchase': True}
+    ))
+    assert all(r.status_code == 200 for r in responses)
+
+    items = query("SELECT id FROM records WHERE category = 'shopping' AND source_record_id = ?", (medicine_id,))
+    assert len(items) == 1
+
+
+def test_parallel_completes_apply_refill_once(medicine):
+    clients, medicine_id = medicine
+    assert clients[0].put(f'/api/records/{medicine_id}/purchase', json={'needs_purchase': True}).status_code == 200
+    item_id = query("SELECT id FROM records WHERE category = 'shopping' AND source_record_id = ?", (medicine_id,))[0]['id']
+    before = query("SELECT total_quantity FROM records WHERE id = ?", (medicine_id,))[0]['total_quantity']
+
+    responses = run_parallel(clients, lambda client: client.put(
+        f'/api/records/{item_id}/status', json={'status': 'completed'}
+    ))
+    assert all(r.status_code == 200 for r in responses)
+
+    after = query("SELECT total_quantity FROM records WHERE id = ?", (medicine_id,))[0]['total_quantity']
+    assert after == before + 30
@@ -0,0 +1,42 @@
+import json
+
+
+def run_import(client, lines):
+    body = ''.join(json.dumps(line, ensure_ascii=False) + '\n' for line in lines)
+    response = client.post('/api/import', data=body.encode('utf-8'), content_type='application/x-ndjson')
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_rows_with_wrong_field_types_are_skipped(login):
+    client = login('import_types')
+    results = run_import(client, [
+        {"kind": "person", "name": "小明"},
+        {"kind": "record", "content": {"a": 1}},
+        {"kind": "post", "content": "hi", "timestamp": 5},
+        {"kind": "record", "content": "买牛奶", "category": "shopping", "person_name": ["x"]},
+        {"kind": "post", "content": "hello"},
+    ])
+    errors = [r['line'] for r in results if 'error' in r and 'imported' not in r]
+    assert errors == [2, 3, 4]
+    assert results[-1] == {"line": 5, "imported": {"person": 1, "record": 0, "post": 1}, "errors": 3, "done": True}
+
+    # 无效的行不影响同一批中的其他行
+    assert [p['name'] for p in client.get('/api/people').get_json()] == ['小明']
+    exported = [json.loads(line) for line in client.get('/api/export').get_data(as_text=True).splitlines()]
+    assert [(e['kind'], e.get('content')) for e in exported if e['kind'] == 'post'] == [('post', 'hello')]
+
+
+def test_round_trip(login):
+    source = login('export_source')
+    source.post('/api/people', json={'name': '奶奶'})
+    source.post('/api/records', json={'category': 'general', 'content': '复诊', 'date': '2026-10-20', 'time': '9:00'})
+    exported = source.get('/api/export').get_data()
+
+    target = login('import_target')
+    response = target.post('/api/import', data=exported, content_type='application/x-ndjson')
+    summary = json.loads(response.get_data(as_text=True).splitlines()[-1])
+    assert summary['done'] and summary['errors'] == 0
+    assert summary['imported']['person'] == 1 and summary['imported']['record'] == 1
+    records = target.get('/api/records?category=general').get_json()
+    assert [(r['content'], r['date'], r['time']) for r in records] == [('复诊', '2026-10-20', '09:00')]
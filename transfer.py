@@ -0,0 +1,388 @@
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+from flask_login import login_required, current_user
+from contextlib import contextmanager
+import codecs
+import csv
+import io
+import json
+import sqlite3
+from database import get_db
+import dates
+import upload_store
+
+# --- 数据导入导出 ---
+# 导出: GET /api/export?format=jsonl            当前用户的人物、记录和帖子，每行一个 JSON 对象 ({"kind": "person"|"record"|"post", ...}；记录本身有 type 字段，这里用 kind 区分)
+#       GET /api/export?format=csv&type=records 单一类型的 CSV (type 为 people、records 或 posts)
+# 导入: POST /api/import?format=jsonl           请求体为导出的 JSONL 文件本身 (如 curl --data-binary @export.jsonl)
+#       POST /api/import?format=csv&type=records
+#
+# 导出在一个读事务中 (WAL 快照，各表一致) 用游标分块读取，边读边发送，不在内存中构建完整列表。
+# 导入逐行解析请求体，每读满 IMPORT_BATCH_SIZE 行后在一个事务中写入并提交，每次提交后输出一行进度 JSON:
+#   {"line": 500, "imported": {"person": 3, "record": 497, "post": 0}, "errors": 0}
+# 最后一行带 "done": true；无效的行被跳过，以 {"line": n, "error": ...} 报告，不影响其他行。
+# 记录通过 person_name 关联人物 (不存在时创建)，source_record_id 按同一文件中的旧 id 映射到新记录。
+
+transfer_bp = Blueprint('transfer_bp', __name__)
+
+EXPORT_CHUNK_SIZE = 500
+IMPORT_BATCH_SIZE = 500
+MAX_LINE_BYTES = 1024 * 1024
+EXPORT_TYPES = ('people', 'records', 'posts')
+RECORD_CATEGORIES = ('general', 'shopping', 'clothes', 'medicine')
+
+# 导出和导入的记录字段 (不含 id、user_id、person_id，人物用 person_name 表示)
+RECORD_FIELDS = (
+    'category', 'content', 'date', 'time', 'urgency', 'status', 'quantity', 'unit', 'brand', 'type', 'color',
+    'frequency', 'style', 'needs_purchase', 'dosage', 'total_quantity', 'start_date', 'refill_quantity',
+    'reminder_threshold', 'source_record_id', 'completion_notes',
+)
+_INTEGER_FIELDS = ('needs_purchase', 'total_quantity', 'refill_quantity', 'reminder_threshold', 'source_record_id')
+
+CSV_COLUMNS = {
+    'people': ('id', 'name'),
+    'records': ('id', *RECORD_FIELDS, 'person_name'),
+    'posts': ('id', 'content', 'timestamp'),
+}
+
+
+# --- 导出 ---
+
+def _export_rows(cursor, user_id, export_type):
+    """按块读取某一类数据，逐个产生字典；记录和帖子附带照片路径"""
+    if export_type == 'people':
+        cursor.execute("SELECT id, name FROM people WHERE user_id = ? ORDER BY id", (user_id,))
+    elif export_type == 'records':
+        columns = ', '.join(f"r.{field}" for field in RECORD_FIELDS)
+        cursor.execute(f"""
+            SELECT r.id, {columns}, p.name AS person_name
+            FROM records r LEFT JOIN people p ON p.id = r.person_id
+            WHERE r.user_id = ? ORDER BY r.id
+        """, (user_id,))
+    else:
+        cursor.execute("SELECT id, content, timestamp FROM posts WHERE user_id = ? ORDER BY id", (user_id,))
+
+    owner_kind = {'records': 'completion', 'posts': 'post'}.get(export_type)
+    photo_cursor = cursor.connection.cursor()
+    while True:
+        rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+        if not rows:
+            return
+        photos = upload_store.load_photos(photo_cursor, owner_kind, [row['id'] for row in rows]) if owner_kind else {}
+        for row in rows:
+            item = dict(row)
+            if owner_kind:
+                item['photos'] = photos[row['id']]
+            yield item
+
+
+@contextmanager
+def _snapshot(conn):
+    """在一个读事务中依次读取，导出的各表来自同一个快照"""
+    conn.execute("BEGIN")
+    try:
+        yield conn.cursor()
+    finally:
+        conn.rollback()
+
+
+def _export_jsonl(conn, user_id):
+    kind_names = {'people': 'person', 'records': 'record', 'posts': 'post'}
+    with _snapshot(conn) as cursor:
+        for export_type in EXPORT_TYPES:
+            chunk = []
+            for item in _export_rows(cursor, user_id, export_type):
+                chunk.append(json.dumps({"kind": kind_names[export_type], **item}, ensure_ascii=False))
+                if len(chunk) >= EXPORT_CHUNK_SIZE:
+                    yield '\n'.join(chunk) + '\n'
+                    chunk = []
+            if chunk:
+                yield '\n'.join(chunk) + '\n'
+
+
+def _export_csv(conn, user_id, export_type):
+    columns = CSV_COLUMNS[export_type]
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    with _snapshot(conn) as cursor:
+        for count, item in enumerate(_export_rows(cursor, user_id, export_type), 1):
+            writer.writerow(item)
+            if count % EXPORT_CHUNK_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    yield buffer.getvalue()
+
+
+@transfer_bp.route('/api/export', methods=['GET'])
+@login_required
+def export_data():
+    """
+    导出当前用户的数据。
+    查询参数: format=jsonl|csv, type=people|records|posts (CSV 必填)
+    """
+    export_format = request.args.get('format', 'jsonl')
+    export_type = request.args.get('type')
+    user_id = current_user.id
+    conn = get_db()
+    if export_format == 'jsonl':
+        body, mimetype, filename = _export_jsonl(conn, user_id), 'application/x-ndjson', 'export.jsonl'
+    elif export_format == 'csv':
+        if export_type not in EXPORT_TYPES:
+            return jsonify({"error": "CSV 导出需要指定 type (people、records 或 posts)"}), 400
+        body, mimetype, filename = _export_csv(conn, user_id, export_type), 'text/csv', f"{export_type}.csv"
+    else:
+        return jsonify({"error": "无效的导出格式"}), 400
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+# --- 导入 ---
+
+def _input_lines(stream):
+    """逐行读取请求体 (字节，未解码)，单行过长时抛出 ValueError"""
+    first = True
+    while True:
+        line = stream.readline(MAX_LINE_BYTES)
+        if not line:
+            return
+        if len(line) >= MAX_LINE_BYTES and not line.endswith(b'\n'):
+            raise ValueError("单行内容过长")
+        if first:
+            line = line.removeprefix(codecs.BOM_UTF8)
+            first = False
+        yield line
+
+
+def _jsonl_items(lines):
+    # 每行单独解码，编码错误只影响这一行
+    for line in lines:
+        line = line.strip()
+        if not line:
+            yield None
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            yield ValueError("无效的 JSON")
+            continue
+        yield item if isinstance(item, dict) else ValueError("每行必须是一个 JSON 对象")
+
+
+def _csv_items(lines, import_type):
+    kind = {'people': 'person', 'records': 'record', 'posts': 'post'}[import_type]
+    # csv 模块按需从迭代器取行，引号中的换行也能正确处理
+    for row in csv.DictReader(line.decode('utf-8') for line in lines):
+        item = {key: (value if value != '' else None) for key, value in row.items() if key}
+        yield {**item, "kind": kind}
+
+
+def _text(item, field):
+    """
+    取出文本字段，空值返回 None；数字按原样转为文本，对象、数组和布尔值视为无效。
+    **关键修复**: 绑定到 SQL 之前检查类型，类型错误的行只报告为该行的错误。
+    """
+    value = item.get(field)
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    raise ValueError(f"字段 {field} 的类型无效")
+
+
+def _to_int(value):
+    if value is None or isinstance(value, int):
+        return value
+    return int(str(value).strip())
+
+
+class _Importer:
+    """按行导入，记住本次导入中旧 id 与新 id 的对应关系和人物名称"""
+
+    def __init__(self, cursor, user_id):
+        self.cursor = cursor
+        self.user_id = user_id
+        self.record_ids = {}
+        self.people = {}
+        self.counts = {"person": 0, "record": 0, "post": 0}    # 当前批次中 (尚未提交) 导入的行数
+        self._added = []       # 当前行加入映射的 (字典, 键)，该行回滚时一并移除
+
+    def person_id(self, name):
+        if not name:
+            return None
+        if name not in self.people:
+            self.cursor.execute(
+                "INSERT INTO people (user_id, name) VALUES (?, ?) ON CONFLICT(user_id, name) DO NOTHING",
+                (self.user_id, name)
+            )
+            self.cursor.execute("SELECT id FROM people WHERE user_id = ? AND name = ?", (self.user_id, name))
+            self.people[name] = self.cursor.fetchone()['id']
+            self._added.append((self.people, name))
+        return self.people[name]
+
+    def add(self, item):
+        """导入一行；每行一个保存点，无效的行只回滚它自己 (连同本行加入的 id 映射)"""
+        self._added = []
+        self.cursor.execute("SAVEPOINT import_row")
+        try:
+            self._add(item)
+        except Exception:
+            self.cursor.execute("ROLLBACK TO import_row")
+            for mapping, key in self._added:
+                mapping.pop(key, None)
+            raise
+        finally:
+            self.cursor.execute("RELEASE import_row")
+
+    def _add(self, item):
+        kind = item.get('kind')
+        if kind == 'person':
+            name = _text(item, 'name')
+            if not name:
+                raise ValueError("缺少人物名称")
+            self.person_id(name)
+        elif kind == 'record':
+            self._add_record(item)
+        elif kind == 'post':
+            self._add_post(item)
+        else:
+            raise ValueError("无效的类型")
+        self.counts[kind] += 1
+
+    def _add_record(self, item):
+        values = {field: item.get(field) if field in _INTEGER_FIELDS else _text(item, field) for field in RECORD_FIELDS}
+        if not values['content']:
+            raise ValueError("缺少记录内容")
+        if (values['category'] or 'general') not in RECORD_CATEGORIES:
+            raise ValueError("无效的记录类别")
+        values['category'] = values['category'] or 'general'
+        values['status'] = values['status'] if values['status'] in ('pending', 'completed') else 'pending'
+        dates.normalize_record_fields(values)
+        for field in _INTEGER_FIELDS:
+            values[field] = _to_int(values[field])
+        values['needs_purchase'] = values['needs_purchase'] or 0
+        # 来源药品只在同一次导入中出现过时才能关联
+        values['source_record_id'] = self.record_ids.get(values['source_record_id'])
+        columns = ('user_id', 'person_id', *RECORD_FIELDS)
+        self.cursor.execute(
+            f"INSERT INTO records ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) RETURNING id",
+            (self.user_id, self.person_id(_text(item, 'person_name')), *(values[field] for field in RECORD_FIELDS))
+        )
+        new_id = self.cursor.fetchone()['id']
+        if item.get('id') is not None:
+            old_id = _to_int(item['id'])
+            self.record_ids[old_id] = new_id
+            self._added.append((self.record_ids, old_id))
+        self._add_photos(item, 'completion', new_id)
+
+    def _add_post(self, item):
+        content, timestamp = _text(item, 'content'), _text(item, 'timestamp')
+        if not content:
+            raise ValueError("缺少帖子内容")
+        timestamp = dates.normalize_timestamp(timestamp) if timestamp else dates.now_timestamp()
+        self.cursor.execute(
+            "INSERT INTO posts (user_id, content, timestamp) VALUES (?, ?, ?) RETURNING id",
+            (self.user_id, content, timestamp)
+        )
+        self._add_photos(item, 'post', self.cursor.fetchone()['id'])
+
+    def _add_photos(self, item, owner_kind, owner_id):
+        # 只引用本站已登记的上传文件 (例如从本站导出的备份)
+        photos = item.get('photos')
+        if not isinstance(photos, list):
+            return
+        for path in upload_store.known_paths(self.cursor, [p for p in photos if isinstance(p, str)]):
+            upload_store.add_photo(self.cursor, path, self.user_id, owner_kind, owner_id)
+
+
+def _read_batch(items):
+    """
+    从请求体读取下一批 (最多 IMPORT_BATCH_SIZE 个非空行)。
+    返回 ([(行号, 数据或错误), ...], 是否已读完, 无法继续解析时的异常)
+    """
+    batch = []
+    try:
+        for line, item in items:
+            if item is not None:
+                batch.append((line, item))
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    return batch, False, None
+    except (ValueError, csv.Error) as e:
+        # 请求体本身无法继续解析 (编码错误、单行过长、CSV 格式错误)，已读到的行照常导入
+        return batch, True, e
+    return batch, True, None
+
+
+def _run_import(conn, items, user_id):
+    """
+    逐批导入并产生进度 JSON 行。
+    **关键修复**: 先把一批行从请求体读入内存，再开启写事务写入并提交。
+    写锁不会在等待客户端上传时被持有，上传缓慢或中断的客户端不会阻塞其他 worker 的写操作。
+    """
+    cursor = conn.cursor()
+    importer = _Importer(cursor, user_id)
+    items = enumerate(items, 1)
+    line, errors = 0, 0
+    imported = dict(importer.counts)    # 已提交的行数
+
+    def progress(**extra):
+        return json.dumps({"line": line, "imported": imported, "errors": errors, **extra}, ensure_ascii=False) + '\n'
+
+    finished = False
+    while not finished:
+        batch, finished, read_error = _read_batch(items)
+        messages = []
+        try:
+            # 显式开启事务；否则最外层的保存点自成事务，RELEASE 时每行单独提交
+            cursor.execute("BEGIN IMMEDIATE")
+            for line, item in batch:
+                try:
+                    if isinstance(item, Exception):
+                        raise item
+                    importer.add(item)
+                except (ValueError, TypeError, KeyError, sqlite3.Error) as e:
+                    # 该行已回滚到它自己的保存点；少数错误 (如磁盘已满) 会让 SQLite 回滚整个事务，此时整批失败
+                    if not conn.in_transaction:
+                        raise sqlite3.OperationalError(f"第 {line} 行导入失败，事务已回滚: {e}") from e
+                    errors += 1
+                    messages.append(json.dumps({"line": line, "error": str(e) or type(e).__name__}, ensure_ascii=False) + '\n')
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            yield progress(done=False, error=str(e))
+            return
+        # 只有提交之后才计入已导入的行数
+        for kind, count in importer.counts.items():
+            imported[kind] += count
+            importer.counts[kind] = 0
+        if messages:
+            yield ''.join(messages)
+        if read_error is not None:
+            yield progress(done=False, error=str(read_error))
+            return
+        yield progress(done=True) if finished else progress()
+
+
+@transfer_bp.route('/api/import', methods=['POST'])
+@login_required
+def import_data():
+    """
+    导入数据，请求体为 JSONL 或 CSV 文件内容 (不使用 multipart，逐行读取请求体)，响应为逐批输出的进度 JSON 行。
+    查询参数: format=jsonl|csv, type=people|records|posts (CSV 必填)
+    """
+    import_format = request.args.get('format', 'jsonl')
+    import_type = request.args.get('type')
+    if import_format not in ('jsonl', 'csv'):
+        return jsonify({"error": "无效的导入格式"}), 400
+    if import_format == 'csv' and import_type not in EXPORT_TYPES:
+        return jsonify({"error": "CSV 导入需要指定 type (people、records 或 posts)"}), 400
+
+    if request.mimetype == 'multipart/form-data':
+        return jsonify({"error": "请直接以请求体发送文件内容"}), 400
+
+    lines = _input_lines(request.stream)
+    items = _jsonl_items(lines) if import_format == 'jsonl' else _csv_items(lines, import_type)
+    body = _run_import(get_db(), items, current_user.id)
+    return Response(stream_with_context(body), mimetype='application/x-ndjson')
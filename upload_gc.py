@@ -0,0 +1,119 @@
+"""
+清理 uploads/ 中不再被引用的文件。
+
+头像被替换、帖子或记录被删除后，触发器会释放对应的引用 (见 migrations.py)，
+引用计数归零的文件在宽限期之后由这里删除；目录中没有登记的文件 (旧版本遗留、
+写入后事务回滚等) 按修改时间同样在宽限期之后删除。
+清理分批进行，每批只短暂持有写锁，可以在线上流量中运行。
+直接运行本文件可以立即执行一次: python upload_gc.py [宽限小时数]
+"""
+import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+import database
+import images
+import jobs
+import upload_store
+
+GRACE_PERIOD = timedelta(hours=24)
+BATCH_SIZE = 100
+BATCH_PAUSE = 0.05      # 两批之间让出写锁的时间 (秒)
+INTERVAL = 6 * 3600     # 后台定期清理的间隔 (秒)
+
+# 按内容命名的文件的其他版本: <sha256>_<版本>.webp
+_VARIANT_NAME = re.compile(r'^([0-9a-f]{64})_\w+' + re.escape(images.IMAGE_EXTENSION) + '$')
+
+
+def _primary_path(filename):
+    match = _VARIANT_NAME.match(filename)
+    if match:
+        return images.primary_path(match.group(1))
+    return f"{images.UPLOAD_FOLDER}/{filename}"
+
+
+def _sweep_registered(conn, cutoff, report):
+    """删除引用计数为 0 且超过宽限期的已登记文件"""
+    while True:
+        paths = [row['path'] for row in conn.execute(
+            "SELECT path FROM uploads WHERE ref_count <= 0 AND COALESCE(orphaned_at, created_at) <= ? LIMIT ?",
+            (cutoff.strftime('%Y-%m-%d %H:%M:%S'), BATCH_SIZE)
+        ).fetchall()]
+        if not paths:
+            return
+        report['bytes'] += upload_store.purge_unreferenced(conn, paths)
+        report['uploads'] += len(paths)
+        time.sleep(BATCH_PAUSE)
+
+
+def _remove_unregistered(conn, entries, report):
+    """删除一批没有登记的文件；在写锁内复查，避免删除刚被 store_upload 登记的文件"""
+    primaries = sorted({_primary_path(entry.name) for entry in entries})
+    placeholders = ','.join('?' for _ in primaries)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        registered = {row['path'] for row in conn.execute(
+            f"SELECT path FROM uploads WHERE path IN ({placeholders})", primaries
+        ).fetchall()}
+        for entry in entries:
+            if _primary_path(entry.name) in registered:
+                continue
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                print(f"Error deleting file {entry.path}: {e}")
+                continue
+            report['bytes'] += size
+            report['files'] += 1
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _sweep_unregistered(conn, cutoff, report):
+    """逐批扫描目录，删除超过宽限期且没有登记的文件"""
+    if not os.path.isdir(images.UPLOAD_FOLDER):
+        return
+    cutoff_ts = cutoff.timestamp()
+    batch = []
+    with os.scandir(images.UPLOAD_FOLDER) as it:
+        for entry in it:
+            if not entry.is_file() or entry.stat().st_mtime >= cutoff_ts:
+                continue
+            batch.append(entry)
+            if len(batch) >= BATCH_SIZE:
+                _remove_unregistered(conn, batch, report)
+                batch = []
+                time.sleep(BATCH_PAUSE)
+    if batch:
+        _remove_unregistered(conn, batch, report)
+
+
+def collect(conn=None, grace=GRACE_PERIOD):
+    """执行一次完整的清理，返回 {"uploads": 删除的登记文件数, "files": 删除的未登记文件数, "bytes": 释放的字节数, "duration_ms": ...}"""
+    conn = conn or database.get_connection()
+    started = time.perf_counter()
+    cutoff = datetime.now() - grace
+    report = {"uploads": 0, "files": 0, "bytes": 0}
+    _sweep_registered(conn, cutoff, report)
+    _sweep_unregistered(conn, cutoff, report)
+    report['duration_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return report
+
+
+# 每隔 INTERVAL 执行一次；下一次由任务调度加入 (见 jobs.py)，本次失败也不会中断
+@jobs.handler('collect_uploads', every=INTERVAL)
+def collect_uploads(conn, payload):
+    report = collect(conn)
+    print(f"Upload GC: removed {report['uploads']} uploads and {report['files']} unregistered files, "
+          f"reclaimed {report['bytes']} bytes in {report['duration_ms']} ms")
+
+
+if __name__ == '__main__':
+    grace = timedelta(hours=float(sys.argv[1])) if len(sys.argv) > 1 else GRACE_PERIOD
+    print(collect(grace=grace))
@@ -0,0 +1,199 @@
+import hashlib
+import mimetypes
+import os
+import tempfile
+from datetime import datetime
+from flask import current_app, send_from_directory, abort
+from werkzeug.security import safe_join
+import images
+
+# --- 按内容寻址的上传文件存储 ---
+# 文件名取 (类型 + 原始字节) 的 SHA-256，相同的图片只处理和保存一次。
+# uploads 表登记每个文件及其引用计数，"谁在哪里引用了它" 记录在 upload_refs 表 (头像) 和
+# photos 表 (帖子照片、完成记录照片，带顺序)。引用计数和删除帖子/记录/用户时的引用释放由触发器维护 (见 migrations.py)。
+#
+# 图片处理在事务之外完成 (prepare_upload)，写入和删除文件则都在持有数据库写锁时进行：
+# store_upload 在登记文件的同一事务中补写缺失的文件，
+# purge_unreferenced 在删除登记的同一事务中删除文件，因此两者不会交错。
+
+
+def _content_name(data, kind):
+    return hashlib.sha256(kind.encode() + b'\0' + data).hexdigest()
+
+
+def _write_atomic(path, data):
+    """先写临时文件再重命名，避免读到写了一半的图片"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _files_size(paths):
+    return sum(os.path.getsize(p) for p in set(paths) if os.path.exists(p))
+
+
+def prepare_upload(file_storage, kind):
+    """
+    读取上传的文件并在内存中生成各个版本，不访问数据库。
+    在开始数据库事务之前调用，避免持有写锁时做耗时的图片处理；已有相同内容的文件时跳过处理。
+    无法识别的文件会抛出 images.InvalidImageError。
+    """
+    data = file_storage.read()
+    path = images.primary_path(_content_name(data, kind))
+    paths = images.variant_paths(path, kind)
+    rendered = None
+    if not all(os.path.exists(p) for p in paths.values()):
+        rendered = images.render_variants(data, kind)
+    return {"data": data, "kind": kind, "path": path, "paths": paths, "rendered": rendered}
+
+
+def store_upload(cursor, upload):
+    """
+    在 uploads 表中登记 prepare_upload 的结果并写入缺失的文件，返回主版本的路径。
+    调用方需要随后用 add_ref 记录引用，并在同一事务中提交。
+    """
+    path, paths = upload['path'], upload['paths']
+    # 这条 INSERT 会取得数据库写锁
+    cursor.execute(
+        "INSERT INTO uploads (path, kind, size, ref_count, created_at) VALUES (?, ?, 0, 0, ?) ON CONFLICT(path) DO NOTHING",
+        (path, upload['kind'], datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    )
+    # 准备之后文件可能已被清理，因此在持有写锁时重新检查
+    missing = [variant for variant, p in paths.items() if not os.path.exists(p)]
+    if missing:
+        rendered = upload['rendered'] or images.render_variants(upload['data'], upload['kind'])
+        if not os.path.exists(images.UPLOAD_FOLDER):
+            os.makedirs(images.UPLOAD_FOLDER)
+        for variant in missing:
+            _write_atomic(paths[variant], rendered[variant])
+        cursor.execute("UPDATE uploads SET size = ? WHERE path = ?", (_files_size(paths.values()), path))
+    return path
+
+
+def add_ref(cursor, path, user_id, owner_kind, owner_id):
+    """记录一次头像引用 (owner_kind 为 'avatar')"""
+    cursor.execute(
+        "INSERT INTO upload_refs (path, user_id, owner_kind, owner_id) VALUES (?, ?, ?, ?)",
+        (path, user_id, owner_kind, owner_id)
+    )
+
+
+def add_photo(cursor, path, user_id, owner_kind, owner_id):
+    """在帖子 ('post') 或完成记录 ('completion') 的照片末尾追加一张，只插入一行"""
+    cursor.execute("""
+        INSERT INTO photos (owner_kind, owner_id, user_id, position, path)
+        SELECT ?, ?, ?, COALESCE(MAX(position) + 1, 0), ? FROM photos WHERE owner_kind = ? AND owner_id = ?
+    """, (owner_kind, owner_id, user_id, path, owner_kind, owner_id))
+
+
+def load_photos(cursor, owner_kind, owner_ids):
+    """一次查询取出多个帖子/记录的照片，返回 {owner_id: [路径, ...]} (按顺序)"""
+    photos = {owner_id: [] for owner_id in owner_ids}
+    if not photos:
+        return photos
+    placeholders = ','.join('?' for _ in photos)
+    cursor.execute(
+        f"SELECT owner_id, path FROM photos WHERE owner_kind = ? AND owner_id IN ({placeholders}) ORDER BY owner_id, position",
+        [owner_kind, *photos]
+    )
+    for row in cursor.fetchall():
+        photos[row['owner_id']].append(row['path'])
+    return photos
+
+
+def known_paths(cursor, paths):
+    """过滤出已在 uploads 表中登记的路径 (保持原顺序)，用于校验客户端提交的已有照片"""
+    if not paths:
+        return []
+    placeholders = ','.join('?' for _ in paths)
+    cursor.execute(f"SELECT path FROM uploads WHERE path IN ({placeholders})", list(paths))
+    known = {row['path'] for row in cursor.fetchall()}
+    return [p for p in paths if p in known]
+
+
+def load_user_photos(cursor, user_id, owner_kind):
+    """取出某个用户所有帖子/记录的照片，返回 {owner_id: [路径, ...]} (按顺序)"""
+    photos = {}
+    cursor.execute(
+        "SELECT owner_id, path FROM photos WHERE user_id = ? AND owner_kind = ? ORDER BY owner_id, position",
+        (user_id, owner_kind)
+    )
+    for row in cursor.fetchall():
+        photos.setdefault(row['owner_id'], []).append(row['path'])
+    return photos
+
+
+def referenced_paths(cursor, user_id):
+    """某个用户建立的所有引用指向的文件"""
+    cursor.execute("""
+        SELECT path FROM upload_refs WHERE user_id = ?
+        UNION
+        SELECT path FROM photos WHERE user_id = ?
+    """, (user_id, user_id))
+    return [row['path'] for row in cursor.fetchall()]
+
+
+def purge_unreferenced(conn, paths):
+    """
+    删除 paths 中引用计数已经为 0 的文件及其所有版本，返回释放的字节数。
+    需要在没有未提交事务的连接上调用。
+    """
+    if not paths:
+        return 0
+    freed = 0
+    placeholders = ','.join('?' for _ in paths)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            f"SELECT path, kind FROM uploads WHERE path IN ({placeholders}) AND ref_count <= 0", list(paths)
+        ).fetchall()
+        for row in rows:
+            conn.execute("DELETE FROM uploads WHERE path = ?", (row['path'],))
+            for file_path in set(images.variant_paths(row['path'], row['kind']).values()):
+                if os.path.exists(file_path):
+                    try:
+                        freed += os.path.getsize(file_path)
+                        os.remove(file_path)
+                    except OSError as e:
+                        # 记录错误，但继续执行，以防文件被占用等问题
+                        print(f"Error deleting file {file_path}: {e}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return freed
+
+
+# --- 上传文件的读取 ---
+# 上传文件的名字在写入后不会再指向其他内容 (新文件按内容哈希命名，旧文件是 uuid)，
+# 浏览器可以缓存一年且无需重新验证。
+# 配置 UPLOADS_ACCEL_REDIRECT (例如 '/_uploads/') 后只返回 X-Accel-Redirect 头，由 nginx 的
+# internal location 发送文件，不再占用 gunicorn worker：
+#   location /_uploads/ { internal; alias /path/to/uploads/; }
+UPLOAD_MAX_AGE = 365 * 24 * 3600
+
+
+def send_upload(filename):
+    accel_prefix = current_app.config.get('UPLOADS_ACCEL_REDIRECT')
+    if accel_prefix:
+        file_path = safe_join(images.UPLOAD_FOLDER, filename)
+        if file_path is None or not os.path.isfile(file_path):
+            abort(404)
+        # Range、ETag/Last-Modified 和 sendfile 由 nginx 处理
+        response = current_app.response_class()
+        response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{filename}"
+        response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    else:
+        # send_from_directory 支持 ETag/Last-Modified 条件请求和 Range 请求，
+        # 并通过 wsgi.file_wrapper 交给 gunicorn 用 sendfile 零拷贝发送
+        # 与写入时一样相对于当前工作目录，而不是 Flask 的 root_path
+        response = send_from_directory(os.path.abspath(images.UPLOAD_FOLDER), filename, max_age=UPLOAD_MAX_AGE)
+    # 需要登录才能访问，因此只允许浏览器缓存，不允许共享缓存
+    response.headers['Cache-Control'] = f"private, max-age={UPLOAD_MAX_AGE}, immutable"
+    return response
@@ -1,4 +1,61 @@
+import threading
+import time
+from collections import OrderedDict
 from flask_login import UserMixin
+from database import get_db
+import metrics
+
+class UserCache:
+    """
+    进程内的 User 对象缓存，用于 Flask-Login 的 load_user。
+    按最近使用淘汰 (LRU)，每个条目 ttl 秒后过期；头像变化、注销账户时需显式失效。
+    多个 gunicorn worker 各有一份缓存，其他 worker 中的旧数据最多保留 ttl 秒。
+    """
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (过期时间, User)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id, user):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self._entries)}
+
+user_cache = UserCache()
+# 命中率等计数在 /metrics 中输出 (cache="user")
+metrics.register_cache('user', user_cache.stats)
 
 class User(UserMixin):
     def __init__(self, id, username, avatar=None):
@@ -8,17 +65,23 @@ class User(UserMixin):
 
     @staticmethod
     def get(user_id):
-        import sqlite3
-        conn = None
-        try:
-            conn = sqlite3.connect('database.db', timeout=15)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-            user_row = cursor.fetchone()
-            if user_row:
-                return User(id=user_row['id'], username=user_row['username'], avatar=user_row['avatar'])
-            return None
-        finally:
-            if conn:
-                conn.close()
\ No newline at end of file
+        # Flask-Login 传入的是字符串，统一转换后作为缓存键
+        user_id = str(user_id)
+        user = user_cache.get(user_id)
+        if user is not None:
+            return user
+
+        # 复用请求范围内的池化连接，而不是每次认证都新建连接
+        cursor = get_db().cursor()
+        cursor.execute("SELECT id, username, avatar FROM users WHERE id = ? AND deleted_at IS NULL", (user_id,))
+        user_row = cursor.fetchone()
+        if user_row:
+            user = User(id=user_row['id'], username=user_row['username'], avatar=user_row['avatar'])
+            user_cache.put(user_id, user)
+            return user
+        return None
+
+    @staticmethod
+    def invalidate(user_id):
+        """用户信息 (如头像) 变化或账户注销后调用，使缓存失效"""
+        user_cache.invalidate(str(user_id))
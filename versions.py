@@ -0,0 +1,50 @@
+from datetime import datetime
+from functools import wraps
+from flask import request, make_response
+from flask_login import current_user
+from database import get_db
+
+# --- 数据版本号与 ETag ---
+# data_versions 表中的版本号由触发器在数据修改的同一事务中递增 (见 migrations.py)，
+# GET 接口先读取版本号生成 ETag，与客户端的 If-None-Match 相同时直接返回 304，
+# 不再查询记录表，也不再序列化 JSON。
+
+FEED_SCOPE = 'feed'
+
+
+def user_scope():
+    return f"user:{current_user.id}"
+
+
+def get_version(scope):
+    row = get_db().execute("SELECT version FROM data_versions WHERE scope = ?", (scope,)).fetchone()
+    return row['version'] if row else 0
+
+
+def conditional_get(scope_func, daily=False):
+    """
+    为 GET 接口添加 ETag / 304 支持。
+    scope_func 返回本接口依赖的版本号范围；daily=True 时 ETag 包含当天日期，
+    用于药品库存等按日期推算、不写数据库也会每天变化的数据。
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # 必须在生成响应之前读取版本号，保证 ETag 不会比响应数据新
+            scope = scope_func()
+            etag = f"u{current_user.id}.{scope}.v{get_version(scope)}"
+            if daily:
+                etag += f".{datetime.now().strftime('%Y%m%d')}"
+
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            # 浏览器可以缓存，但每次使用前都要带 If-None-Match 重新验证
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator